@@ -1,9 +1,12 @@
 import os
+import sqlite3
 
 from flask import Flask
 from flask.ext.admin import Admin
 from flask.ext.sqlalchemy import SQLAlchemy
 from raven.contrib.flask import Sentry
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from werkzeug.contrib.fixers import ProxyFix
 
 
@@ -35,8 +38,24 @@ app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
 db = SQLAlchemy(app)
 admin = Admin(app)
 
+
+# pysqlite begins transactions itself, and not before savepoints, which
+# breaks `begin_nested`; leave it to sqlalchemy instead
+@event.listens_for(Engine, 'connect')
+def sqlite_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+
+@event.listens_for(Engine, 'begin')
+def sqlite_begin(connection):
+    if connection.dialect.name == 'sqlite':
+        connection.connection.execute('BEGIN')
+
+
 import cinch.views
 import cinch.auth.views
 import cinch.github
+import cinch.sha_index  # keeps the index current in every process
 
 cinch  # pyflakes
@@ -5,8 +5,10 @@ from flask.ext.admin.contrib.sqla import ModelView
 
 from cinch import admin, app, db
 from cinch.auth.decorators import is_authenticated
+from cinch.cache import OPEN_PULL_REQUESTS, bump_version
 from cinch.models import Project
 from cinch.jenkins.models import Job
+from cinch.jenkins.controllers import rebuild_job_sha_statuses
 
 log = logging.getLogger(__name__)
 
@@ -25,7 +27,22 @@ class AdminView(ModelView):
 
         return is_authenticated() and session['gh-username'] in admin_users
 
+    def on_model_change(self, form, model, is_created):
+        # e.g. master shas, or the projects of jobs, affect cached statuses
+        bump_version(OPEN_PULL_REQUESTS)
 
-for model in Project, Job:
-    view = AdminView(model, db.session)
-    admin.add_view(view)
+    def on_model_delete(self, model):
+        bump_version(OPEN_PULL_REQUESTS)
+
+
+class JobAdminView(AdminView):
+    def on_model_change(self, form, model, is_created):
+        super(JobAdminView, self).on_model_change(form, model, is_created)
+        # statuses are per combination of shas of the job's projects.
+        # committed along with the change
+        db.session.flush()
+        rebuild_job_sha_statuses([model.id])
+
+
+admin.add_view(AdminView(Project, db.session))
+admin.add_view(JobAdminView(Job, db.session))
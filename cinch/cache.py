@@ -0,0 +1,89 @@
+"""Values computed from the database, shared between requests and events
+
+Each cache is stamped with the stored version of its `name` when computed.
+Changes that may affect a cache bump that version, in the same transaction
+as the change. Caches check the stored version before each use, which is a
+single primary key lookup.
+"""
+
+import threading
+import uuid
+
+from cinch import db
+from cinch.models import CacheVersion
+
+
+# the jenkins build statuses of all open pull requests
+OPEN_PULL_REQUESTS = 'open_pull_requests'
+# the heads and merge heads of all open pull requests
+OPEN_PULL_REQUEST_SHAS = 'open_pull_request_shas'
+
+
+def get_version(name):
+    return db.session.query(CacheVersion.version).filter(
+        CacheVersion.name == name).scalar()
+
+
+def bump_version(name, session=None):
+    """Record a change invalidating caches of `name`, in all processes
+
+    Uses `session` if given (e.g. from a session event), otherwise
+    `db.session`. Does not commit. Returns the new version.
+    """
+    if session is None:
+        session = db.session
+    version = uuid.uuid4().hex
+    updated = session.query(CacheVersion).filter(
+        CacheVersion.name == name,
+    ).update({CacheVersion.version: version}, synchronize_session=False)
+    if not updated:
+        session.add(CacheVersion(name=name, version=version))
+    return version
+
+
+class VersionedCache(object):
+    """The result of `compute()`, shared by all threads of this process
+    until the stored version of `name` changes
+
+    The result must not be modified, or hold on to database sessions (e.g.
+    via ORM instances). If given, `refresh(value)` is tried before computing
+    afresh, to bring an earlier result up to date; it returns a new value,
+    or None if it can't.
+    """
+
+    def __init__(self, name, compute, refresh=None):
+        self.name = name
+        self.compute = compute
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        # (version, value)
+        self._entry = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self):
+        with self._lock:
+            entry = self._entry
+
+        # read before computing, so that changes made meanwhile invalidate
+        # the result
+        version = get_version(self.name)
+        if entry is not None and entry[0] == version:
+            with self._lock:
+                self.hits += 1
+            return entry[1]
+
+        value = None
+        if entry is not None and self.refresh is not None:
+            value = self.refresh(entry[1])
+        if value is None:
+            value = self.compute()
+            with self._lock:
+                self.misses += 1
+        with self._lock:
+            self._entry = (version, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entry = None
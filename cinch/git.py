@@ -1,11 +1,19 @@
 """Make bare clones of repos to use for faster (local) comparison operations"""
 
+from collections import Mapping, OrderedDict
 import errno
+import heapq
+import json
 import logging
 import os
+import re
 import subprocess
+import threading
+import time
 
 from cinch import app
+from cinch.object_store import (
+    CommitGraph, ObjectStore, ObjectStoreError, RefStore, SHA_PATTERN)
 
 
 GIT_ERROR = 128
@@ -18,6 +26,45 @@ PULL_REQUEST_REMOTES = {
     'pr_merge': '+refs/pull/*/merge:refs/remotes/pr_merge/*',
 }
 
+# refspecs for fetching only the refs affected by an event. the trailing globs
+# make the pull request refs optional: github removes the merge ref for pull
+# requests that don't merge cleanly, and fetching a missing ref is an error
+MASTER_REFSPEC = '+refs/heads/master:refs/remotes/origin/master'
+PULL_REQUEST_HEAD_REFSPEC = '+refs/pull/{0}/head*:refs/remotes/pr_head/{0}*'
+PULL_REQUEST_MERGE_REFSPEC = (
+    '+refs/pull/{0}/merge*:refs/remotes/pr_merge/{0}*')
+
+# strategies for cloning new repos (`CLONE_STRATEGY` config key)
+CLONE_FULL = 'full'
+# repos of the same owner share objects from a common store, via alternates
+CLONE_SHARED = 'shared'
+# commits and trees only; blobs are fetched on demand (e.g. for merges)
+CLONE_PARTIAL = 'partial'
+
+PARTIAL_CLONE_FILTER = 'blob:none'
+# `@` is not allowed in github repo names, so this can't clash with a project
+SHARED_STORE_NAME = '@shared.git'
+
+# first git version supporting `commit-graph write --changed-paths`
+CHANGED_PATHS_MIN_VERSION = (2, 27)
+
+# first git version supporting `merge-tree --write-tree`
+WRITE_TREE_MIN_VERSION = (2, 38)
+
+# config values (from the environment, so strings) that disable a flag
+FALSE_VALUES = ('', '0', 'false', 'no', 'off')
+
+# refs included in a `RefSnapshot` (master, and pull request heads and merge
+# heads)
+REF_SNAPSHOT_PREFIX = 'refs/remotes/'
+
+# number of pull request heads whose counts relative to master are kept, to
+# derive new counts from when master fast forwards
+MAX_MASTER_COUNTS = 10000
+
+MERGE_CACHE_FILENAME = 'cinch_merge_cache.json'
+DEFAULT_MERGE_CACHE_SIZE = 1000
+
 _log = logging.getLogger(__name__)
 
 
@@ -25,6 +72,853 @@ class NotARepo(Exception):
     pass
 
 
+class GitError(Exception):
+    pass
+
+
+class GitProcessError(GitError):
+    pass
+
+
+class BatchProcess(object):
+    """A long-running ``git cat-file`` process, answering one query per line
+
+    The process is started on first use and restarted if it dies, or after
+    serving `max_requests` queries (to bound any memory git holds on to for
+    its object caches).
+    """
+
+    def __init__(self, path, mode, max_requests=10000):
+        self.path = path
+        self.mode = mode
+        self.max_requests = max_requests
+        self.requests = 0
+        self.starts = 0
+        self._process = None
+        self._lock = threading.Lock()
+
+    def is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def _start(self):
+        git_dir = '--git-dir={}'.format(self.path)
+        with open(os.devnull, 'w') as devnull:
+            self._process = subprocess.Popen(
+                ['git', git_dir, 'cat-file', self.mode],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=devnull,
+            )
+        self.starts += 1
+        self.requests = 0
+
+    def stop(self):
+        process, self._process = self._process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+    def _query(self, name):
+        process = self._process
+        process.stdin.write('{}\n'.format(name))
+        process.stdin.flush()
+        header = process.stdout.readline()
+        if not header:
+            raise GitProcessError(
+                'git cat-file exited (status {})'.format(process.poll()))
+
+        parts = header.split()
+        if parts[-1] == 'missing':
+            return None, None
+
+        sha, object_type, size = parts
+        body = None
+        if self.mode == '--batch':
+            body = process.stdout.read(int(size))
+            process.stdout.read(1)  # trailing newline
+        return (sha, object_type), body
+
+    def query(self, name):
+        """Return ``((sha, type), body)`` for the object `name` resolves to
+
+        ``body`` is only read in ``--batch`` mode. Returns ``(None, None)``
+        for names that don't resolve to an object.
+        """
+        with self._lock:
+            if self.requests >= self.max_requests:
+                self.stop()
+            error = None
+            for _ in range(2):
+                if not self.is_alive():
+                    self._start()
+                try:
+                    result = self._query(name)
+                except (IOError, OSError, GitProcessError) as ex:
+                    _log.debug('git cat-file failed for %s: %s', self.path, ex)
+                    error = ex
+                    self.stop()
+                else:
+                    self.requests += 1
+                    return result
+            raise GitProcessError(error)
+
+
+class GitBackend(object):
+    """Read-only access to a single repo, shared by all `Repo` instances for
+    the same path
+
+    Subclasses look up refs and objects, by providing:
+
+    - ``is_healthy()``: whether the repo can be read at all
+    - ``resolve(rev)``: the sha `rev` points to, or None if it can't be
+      resolved
+    - ``read_object(sha)``: ``(type, data)`` for an object, or None if not
+      present
+    - ``list_refs(prefix)``: a dict mapping full names of refs under
+      `prefix` to shas
+
+    Commit walks are done in-process. Parents and generation numbers are
+    read from the repo's commit graph (written by maintenance) where it
+    covers a commit, and otherwise cached in-process, up to
+    `MAX_CACHED_COMMITS`. Also holds per-repo state such as the merge cache
+    and fetch coordinator.
+    """
+
+    # any repo can look up the empty tree
+    EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+    # past this many commits, the in-process caches are dropped after a
+    # walk
+    MAX_CACHED_COMMITS = 100000
+
+    def __init__(self, path):
+        self.path = path
+        self._parents = {}
+        self._generations = {}
+        self._commit_graph = None
+        self._commit_graph_stat = None
+        # last time the repo was used; maintenance only runs on idle repos,
+        # so not straight after the worker starts
+        self.last_used = time.time()
+        self.maintenance_stats = None
+        self.maintenance_lock = threading.Lock()
+        self.fetches = FetchCoordinator(
+            window=float(app.config.get('FETCH_COALESCE_WINDOW', 0)))
+        self.merge_cache = MergeCache(
+            os.path.join(path, MERGE_CACHE_FILENAME),
+            max_size=int(app.config.get(
+                'MERGE_CACHE_SIZE', DEFAULT_MERGE_CACHE_SIZE)),
+        )
+        self._ref_snapshot = None
+        self._ref_snapshot_lock = threading.Lock()
+        # tip sha -> (master sha, (behind, ahead)) as last counted by
+        # `Repo.compare_prs`
+        self.master_counts = {}
+
+    def close(self):
+        self.merge_cache.save()
+
+    def touch(self):
+        self.last_used = time.time()
+
+    def ref_snapshot(self):
+        """Return the current `RefSnapshot`, reading refs if necessary"""
+        with self._ref_snapshot_lock:
+            if self._ref_snapshot is None:
+                self.touch()
+                refs = self.list_refs(REF_SNAPSHOT_PREFIX)
+                self._ref_snapshot = RefSnapshot(
+                    (name[len(REF_SNAPSHOT_PREFIX):], sha)
+                    for name, sha in refs.items()
+                )
+            return self._ref_snapshot
+
+    def invalidate_refs(self):
+        """Drop the current `RefSnapshot`, e.g. after a fetch"""
+        with self._ref_snapshot_lock:
+            self._ref_snapshot = None
+
+    def load_history(self, tips):
+        """Hint that commits reachable from `tips` are about to be walked"""
+
+    def refresh_commit_graph(self):
+        """Pick up a rewritten commit graph, e.g. before walking commits"""
+        filename = os.path.join(self.path, 'objects', 'info', 'commit-graph')
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            stat_key = None
+        else:
+            stat_key = (stat.st_mtime, stat.st_size, stat.st_ino)
+
+        if stat_key != self._commit_graph_stat:
+            commit_graph = None
+            if stat_key is not None:
+                try:
+                    commit_graph = CommitGraph(filename)
+                except (IOError, ValueError, ObjectStoreError) as ex:
+                    _log.warning('not using commit graph of %s: %s',
+                                 self.path, ex)
+            # the previous graph is closed once no walk is using it
+            self._commit_graph = commit_graph
+            self._commit_graph_stat = stat_key
+            self.drop_history()
+
+    def bound_history(self):
+        """Drop the in-process caches if they've grown too large"""
+        if (len(self._parents) > self.MAX_CACHED_COMMITS or
+                len(self._generations) > self.MAX_CACHED_COMMITS):
+            self.drop_history()
+
+    def drop_history(self):
+        """Forget cached parents and generation numbers"""
+        # replaced rather than cleared, for any walk still using them
+        self._parents = {}
+        self._generations = {}
+
+    def parents(self, sha):
+        try:
+            return self._parents[sha]
+        except KeyError:
+            pass
+
+        commit_graph = self._commit_graph
+        if commit_graph is not None:
+            entry = commit_graph.read(sha)
+            if entry is not None:
+                return entry[0]
+
+        self.touch()
+        result = self.read_object(sha)
+        if result is None or result[0] != 'commit':
+            raise GitError('{} is not a commit'.format(sha))
+        _, body = result
+
+        parents = []
+        for line in body.split('\n'):
+            if not line:
+                break  # end of commit headers
+            if line.startswith('parent '):
+                parents.append(line[len('parent '):])
+        parents = tuple(parents)
+        self._parents[sha] = parents
+        return parents
+
+    def generation(self, sha):
+        """Length of the longest path from `sha` to a root commit
+
+        Commits not in the commit graph are walked back to ones that are
+        (or to the root commits, if there's no graph).
+        """
+        commit_graph = self._commit_graph
+        generations = self._generations
+
+        def known(current):
+            generation = generations.get(current)
+            if generation is None and commit_graph is not None:
+                entry = commit_graph.read(current)
+                if entry is not None:
+                    generation = entry[1]
+            return generation
+
+        stack = [sha]
+        while stack:
+            current = stack[-1]
+            if known(current) is not None:
+                stack.pop()
+                continue
+            parents = self.parents(current)
+            parent_generations = [known(parent) for parent in parents]
+            missing = [
+                parent
+                for parent, generation in zip(parents, parent_generations)
+                if generation is None
+            ]
+            if missing:
+                stack.extend(missing)
+                continue
+            generations[current] = 1 + max(parent_generations or [0])
+            stack.pop()
+        return known(sha)
+
+    def count_exclusive_many(self, base, tips):
+        """Return ``(base_only, tip_only)`` commit counts for each of `tips`
+
+        Equivalent to ``git rev-list --left-right --count base...tip`` for
+        every tip, in a single walk. Each commit carries a bitmask of the
+        shas it is reachable from (bit 0 for `base`). Commits are visited in
+        order of decreasing generation, so a commit's mask is final when it
+        is popped, and the walk stops as soon as everything left to visit is
+        reachable from every sha.
+        """
+        self.refresh_commit_graph()
+        base_bit = 1
+        full = (1 << (len(tips) + 1)) - 1
+        masks = {}
+        heap = []
+        # number of popped commits per mask
+        mask_counts = {}
+        # number of queued commits not (yet) reachable from every sha
+        interesting = [0]
+
+        def push(sha, mask):
+            existing = masks.get(sha)
+            if existing is None:
+                masks[sha] = mask
+                heapq.heappush(heap, (-self.generation(sha), sha))
+                if mask != full:
+                    interesting[0] += 1
+            elif existing | mask != existing:
+                masks[sha] = existing | mask
+                if existing | mask == full:
+                    interesting[0] -= 1
+
+        push(base, base_bit)
+        for index, tip in enumerate(tips):
+            push(tip, 1 << (index + 1))
+
+        while interesting[0]:
+            _, sha = heapq.heappop(heap)
+            mask = masks[sha]
+            if mask != full:
+                interesting[0] -= 1
+                mask_counts[mask] = mask_counts.get(mask, 0) + 1
+            for parent in self.parents(sha):
+                push(parent, mask)
+
+        results = []
+        for index in range(len(tips)):
+            tip_bit = 1 << (index + 1)
+            base_only = tip_only = 0
+            for mask, count in mask_counts.items():
+                if mask & base_bit and not mask & tip_bit:
+                    base_only += count
+                elif mask & tip_bit and not mask & base_bit:
+                    tip_only += count
+            results.append((base_only, tip_only))
+        self.bound_history()
+        return results
+
+    def count_exclusive(self, left, right):
+        """Return ``(left_only, right_only)`` commit counts for two shas"""
+        [counts] = self.count_exclusive_many(left, [right])
+        return counts
+
+    def count_new_many(self, old, new, tips):
+        """Count the commits added by moving from `old` to `new`
+
+        Returns a tuple of the number of new commits, and a list of the
+        number of those not reachable from each of `tips` (i.e. ``git
+        rev-list --count new ^old ^tip``), or None if `new` isn't a fast
+        forward from `old`.
+
+        Like `count_exclusive_many`, but the walk only covers the new
+        commits (and any commits of the tips newer than those), rather than
+        going back to the merge bases of the tips.
+        """
+        self.refresh_commit_graph()
+        old_bit, new_bit = 1, 2
+        masks = {}
+        heap = []
+        # number of queued commits reachable from `new` but not `old`
+        interesting = [0]
+
+        def is_new(mask):
+            return mask & (old_bit | new_bit) == new_bit
+
+        def push(sha, mask):
+            existing = masks.get(sha)
+            if existing is None:
+                masks[sha] = mask
+                heapq.heappush(heap, (-self.generation(sha), sha))
+                if is_new(mask):
+                    interesting[0] += 1
+            elif existing | mask != existing:
+                masks[sha] = existing | mask
+                interesting[0] += is_new(existing | mask) - is_new(existing)
+
+        push(old, old_bit)
+        push(new, new_bit)
+        for index, tip in enumerate(tips):
+            push(tip, 4 << index)
+
+        new_count = 0
+        tip_counts = [0] * len(tips)
+        while interesting[0]:
+            _, sha = heapq.heappop(heap)
+            mask = masks[sha]
+            if is_new(mask):
+                interesting[0] -= 1
+                new_count += 1
+                for index in range(len(tips)):
+                    if not mask & (4 << index):
+                        tip_counts[index] += 1
+            for parent in self.parents(sha):
+                push(parent, mask)
+
+        self.bound_history()
+        # any descendants of `old` have been visited by now
+        if not masks[old] & new_bit:
+            return None
+        return new_count, tip_counts
+
+
+class CatFileBackend(GitBackend):
+    """Uses persistent ``git cat-file`` processes
+
+    Answers ref lookups and reads commits without starting a new git process
+    per call.
+    """
+
+    # maximum number of fully loaded tips passed to ``rev-list --not``
+    MAX_LOADED_TIPS = 50
+
+    def __init__(self, path):
+        super(CatFileBackend, self).__init__(path)
+        self._check = BatchProcess(path, '--batch-check')
+        self._batch = BatchProcess(path, '--batch')
+        # shas whose entire history is in `_parents`, least recently loaded
+        # first (values are unused)
+        self._loaded = OrderedDict()
+
+    def close(self):
+        self._check.stop()
+        self._batch.stop()
+        super(CatFileBackend, self).close()
+
+    def is_healthy(self):
+        try:
+            sha = self.resolve(self.EMPTY_TREE)
+        except GitProcessError:
+            return False
+        return sha == self.EMPTY_TREE
+
+    def resolve(self, rev):
+        self.touch()
+        info, _ = self._check.query(rev)
+        if info is None:
+            return None
+        sha, _ = info
+        return sha
+
+    def read_object(self, sha):
+        info, body = self._batch.query(sha)
+        if info is None:
+            return None
+        _, object_type = info
+        return object_type, body
+
+    def list_refs(self, prefix):
+        git_dir = '--git-dir={}'.format(self.path)
+        try:
+            output = subprocess.check_output([
+                'git', git_dir, 'for-each-ref',
+                '--format=%(objectname) %(refname)', prefix,
+            ])
+        except subprocess.CalledProcessError as ex:
+            raise GitProcessError(
+                'for-each-ref failed with status {}'.format(ex.returncode))
+        refs = {}
+        for line in output.splitlines():
+            sha, name = line.split(' ', 1)
+            refs[name] = sha
+        return refs
+
+    def load_history(self, tips):
+        """Cache the parents of every commit reachable from `tips`
+
+        Uses a single ``git rev-list --parents`` dump rather than reading
+        commits one at a time, skipping history already loaded by a previous
+        call. Loaded tips that have since vanished from the repo (e.g. on
+        gc) are ignored.
+
+        Not needed once the repo has a commit graph; only commits newer
+        than the graph are read, one at a time.
+        """
+        self.refresh_commit_graph()
+        if self._commit_graph is not None:
+            return
+
+        new_tips = [sha for sha in tips if sha not in self._loaded]
+        if not new_tips:
+            return
+
+        git_dir = '--git-dir={}'.format(self.path)
+        cmd = ['git', git_dir, 'rev-list', '--parents', '--ignore-missing']
+        cmd += new_tips
+        if self._loaded:
+            cmd += ['--not'] + list(self._loaded)
+
+        parents = self._parents
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        for line in process.stdout:
+            shas = line.split()
+            parents[shas[0]] = tuple(shas[1:])
+        if process.wait():
+            # start over next time, in case any loaded tip is to blame
+            self._loaded.clear()
+            raise GitProcessError(
+                'rev-list failed with status {}'.format(process.returncode))
+
+        for sha in new_tips:
+            self._loaded[sha] = True
+        # only the latest tips are needed to exclude known history; cap the
+        # command line length
+        while len(self._loaded) > self.MAX_LOADED_TIPS:
+            self._loaded.popitem(last=False)
+
+    def drop_history(self):
+        super(CatFileBackend, self).drop_history()
+        self._loaded = OrderedDict()
+
+
+class NativeBackend(GitBackend):
+    """Reads refs and objects directly from the repo's files
+
+    No git processes are started at all; see `cinch.object_store`.
+    """
+
+    # e.g. `origin/master^2~3`
+    REV_PATTERN = re.compile(r'^(?P<name>.*?)(?P<suffix>(?:[~^][0-9]*)*)$')
+    SUFFIX_PATTERN = re.compile(r'([~^])([0-9]*)')
+
+    def __init__(self, path):
+        super(NativeBackend, self).__init__(path)
+        self.objects = ObjectStore(path)
+        self.refs = RefStore(path)
+
+    def close(self):
+        self.objects.close()
+        super(NativeBackend, self).close()
+
+    def is_healthy(self):
+        return (
+            os.path.isfile(os.path.join(self.path, 'HEAD')) and
+            os.path.isdir(os.path.join(self.path, 'objects'))
+        )
+
+    def read_object(self, sha):
+        try:
+            return self.objects.read(sha)
+        except ObjectStoreError as ex:
+            raise GitError(ex)
+
+    def list_refs(self, prefix):
+        return self.refs.list_refs(prefix)
+
+    def _exists(self, sha):
+        return sha == self.EMPTY_TREE or self.read_object(sha) is not None
+
+    def resolve(self, rev):
+        self.touch()
+        if not self.is_healthy():
+            return None
+
+        match = self.REV_PATTERN.match(rev)
+        name = match.group('name')
+        if SHA_PATTERN.match(name):
+            sha = name if self._exists(name) else None
+        else:
+            sha = self.refs.resolve(name)
+        if sha is None:
+            return None
+
+        for operator, number in self.SUFFIX_PATTERN.findall(
+                match.group('suffix')):
+            if operator == '^':
+                number = int(number or 1)
+                if number == 0:
+                    continue
+                parents = self.parents(sha)
+                if len(parents) < number:
+                    return None
+                sha = parents[number - 1]
+            else:
+                for _ in range(int(number or 1)):
+                    parents = self.parents(sha)
+                    if not parents:
+                        return None
+                    sha = parents[0]
+        return sha
+
+
+class RefSnapshot(Mapping):
+    """An immutable mapping of remote ref names (e.g. ``origin/master``,
+    ``pr_head/12``) to shas, as they were at a single point in time
+
+    All refs are read at once, instead of looking each one up separately.
+    """
+
+    def __init__(self, refs):
+        self._refs = dict(refs)
+
+    def __getitem__(self, name):
+        return self._refs[name]
+
+    def __iter__(self):
+        return iter(self._refs)
+
+    def __len__(self):
+        return len(self._refs)
+
+
+# values for the `GIT_BACKEND` config key
+BACKENDS = {
+    'cat-file': CatFileBackend,
+    'native': NativeBackend,
+}
+DEFAULT_BACKEND = 'cat-file'
+
+
+class MergeCache(object):
+    """Least recently used cache of merge results, persisted to a json file
+
+    Results are keyed by the (merge base, pull request head, master) shas,
+    which fully determine the outcome of the merge. Each entry records
+    whether the merge is clean, and the paths that conflict if not.
+
+    Changes are written out at most every `save_interval` seconds, and when
+    the cache is closed.
+    """
+
+    def __init__(self, filename, max_size=DEFAULT_MERGE_CACHE_SIZE,
+                 save_interval=5):
+        self.filename = filename
+        self.max_size = max_size
+        self.save_interval = save_interval
+        self._entries = None
+        self._dirty = False
+        self._last_save = 0
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = OrderedDict()
+            try:
+                with open(self.filename) as handle:
+                    stored = json.load(handle)
+            except (IOError, ValueError):
+                stored = []
+            for key, value in stored:
+                self._entries[tuple(key)] = value
+        return self._entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, merge_base, head, master):
+        """Return (mergeable, conflicting paths), or None if not cached"""
+        key = (merge_base, head, master)
+        value = self.entries.pop(key, None)
+        if value is None:
+            return None
+        self.entries[key] = value  # most recently used
+        return value['mergeable'], value['conflicts']
+
+    def find_previous(self, merge_base, head):
+        """Return the most recently used (master, mergeable, conflicting
+        paths) for this merge base and pull request head, or None
+        """
+        for key in reversed(self.entries):
+            if key[:2] == (merge_base, head):
+                value = self.entries[key]
+                return key[2], value['mergeable'], value['conflicts']
+        return None
+
+    def set(self, merge_base, head, master, mergeable, conflicts):
+        key = (merge_base, head, master)
+        self.entries.pop(key, None)
+        self.entries[key] = {
+            'mergeable': mergeable,
+            'conflicts': sorted(conflicts),
+        }
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self._dirty = True
+        if time.time() - self._last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_filename = '{}.tmp'.format(self.filename)
+        with open(tmp_filename, 'w') as handle:
+            json.dump(list(self.entries.items()), handle)
+        os.rename(tmp_filename, self.filename)
+        self._dirty = False
+        self._last_save = time.time()
+
+
+class FetchCoordinator(object):
+    """Coalesces fetches of a single repo
+
+    Requests made while a fetch is running are merged into a single
+    follow-up fetch. A request is also satisfied by any fetch of the same
+    refs that started after it was made, or within `window` seconds before.
+    """
+
+    # key used for full fetches (of all refs)
+    ALL = None
+
+    def __init__(self, window=0):
+        self.window = window
+        self.last_fetched = {}
+        self.fetches = 0
+        self.coalesced = 0
+        self._condition = threading.Condition(threading.Lock())
+        self._pending = set()
+        self._fetching = False
+
+    def fetched_at(self, refspec):
+        """Return when the latest fetch of `refspec` (or of everything)
+        started, or 0 if there wasn't one
+        """
+        return max(
+            self.last_fetched.get(refspec, 0),
+            self.last_fetched.get(self.ALL, 0),
+        )
+
+    def _fetched_since(self, refspec, since):
+        return self.fetched_at(refspec) >= since
+
+    def fetch(self, repo, refspecs=None):
+        """Fetch `refspecs` (or everything if None) using ``repo._fetch``"""
+        requested_at = time.time()
+        if refspecs is None:
+            refspecs = [self.ALL]
+
+        with self._condition:
+            refspecs = [
+                refspec for refspec in refspecs
+                if not self._fetched_since(
+                    refspec, requested_at - self.window)
+            ]
+            if not refspecs:
+                self.coalesced += 1
+                return
+
+            self._pending.update(refspecs)
+            while self._fetching:
+                self._condition.wait()
+                if all(self._fetched_since(refspec, requested_at)
+                       for refspec in refspecs):
+                    # fetched by a concurrent request
+                    self.coalesced += 1
+                    return
+
+            # our refspecs may have been part of a fetch that failed
+            self._pending.update(refspecs)
+            self._fetching = True
+            batch = self._pending
+            self._pending = set()
+            started = time.time()
+
+        succeeded = False
+        try:
+            if self.ALL in batch:
+                repo._fetch(None)
+            else:
+                repo._fetch(sorted(batch))
+            succeeded = True
+        finally:
+            with self._condition:
+                if succeeded:
+                    self.fetches += 1
+                    for refspec in batch:
+                        self.last_fetched[refspec] = started
+                self._fetching = False
+                self._condition.notify_all()
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(path):
+    """Return the shared `GitBackend` for the repo at `path`"""
+    with _backends_lock:
+        backend = _backends.get(path)
+        if backend is None:
+            backend_name = app.config.get('GIT_BACKEND', DEFAULT_BACKEND)
+            try:
+                backend_class = BACKENDS[backend_name]
+            except KeyError:
+                raise RuntimeError(
+                    'Unknown GIT_BACKEND {}'.format(backend_name))
+            backend = backend_class(path)
+            _backends[path] = backend
+        return backend
+
+
+def close_backends():
+    with _backends_lock:
+        for backend in _backends.values():
+            backend.close()
+        _backends.clear()
+
+
+_git_version = []
+
+
+def git_version():
+    """Return the installed git version as a tuple of ints"""
+    if not _git_version:
+        output = subprocess.check_output(['git', 'version'])
+        # e.g. `git version 2.39.5` or `git version 2.37.1 (Apple Git-137.1)`
+        version = output.split()[2]
+        _git_version.append(tuple(
+            int(part) for part in version.split('.') if part.isdigit()))
+    return _git_version[0]
+
+
+def setup_shared_store(owner_base_dir, name, url):
+    """Create (if necessary) the object store shared by all repos of an
+    owner, and fetch the project `name` into it
+
+    Branches are kept under ``refs/projects/<name>/`` so their objects are
+    never pruned from the store. Returns the path of the store.
+    """
+    shared_store = os.path.join(owner_base_dir, SHARED_STORE_NAME)
+    git_dir = '--git-dir={}'.format(shared_store)
+    if not os.path.exists(shared_store):
+        subprocess.check_call(
+            ['git', 'init', '--quiet', '--bare', shared_store])
+
+    refspec = '+refs/heads/*:refs/projects/{}/heads/*'.format(name)
+    subprocess.check_call(
+        ['git', git_dir, 'fetch', '--quiet', '--no-tags', url, refspec])
+    return shared_store
+
+
+def config_flag(key):
+    """Return True if the config key `key` is set to a true value"""
+    value = app.config.get(key)
+    return value is not None and str(value).lower() not in FALSE_VALUES
+
+
+def maintenance_commands():
+    """Commands that keep commit walks fast as history grows"""
+    commit_graph = ['commit-graph', 'write', '--reachable']
+    if git_version() >= CHANGED_PATHS_MIN_VERSION:
+        commit_graph.append('--changed-paths')
+
+    return [
+        ['pack-refs', '--all'],
+        # `-l` leaves objects from a shared store (alternates) alone.
+        # unreachable objects (e.g. old heads of force pushed pull
+        # requests) are kept, as backends may still refer to them
+        ['repack', '-a', '-d', '-l', '-q', '--keep-unreachable',
+         '--write-bitmap-index'],
+        commit_graph,
+    ]
+
+
 def add_custom_remote(repo, name, url, spec):
     repo.cmd([
         'remote',
@@ -56,11 +950,23 @@ class Repo(object):
 
         url = GITHUB_URL_TEMPLATE.format(owner, name)
 
+        strategy = app.config.get('CLONE_STRATEGY', CLONE_FULL)
+        clone_options = []
+        if strategy == CLONE_SHARED:
+            shared_store = setup_shared_store(owner_base_dir, name, url)
+            clone_options = ['--reference', shared_store]
+        elif strategy == CLONE_PARTIAL:
+            clone_options = ['--filter={}'.format(PARTIAL_CLONE_FILTER)]
+        elif strategy != CLONE_FULL:
+            raise RuntimeError(
+                'Unknown CLONE_STRATEGY {}'.format(strategy))
+
         subprocess.check_call(
             [
                 'git',
                 'clone',
                 '--bare',
+            ] + clone_options + [
                 url,
                 name,
             ],
@@ -83,6 +989,17 @@ class Repo(object):
                 url,
                 spec
             )
+            if strategy == CLONE_PARTIAL:
+                # otherwise full fetches would download all blobs
+                repo.cmd([
+                    'config', 'remote.{}.promisor'.format(remote_name),
+                    'true',
+                ])
+                repo.cmd([
+                    'config',
+                    'remote.{}.partialclonefilter'.format(remote_name),
+                    PARTIAL_CLONE_FILTER,
+                ])
         repo.fetch()
         return repo
 
@@ -94,20 +1011,104 @@ class Repo(object):
         repo = cls(repo_dir)
         return repo
 
+    @property
+    def backend(self):
+        return get_backend(self.path)
+
     def is_repo(self):
+        return self.backend.is_healthy()
+
+    def fetch(self, refspecs=None):
+        """Fetch from github
+
+        By default, all remotes are fetched in full. If `refspecs` are given,
+        only those are fetched from origin. Concurrent and recent fetches of
+        the same refs are coalesced; see `FetchCoordinator`.
+        """
+        self.backend.fetches.fetch(self, refspecs)
+
+    def _fetch(self, refspecs):
         try:
-            self.cmd(['rev-parse'], bubble_errors=True)
-        except subprocess.CalledProcessError as ex:
-            if ex.returncode == GIT_ERROR:
-                return False
-            raise
+            if refspecs is None:
+                self.cmd(['fetch', '--all'])
+            else:
+                self.cmd(['fetch', 'origin'] + list(refspecs))
+        finally:
+            # even failed fetches may have updated some refs
+            self.backend.invalidate_refs()
+
+    def ref_snapshot(self):
+        """Return a `RefSnapshot` of master and all pull request heads and
+        merge heads
+
+        Refs are read in one go, and the snapshot is shared until the next
+        fetch.
+        """
+        return self.backend.ref_snapshot()
+
+    def fetch_master(self, pull_request_numbers=(), sha=None):
+        """Fetch master, along with the merge heads of the given pull
+        requests (which github updates when master moves)
+
+        If `sha` is given and master is already there locally, only merge
+        heads that haven't been fetched since master was are fetched.
+        """
+        if sha is not None and self.ref_snapshot().get('origin/master') == sha:
+            refspecs = self._stale_merge_refspecs(pull_request_numbers)
         else:
-            return True
+            refspecs = [MASTER_REFSPEC] + [
+                PULL_REQUEST_MERGE_REFSPEC.format(number)
+                for number in pull_request_numbers
+            ]
+        if refspecs:
+            self.fetch(refspecs)
+
+    def _stale_merge_refspecs(self, pull_request_numbers):
+        """Return the merge refspecs of the given pull requests that haven't
+        been fetched since master was
+        """
+        fetches = self.backend.fetches
+        master_fetched = fetches.fetched_at(MASTER_REFSPEC)
+        refspecs = [
+            PULL_REQUEST_MERGE_REFSPEC.format(number)
+            for number in pull_request_numbers
+        ]
+        return [
+            refspec for refspec in refspecs
+            if not master_fetched or
+            fetches.fetched_at(refspec) < master_fetched
+        ]
 
-    def fetch(self):
-        self.cmd(['fetch', '--all'])
+    def fetch_pull_request(self, pull_request_number, head=None):
+        """Fetch the head and merge head of a single pull request
+
+        If `head` is given and the pull request is already there locally,
+        only its merge head is fetched, unless it was since master was.
+        """
+        self.fetch_pull_requests({pull_request_number: head})
+
+    def fetch_pull_requests(self, heads):
+        """Fetch the heads and merge heads of several pull requests at once
+
+        `heads` maps pull request numbers to their heads (or None). Pull
+        requests whose head is already there locally only have their merge
+        heads fetched, which also move with master, unless they were since
+        master was.
+        """
+        refs = self.ref_snapshot()
+        refspecs = []
+        for number, head in sorted(heads.items()):
+            pr_ref = self._pull_request_ref(number)
+            if head is not None and refs.get(pr_ref) == head:
+                refspecs.extend(self._stale_merge_refspecs([number]))
+                continue
+            refspecs.append(PULL_REQUEST_HEAD_REFSPEC.format(number))
+            refspecs.append(PULL_REQUEST_MERGE_REFSPEC.format(number))
+        if refspecs:
+            self.fetch(refspecs)
 
     def cmd(self, cmd, bubble_errors=False):
+        self.backend.touch()
         git_dir = '--git-dir={}'.format(self.path)
         git_cmd = ['git', git_dir] + cmd
         try:
@@ -120,58 +1121,312 @@ class Repo(object):
                 return None
         return output.strip()
 
+    def is_idle(self, idle_time):
+        """Return True if the repo hasn't been used for `idle_time` seconds
+        by this process
+        """
+        return time.time() - self.backend.last_used >= idle_time
+
+    def _time_walk(self):
+        """Time comparing all pull requests to master from scratch, with the
+        in-process walk `compare_prs` uses
+        """
+        backend = self.backend
+        refs = self.ref_snapshot()
+        base_sha = refs.get('origin/master')
+        tips = [
+            sha for name, sha in refs.items() if name.startswith('pr_head/')]
+        start = time.time()
+        if base_sha is not None and tips:
+            backend.drop_history()
+            backend.load_history([base_sha] + tips)
+            backend.count_exclusive_many(base_sha, tips)
+        return time.time() - start
+
+    def maintain(self):
+        """Repack, and write reachability bitmaps and a commit-graph
+
+        Returns timings of comparing all pull requests to master before and
+        after, or None if maintenance of this repo is already running.
+        """
+        backend = self.backend
+        if not backend.maintenance_lock.acquire(False):
+            return None
+
+        try:
+            walk_before = self._time_walk()
+            start = time.time()
+            for cmd in maintenance_commands():
+                self.cmd(cmd)
+            duration = time.time() - start
+            walk_after = self._time_walk()
+        finally:
+            backend.maintenance_lock.release()
+
+        stats = {
+            'finished': time.time(),
+            'duration': duration,
+            'walk_before': walk_before,
+            'walk_after': walk_after,
+        }
+        backend.maintenance_stats = stats
+        _log.info(
+            'maintenance of %s took %.2fs. comparing pull requests took '
+            '%.3fs before and %.3fs after', self.path, duration, walk_before,
+            walk_after)
+        return stats
+
     def _pull_request_ref(self, pull_request_number):
         return 'pr_head/{}'.format(pull_request_number)
 
     def _pull_request_merge_ref(self, pull_request_number):
         return 'pr_merge/{}'.format(pull_request_number)
 
+    def _compare_both(self, base, branch):
+        """Return tuple (commits only in base, commits only in branch)"""
+        backend = self.backend
+        base_sha = backend.resolve(base)
+        branch_sha = backend.resolve(branch)
+        if base_sha is None or branch_sha is None:
+            return (None, None)
+        backend.load_history([base_sha, branch_sha])
+        return backend.count_exclusive(base_sha, branch_sha)
+
     def compare(self, base, branch):
         """Count number of commits in branch that are not in base"""
-        branches = '{}..{}'
-        branch_arg = branches.format(base, branch)
-        cmd = ['rev-list',  '--count', branch_arg]
-        output = self.cmd(cmd)
-        if output is None:
-            return None
-        return int(output)
+        _, ahead = self._compare_both(base, branch)
+        return ahead
+
+    def compare_pr(self, pull_request_number, refs=None):
+        """Return tuple (behind, ahead) comparing pull request to master
+
+        Refs are looked up in `refs` (a `RefSnapshot`), defaulting to the
+        current snapshot. Like `compare_prs`, history is loaded up front, and
+        counts are derived from earlier ones where master fast forwarded.
+        """
+        counts = self.compare_prs([pull_request_number], refs=refs)
+        return counts[pull_request_number]
+
+    def compare_prs(self, pull_request_numbers, refs=None):
+        """Return a dict mapping each pull request number to a tuple
+        (behind, ahead) comparing it to master
+
+        All pull requests are compared in a single history walk. Unknown
+        pull requests map to (None, None).
+        """
+        backend = self.backend
+        if refs is None:
+            refs = self.ref_snapshot()
+        results = {
+            number: (None, None) for number in pull_request_numbers}
+
+        base_sha = refs.get('origin/master')
+        if base_sha is None:
+            return results
+
+        pr_shas = {}
+        for number in pull_request_numbers:
+            sha = refs.get(self._pull_request_ref(number))
+            if sha is not None:
+                pr_shas[number] = sha
+        if not pr_shas:
+            return results
+
+        counts = self._update_master_counts(base_sha, set(pr_shas.values()))
+        for number, sha in pr_shas.items():
+            results[number] = counts[sha]
+        return results
 
-    def compare_pr(self, pull_request_number):
-        """Return tuple (behind, ahead) comparing pull request to master"""
+    def _update_master_counts(self, base_sha, tips):
+        """Return a dict mapping each of `tips` to (behind, ahead) relative
+        to `base_sha`
 
-        pr_ref = self._pull_request_ref(pull_request_number)
-        base = 'origin/master'
+        If master has fast forwarded since tips were last counted, their
+        counts are derived from the previous ones by walking only the new
+        commits on master. Anything else is counted from scratch.
+        """
+        backend = self.backend
+        master_counts = backend.master_counts
+        counts = {}
+
+        # tips last counted against the same master are derived together
+        by_master = {}
+        for tip in tips:
+            if tip in master_counts:
+                previous_master, _ = master_counts[tip]
+                by_master.setdefault(previous_master, []).append(tip)
+
+        for previous_master, known in by_master.items():
+            if previous_master == base_sha:
+                counts.update((tip, master_counts[tip][1]) for tip in known)
+                continue
+            try:
+                result = backend.count_new_many(
+                    previous_master, base_sha, known)
+            except GitError:
+                # e.g. the previous master was force pushed away
+                result = None
+            if result is None:
+                continue
+            new_count, not_in_tips = result
+            for tip, not_in_tip in zip(known, not_in_tips):
+                _, (behind, ahead) = master_counts[tip]
+                counts[tip] = (
+                    behind + not_in_tip,
+                    ahead - (new_count - not_in_tip),
+                )
 
-        behind = self.compare(pr_ref, base)
-        ahead = self.compare(base, pr_ref)
+        remaining = [tip for tip in tips if tip not in counts]
+        if remaining:
+            backend.load_history([base_sha] + remaining)
+            counts.update(zip(
+                remaining,
+                backend.count_exclusive_many(base_sha, remaining),
+            ))
 
-        return (behind, ahead)
+        if len(master_counts) + len(counts) > MAX_MASTER_COUNTS:
+            # forget tips of pull requests that have moved on or closed
+            for tip, (master, _) in list(master_counts.items()):
+                if master != base_sha:
+                    del master_counts[tip]
+        for tip, tip_counts in counts.items():
+            master_counts[tip] = (base_sha, tip_counts)
+        return counts
 
-    def is_mergeable(self, pull_request_number):
+    def is_mergeable(self, pull_request_number, refs=None):
         """Return True if the pull request can merge cleanly into master.
 
         We check mergability by asking for an in-memory 3-way merge between
         the merge base (branch point), master and the pull request head. We
         then look for conflict notifications in the output.
 
+        Results are cached by the shas of all three commits. If master has
+        moved since a merge that conflicted, and the new master commits
+        don't touch any of the conflicting paths, the merge will still
+        conflict and we can skip it.
+
+        Returns None if the pull request is unknown.
+        """
+        backend = self.backend
+        if refs is None:
+            refs = self.ref_snapshot()
+
+        pr_sha = refs.get(self._pull_request_ref(pull_request_number))
+        master_sha = refs.get('origin/master')
+        if pr_sha is None or master_sha is None:
+            return None
+
+        merge_base = self.cmd(['merge-base', pr_sha, master_sha])
+        cache = backend.merge_cache
+
+        cached = cache.get(merge_base, pr_sha, master_sha)
+        if cached is not None:
+            mergeable, _ = cached
+            return mergeable
+
+        previous = cache.find_previous(merge_base, pr_sha)
+        if previous is not None:
+            previous_master, mergeable, conflicts = previous
+            if not mergeable:
+                changed = self.changed_paths(previous_master, master_sha)
+                if changed is not None and not changed.intersection(
+                        conflicts):
+                    cache.set(
+                        merge_base, pr_sha, master_sha, mergeable, conflicts)
+                    return mergeable
+
+        conflicts = self.merge_conflicts(merge_base, pr_sha, master_sha)
+        mergeable = not conflicts
+        cache.set(merge_base, pr_sha, master_sha, mergeable, conflicts)
+        return mergeable
+
+    def merge_conflicts(self, merge_base, head, master):
+        """Return the set of paths that conflict when merging head and master
+
+        Uses ``merge-tree --write-tree`` if enabled by the
+        ``MERGE_TREE_WRITE_TREE`` config key and supported by the installed
+        git, and otherwise streams the output of the older ``merge-tree``
+        """
+        if (config_flag('MERGE_TREE_WRITE_TREE') and
+                git_version() >= WRITE_TREE_MIN_VERSION):
+            return self._write_tree_conflicts(head, master)
+        return self._merge_tree_conflicts(merge_base, head, master)
+
+    def _merge_tree_conflicts(self, merge_base, head, master):
+        """Stream ``merge-tree`` output, stopping at the first conflict
+
         When file contents is listed in the merge result, it has a single
         character gutter (+/- for changes, or space for lines included for
         context. Thus we are safe to compare whole lines to our sentinel
-        ``changed in both``.
+        ``changed in both``. The sentinel is followed by a line per version
+        of the file (``base``, ``our``, ``their``), each ending with the
+        path.
+
+        Only the first conflicting path is returned. The output (which
+        includes the full diff) is never held in memory. Raises
+        `GitProcessError` if ``merge-tree`` fails (e.g. on a missing
+        object), rather than report a clean merge.
         """
+        git_dir = '--git-dir={}'.format(self.path)
+        process = subprocess.Popen(
+            ['git', git_dir, 'merge-tree', merge_base, head, master],
+            stdout=subprocess.PIPE,
+        )
+        sentinel = 'changed in both'
+        conflicts = set()
+        in_conflict = False
+        # whether all output was read, rather than stopping early
+        finished = False
+        try:
+            for line in iter(process.stdout.readline, ''):
+                line = line.rstrip('\n')
+                if line == sentinel:
+                    in_conflict = True
+                elif in_conflict and line.startswith('  '):
+                    _, _, _, path = line.split(None, 3)
+                    conflicts.add(path)
+                elif in_conflict:
+                    break
+            else:
+                finished = True
+        finally:
+            if not finished and process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            process.wait()
 
-        pr_ref = self._pull_request_ref(pull_request_number)
-        base = 'origin/master'
+        if finished and process.returncode:
+            raise GitProcessError(
+                'merge-tree failed with status {}'.format(process.returncode))
+        return conflicts
 
-        merge_base = self.cmd(['merge-base', pr_ref, base])
-        merge_result = self.cmd(['merge-tree', merge_base, pr_ref, base])
-        sentinel = 'changed in both'
-        for line in merge_result.splitlines():
-            if line == sentinel:
-                return False
-        return True
-
-    def merge_head(self, pull_request_number):
-        pr_merge_ref = self._pull_request_merge_ref(pull_request_number)
-        sha = self.cmd(['rev-parse', pr_merge_ref])
-        return sha
+    def _write_tree_conflicts(self, head, master):
+        """Use ``merge-tree --write-tree`` (git 2.38+), which only lists the
+        conflicting paths
+
+        This writes the merged tree objects to the repo.
+        """
+        try:
+            self.cmd([
+                'merge-tree', '--write-tree', '--name-only', '--no-messages',
+                head, master,
+            ], bubble_errors=True)
+        except subprocess.CalledProcessError as ex:
+            # conflicts exit with status 1, listing the tree sha followed by
+            # the conflicting paths
+            if ex.returncode != 1:
+                raise
+            return set(ex.output.splitlines()[1:])
+        return set()
+
+    def changed_paths(self, old, new):
+        """Return the set of paths that differ between two commits"""
+        output = self.cmd(['diff', '--name-only', '--no-renames', old, new])
+        if output is None:
+            return None
+        return set(output.splitlines())
+
+    def merge_head(self, pull_request_number, refs=None):
+        if refs is None:
+            refs = self.ref_snapshot()
+        return refs.get(self._pull_request_merge_ref(pull_request_number))
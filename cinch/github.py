@@ -6,6 +6,7 @@ from flask import request
 from sqlalchemy.orm.exc import NoResultFound
 
 from cinch import app, db
+from cinch.cache import OPEN_PULL_REQUESTS, bump_version
 from cinch.models import Project, PullRequest
 from cinch.check import check, CheckStatus
 from cinch.worker import MasterMoved, PullRequestMoved, dispatcher
@@ -14,11 +15,16 @@ logger = logging.getLogger(__name__)
 
 MASTER_REF = 'refs/heads/master'
 PULL_REQUEST_OPEN_STATE = 'open'
+# `before` sha of pushes creating a branch
+NULL_SHA = '0' * 40
+# github may truncate the list of commits in push payloads
+MAX_PUSH_COMMITS = 20
 
 RepoInfo = namedtuple('RepoInfo', ['owner', 'name'])
 PullRequestInfo = namedtuple(
     'PullRequestInfo',
     ['number', 'title', 'head', 'user', 'state', 'base_ref'])
+PushInfo = namedtuple('PushInfo', ['before', 'after', 'forced', 'commits'])
 
 
 class HookEvents(object):
@@ -91,6 +97,20 @@ class GithubHookParser(object):
             base_ref=base_ref,
         )
 
+    def get_push_info(self):
+        """Return PushInfo namedtuple (before, after, forced, commits), or
+        None if this is not a push event
+        """
+        if self.event_type != HookEvents.PUSH:
+            return None
+
+        return PushInfo(
+            before=self.data.get('before'),
+            after=self.data.get('after'),
+            forced=self.data.get('forced', False),
+            commits=[commit['id'] for commit in self.data.get('commits', [])],
+        )
+
     def is_ping(self):
         return self.event_type == HookEvents.PING
 
@@ -141,6 +161,17 @@ def handle_github_webhook():
         return Responses.UNKNOWN_ACTION
 
 
+def is_fast_forward(push_info):
+    """Return True if we know the push only added the commits listed"""
+    return (
+        push_info.before is not None and
+        push_info.after is not None and
+        push_info.before != NULL_SHA and
+        not push_info.forced and
+        len(push_info.commits) < MAX_PUSH_COMMITS
+    )
+
+
 def handle_push(parser):
     repo_info = parser.get_repo_info()
     project = get_project_from_repo_info(repo_info)
@@ -153,12 +184,25 @@ def handle_push(parser):
             PullRequest.is_open,
         )
 
+    push_info = parser.get_push_info()
+    new_commits = None
+    if is_fast_forward(push_info):
+        new_commits = set(push_info.commits)
+
     for pr in pull_requests:
-        pr.behind_master = None
-        pr.ahead_of_master = None
+        if (new_commits is not None and pr.behind_master is not None and
+                pr.head not in new_commits):
+            # until the worker catches up, assume none of the new commits are
+            # in the pull request, so it's behind by all of them and just as
+            # far ahead
+            pr.behind_master += len(new_commits)
+        else:
+            pr.behind_master = None
+            pr.ahead_of_master = None
         pr.is_mergeable = None
         pr.merge_head = None
 
+    bump_version(OPEN_PULL_REQUESTS)
     db.session.commit()
 
     with dispatcher() as dispatch:
@@ -201,6 +245,7 @@ def handle_pull_request(parser):
     pr.is_open = (pr_info.state == PULL_REQUEST_OPEN_STATE)
     pr.head = pr_info.head
     pr.merge_head = None
+    bump_version(OPEN_PULL_REQUESTS)
     db.session.commit()
 
     with dispatcher() as dispatch:
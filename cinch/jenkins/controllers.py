@@ -1,17 +1,21 @@
 from __future__ import absolute_import
 
 from collections import OrderedDict, namedtuple
+import hashlib
 
 from flask import url_for, g
 from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload, aliased
 from sqlalchemy.orm.exc import NoResultFound
 
+from cinch.cache import OPEN_PULL_REQUESTS, VersionedCache, bump_version
 from cinch.check import check, CheckStatus
 from cinch.controllers import get_project
-from cinch.models import db, PullRequest
+from cinch.models import db, PullRequest, YIELD_PER
+from cinch.sha_index import find_open_pull_requests
 from cinch.worker import dispatcher, PullRequestStatusUpdated
-from .models import Job, Build, BuildSha
+from .models import Job, Build, BuildSha, JobShaStatus
 from .exceptions import UnknownJob
 
 
@@ -38,12 +42,194 @@ def g_cache(func):
             cache[key] = func(*args)
         return cache[key]
 
+    def peek(*args):
+        """Return the cached result, or None if not computed during this
+        request
+        """
+        return getattr(g, '_cache', {}).get((func, tuple(args)))
+
+    wrapped.peek = peek
     return wrapped
 
 
 def clear_g_cache():
-    """Test helper to clear the `g_cache`"""
+    """Test helper to clear the `g_cache`, and the process level cache of
+    `all_open_prs`
+    """
     getattr(g, '_cache', {}).clear()
+    open_prs_cache.clear()
+
+
+def sha_signature(shas):
+    """Return a canonical signature for a combination of shas, given as a
+    dict mapping project ids to shas, or None if any sha is missing
+    """
+    if any(sha is None for sha in shas.values()):
+        return None
+    canonical = ','.join(
+        '{}:{}'.format(project_id, sha)
+        for project_id, sha in sorted(shas.items())
+    )
+    return hashlib.sha1(canonical).hexdigest()
+
+
+def build_rank(build_number, success):
+    """Successful builds of the same shas are better than others, then
+    later ones
+    """
+    return (success is True, build_number)
+
+
+def get_build_shas(build):
+    """Return a dict mapping the ids of the projects of the build's job to
+    the shas of this build, or None if not all have been recorded yet
+    """
+    project_ids = [project.id for project in build.job.projects]
+    build_shas = dict(db.session.query(
+        BuildSha.project_id, BuildSha.sha
+    ).filter(
+        BuildSha.build_id == build.id,
+    ).all())
+
+    shas = {
+        project_id: build_shas.get(project_id)
+        for project_id in project_ids
+    }
+    if any(sha is None for sha in shas.values()):
+        return None
+    return shas
+
+
+def add_job_sha_status(job_id, signature, build_number, success):
+    """Add a `JobShaStatus`, in a savepoint
+
+    Returns None instead if one was added concurrently, e.g. for another
+    build of the same job and shas, which the caller should then re-read.
+    """
+    status = JobShaStatus(
+        job_id=job_id,
+        signature=signature,
+        build_number=build_number,
+        success=success,
+    )
+    try:
+        with db.session.begin_nested():
+            db.session.add(status)
+    except IntegrityError:
+        return None
+    return status
+
+
+def get_job_sha_status_for_update(job_id, signature):
+    """Read a `JobShaStatus`, locking its row until the transaction ends,
+    so that concurrent updates for the same shas don't overwrite each other
+    """
+    return db.session.query(JobShaStatus).with_for_update().get(
+        (job_id, signature))
+
+
+def rebuild_job_sha_status(job_id, shas):
+    """Recompute the `JobShaStatus` of a job for one combination of shas
+    from the job's builds
+
+    Does not commit.
+    """
+    query, _ = get_job_build_query(job_id, shas.keys(), {
+        project_id: [sha] for project_id, sha in shas.items()
+    })
+    best = None
+    for build_number, success in query.values(
+            Build.build_number, Build.success):
+        rank = build_rank(build_number, success)
+        if best is None or rank > best[0]:
+            best = (rank, build_number, success)
+
+    signature = sha_signature(shas)
+    status = get_job_sha_status_for_update(job_id, signature)
+    if best is None:
+        if status is not None:
+            db.session.delete(status)
+        return
+
+    best_rank, build_number, success = best
+    if status is None:
+        if add_job_sha_status(job_id, signature, build_number, success):
+            return
+        status = get_job_sha_status_for_update(job_id, signature)
+        # the concurrently added build is as valid as those we found
+        if best_rank < build_rank(status.build_number, status.success):
+            return
+    status.build_number = build_number
+    status.success = success
+
+
+def update_job_sha_status(build, previous_shas=None):
+    """Update the `JobShaStatus` for the shas of `build`, after it changed
+
+    `previous_shas` are those of the build before the change, if they were
+    complete and may have changed. Does not commit.
+    """
+    db.session.flush()
+    shas = get_build_shas(build)
+
+    if previous_shas is not None and previous_shas != shas:
+        # this may have been the best build for its old shas
+        rebuild_job_sha_status(build.job_id, previous_shas)
+    if shas is None:
+        return
+
+    signature = sha_signature(shas)
+    status = get_job_sha_status_for_update(build.job_id, signature)
+    rank = build_rank(build.build_number, build.success)
+    if status is None:
+        if add_job_sha_status(
+                build.job_id, signature, build.build_number, build.success):
+            return
+        status = get_job_sha_status_for_update(
+            build.job_id, signature)
+
+    current_rank = build_rank(status.build_number, status.success)
+    if status.build_number == build.build_number and rank < current_rank:
+        # demoted; another build may be better now
+        rebuild_job_sha_status(build.job_id, shas)
+    elif rank >= current_rank:
+        status.build_number = build.build_number
+        status.success = build.success
+
+
+def rebuild_job_sha_statuses(job_ids=None):
+    """Recompute all `JobShaStatus`es of the given jobs (or all jobs) from
+    their builds, e.g. after changing the projects of a job
+
+    Does not commit.
+    """
+    job_master_shas = get_job_master_shas()
+    if job_ids is None:
+        job_ids = job_master_shas.keys()
+
+    for job_id in job_ids:
+        project_ids = job_master_shas[job_id].keys()
+        db.session.query(JobShaStatus).filter(
+            JobShaStatus.job_id == job_id).delete()
+
+        query, sha_columns = get_job_build_query(job_id, project_ids)
+        best = {}
+        results = query.yield_per(YIELD_PER).values(
+            Build.build_number, Build.success, *sha_columns)
+        for result in results:
+            shas = dict(zip(project_ids, result[2:]))
+            signature = sha_signature(shas)
+            rank = build_rank(result.build_number, result.success)
+            if signature not in best or rank > best[signature][0]:
+                best[signature] = (rank, result)
+
+        for signature, (_, result) in best.items():
+            db.session.add(JobShaStatus(
+                job_id=job_id,
+                signature=signature,
+                build_number=result.build_number,
+                success=result.success,
+            ))
 
 
 def get_or_create_build(job, build_number):
@@ -76,12 +262,19 @@ def get_prs_for_build(build):
 
     build_shas = [build_sha.sha for build_sha in build_shas]
 
+    keys = find_open_pull_requests(build_shas)
+    if not keys:
+        return []
+
     pulls = session.query(PullRequest).filter(
         PullRequest.is_open == True,
-        or_(
-            PullRequest.head.in_(build_shas),
-            PullRequest.merge_head.in_(build_shas)
-        ),
+        or_(*[
+            and_(
+                PullRequest.project_id == project_id,
+                PullRequest.number == number,
+            )
+            for project_id, number in sorted(keys)
+        ]),
     )
 
     return pulls
@@ -122,11 +315,15 @@ def record_job_sha(job_name, build_number, project_owner, project_name, sha):
 
     project = get_project(project_owner, project_name)
 
+    session.flush()
+    previous_shas = get_build_shas(build)
     build_sha = session.query(BuildSha).get((build.id, project.id))
     if build_sha is None:
         build_sha = BuildSha(build=build, project=project)
         session.add(build_sha)
     build_sha.sha = sha
+    update_job_sha_status(build, previous_shas)
+    bump_version(OPEN_PULL_REQUESTS)
     session.commit()
 
     handle_build_updated(build)
@@ -146,17 +343,25 @@ def record_job_result(job_name, build_number, success, status):
 
     build.success = success
     build.status = status
+    update_job_sha_status(build)
+    bump_version(OPEN_PULL_REQUESTS)
     db.session.commit()
 
     handle_build_updated(build)
 
 
-def get_job_master_shas():
+def get_job_master_shas(job_ids=None):
+    """Return a dict mapping the ids of the given jobs (or all jobs) to
+    ordered dicts mapping the ids of their projects to master shas
+    """
+    query = db.session.query(Job).options(joinedload('projects'))
+    if job_ids is not None:
+        if not job_ids:
+            return {}
+        query = query.filter(Job.id.in_(list(job_ids)))
+
     job_master_shas = {}
-    for job in db.session.query(Job).options(joinedload('projects')):
-        # The BuildSha aliases for the related projects are ordered in
-        # `get_job_sha_statuses` below. This order needs to match
-        # the order use to look them up later for each pull_request.
+    for job in query:
         job_master_shas[job.id] = OrderedDict({
             project.id: project.master_sha
             for project in job.projects
@@ -164,13 +369,17 @@ def get_job_master_shas():
     return job_master_shas
 
 
-def get_job_build_query(job_id, project_ids):
+def get_job_build_query(job_id, project_ids, candidate_shas=None):
     """Construct a query, and column aliases for querying sha tuples for builds
     of a given job
 
     :Parameters:
         job_id
         project_ids
+        candidate_shas
+            Optional dict mapping project ids to the shas of interest.
+            Builds with other shas for those projects are filtered out in
+            the database
 
     :Returns:
         query, base_alias, project_sha_columns
@@ -202,73 +411,117 @@ def get_job_build_query(job_id, project_ids):
     sha_columns = [alias.sha for alias in aliases]
     query = query.filter(and_(column != NULL for column in sha_columns))
 
+    if candidate_shas is not None:
+        for project_id, column in zip(project_ids, sha_columns):
+            if project_id in candidate_shas:
+                query = query.filter(
+                    column.in_(list(candidate_shas[project_id])))
+
     return query, sha_columns
 
 
-def get_job_sha_statuses(job_master_shas):
-    # For each job, we construct a query that finds tuples of shas for all
-    # known builds. We can then match those against the required shas for any
-    # given pull_request (the head for the project of the pr, and master for
-    # any related projects). It may be possible to do this in a single query,
-    # for for my sanity we're doing n queries for now. Note that n depends on
-    # the number of _jobs_, not the number of builds or open pull requests.
+def get_job_sha_statuses(job_master_shas, job_signatures=None):
+    """Return a dict mapping the ids of the given jobs to dicts mapping sha
+    signatures (see `sha_signature`) to the `BuildInfo` of the best build
+    of the job with those shas
 
+    Reads the `JobShaStatus`es maintained as builds are recorded, so takes
+    (at most) one query per job, regardless of the number of builds. If
+    `job_signatures` (a dict mapping job ids to collections of signatures)
+    is given, only those signatures are read.
+    """
     job_statuses = {}
-    for job_id, shas in job_master_shas.items():
-        # The subqueries for the related projects are ordered in
-        # `successful_job_shas` below. This order needs to match
-        # the order use to look them up later for each pull_request.
-        query, sha_columns = get_job_build_query(
-            job_id, shas.keys())
-
-        # for each job, successful_job_shas is a dictionary, mapping tuples
-        # of shas (ordered as per the job_sha_map) for successful builds to
-        # the build number in question
-        job_statuses[job_id] = {}
-        results = query.values(Build.build_number, Build.success, *sha_columns)
-        for result in results:
-            shas = result[2:]
-            existing = job_statuses[job_id].get(shas)
-            if existing and existing.status and not result.success:
-                # don't overwrite successes with failures (for same job/sha)
+    for job_id in job_master_shas:
+        query = db.session.query(
+            JobShaStatus.signature,
+            JobShaStatus.build_number,
+            JobShaStatus.success,
+        ).filter(
+            JobShaStatus.job_id == job_id,
+        )
+        if job_signatures is not None:
+            signatures = job_signatures.get(job_id)
+            if not signatures:
+                job_statuses[job_id] = {}
                 continue
-            job_statuses[job_id][shas] = BuildInfo(
-                result.build_number, result.success)
+            query = query.filter(
+                JobShaStatus.signature.in_(list(signatures)))
+
+        job_statuses[job_id] = {
+            signature: BuildInfo(build_number, success)
+            for signature, build_number, success in query
+        }
 
     return job_statuses
 
 
-def get_pr_builds(job_master_shas, job_sha_map):
-    pr_map = {}
-    pull_requests = db.session.query(
+def get_open_pull_requests():
+    return db.session.query(
         PullRequest
         ).filter(
             PullRequest.is_open == True
         ).options(
             joinedload('project')
     )
+
+
+def get_pr_signatures(pull_requests, job_master_shas):
+    """Return a dict mapping each pull request to a dict mapping the ids of
+    the jobs of its project to the sha signatures of its (head, merge_head)
+    """
+    pr_signatures = {}
     for pr in pull_requests:
         project = pr.project
-        pr_job_map = {}
+        job_signatures = {}
 
         for job in project.jobs:
             # Take a copy of the master shas dict, and replace the shas for
-            # this pull request's project by the pull request head. we check
-            # for both the head and the merge_head, accepting preferring
-            # results from the merge head.
+            # this pull request's project by the pull request head (or merge
+            # head)
             job_id = job.id
             head_sha_dict = job_master_shas[job_id].copy()
             head_sha_dict[project.id] = pr.head
-            head_shas = tuple(head_sha_dict.values())
             merge_head_sha_dict = job_master_shas[job_id].copy()
             merge_head_sha_dict[project.id] = pr.merge_head
-            merge_head_shas = tuple(merge_head_sha_dict.values())
 
+            job_signatures[job_id] = (
+                sha_signature(head_sha_dict),
+                sha_signature(merge_head_sha_dict),
+            )
+
+        pr_signatures[pr] = job_signatures
+
+    return pr_signatures
+
+
+def get_candidate_signatures(pr_signatures):
+    """Return a dict mapping job ids to the set of sha signatures that may
+    match any of `pr_signatures` (see `get_pr_signatures`)
+    """
+    job_signatures = {}
+    for signatures in pr_signatures.values():
+        for job_id, (head, merge_head) in signatures.items():
+            candidates = job_signatures.setdefault(job_id, set())
+            candidates.update(
+                signature for signature in (head, merge_head)
+                if signature is not None
+            )
+    return job_signatures
+
+
+def get_pr_builds(pr_signatures, job_sha_map):
+    pr_map = {}
+    for pr, signatures in pr_signatures.items():
+        pr_job_map = {}
+
+        for job_id, (head, merge_head) in signatures.items():
+            # we check for both the head and the merge_head, accepting
+            # preferring results from the merge head.
             job_shas = job_sha_map[job_id]
             missing = (None, None)
-            head_build_number, head_status = job_shas.get(head_shas, missing)
+            head_build_number, head_status = job_shas.get(head, missing)
             merge_head_build_number, merge_head_status = job_shas.get(
-                merge_head_shas, missing)
+                merge_head, missing)
 
             # let results for merge head overwrite results for head. fall back
             # to head (which may be None)
@@ -281,24 +534,73 @@ def get_pr_builds(job_master_shas, job_sha_map):
 
             pr_job_map[job_id] = BuildInfo(build_number, status)
 
-        pr_map[pr] = pr_job_map
+        pr_map[(pr.number, pr.project_id)] = pr_job_map
 
     return pr_map
 
 
+def compute_pr_builds(pull_requests, job_master_shas):
+    pr_signatures = get_pr_signatures(pull_requests, job_master_shas)
+    # only read statuses that can match one of the pull requests
+    job_shas = get_job_sha_statuses(
+        job_master_shas, get_candidate_signatures(pr_signatures))
+
+    return get_pr_builds(pr_signatures, job_shas)
+
+
+def compute_open_prs():
+    return compute_pr_builds(get_open_pull_requests(), get_job_master_shas())
+
+
+def get_pull_request_builds(pull_requests):
+    """Return a dict like `all_open_prs`, for the given pull requests only
+    (open or not)
+
+    Only reads the jobs of the pull requests' projects, and the statuses
+    that can match the pull requests' shas.
+    """
+    job_ids = {
+        job.id
+        for pull_request in pull_requests
+        for job in pull_request.project.jobs
+    }
+    return compute_pr_builds(pull_requests, get_job_master_shas(job_ids))
+
+
+def pull_request_builds(pull_request):
+    """Return a dict mapping the ids of the jobs of the pull request's
+    project to the `BuildInfo` of its best build
+
+    Uses the statuses of all open pull requests if they have already been
+    read during this request (e.g. for the dashboard).
+    """
+    key = (pull_request.number, pull_request.project_id)
+    pr_map = all_open_prs.peek()
+    if pr_map is not None and key in pr_map:
+        return pr_map[key]
+    return get_pull_request_builds([pull_request])[key]
+
+
+open_prs_cache = VersionedCache(OPEN_PULL_REQUESTS, compute_open_prs)
+
+
 @g_cache
 def all_open_prs():
-    job_master_shas = get_job_master_shas()
-    job_shas = get_job_sha_statuses(job_master_shas)
+    """Return a dict mapping the (number, project id) of each open pull
+    request to a dict mapping the ids of the jobs of its project to the
+    `BuildInfo` of its best build
 
-    return get_pr_builds(job_master_shas, job_shas)
+    Shared between requests (and threads) until anything it depends on
+    changes, so must not be modified.
+    """
+    return open_prs_cache.get()
 
 
 @check
 def jenkins_check(pull_request):
-    pr_map = all_open_prs()
+    pr_builds = pull_request_builds(pull_request)
 
-    job_ids = pr_map[pull_request].keys()
+    job_ids = pr_builds.keys()
     if job_ids:
         jobs = db.session.query(Job).filter(Job.id.in_(job_ids))
     else:
@@ -312,7 +614,7 @@ def jenkins_check(pull_request):
     )
 
     def get_status(job):
-        build_number, status = pr_map[pull_request][job.id]
+        build_number, status = pr_builds[job.id]
         if build_number is None:
             return None
         return status
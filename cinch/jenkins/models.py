@@ -51,3 +51,18 @@ class BuildSha(db.Model):
 
     build = db.relationship(Build)
     project = db.relationship(Project)
+
+
+class JobShaStatus(db.Model):
+    """The best build of a job for each combination of shas of the job's
+    projects (see `cinch.jenkins.controllers.sha_signature`)
+
+    Successful builds are best, then the latest. Kept up to date by
+    `record_job_sha` and `record_job_result`.
+    """
+    __tablename__ = "job_sha_statuses"
+
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'), primary_key=True)
+    signature = db.Column(db.String(40), primary_key=True)
+    build_number = db.Column(db.Integer, nullable=False)
+    success = db.Column(db.Boolean, nullable=True)
@@ -10,7 +10,8 @@ from cinch import app, db
 from cinch.auth.decorators import requires_auth
 from cinch.exceptions import UnknownProject
 from cinch.models import PullRequest, Project
-from .controllers import record_job_result, record_job_sha, all_open_prs
+from .controllers import (
+    record_job_result, record_job_sha, pull_request_builds)
 from .exceptions import UnknownJob
 from .models import Job, JobProject
 
@@ -113,14 +114,14 @@ def pull_request_status(project_owner, project_name, pr_number):
 
     pull_request_project = pull_request.project
 
-    pr_map = all_open_prs()
+    pr_builds = pull_request_builds(pull_request)
     jobs = pull_request_project.jobs
 
     job_statuses = []
     jenkins_url = get_jenkins_url()
 
     for job in sorted(jobs, key=lambda j: j.name):
-        build_number, status = pr_map[pull_request][job.id]
+        build_number, status = pr_builds[job.id]
 
         if build_number is None:
             status = None
@@ -3,6 +3,9 @@ from cinch import db
 
 STRING_LENGTH = 200
 
+# rows loaded at a time when scanning tables
+YIELD_PER = 100
+
 
 class Project(db.Model):
     __tablename__ = "projects"
@@ -43,6 +46,64 @@ class PullRequest(db.Model):
     project = db.relationship('Project', backref='pull_requests')
 
 
+class PullRequestSha(db.Model):
+    """The head and merge head of each open pull request, to look pull
+    requests up by sha (see `cinch.sha_index`)
+    """
+    __tablename__ = "pull_request_shas"
+
+    sha = db.Column(db.String(40), primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'),
+                           primary_key=True, autoincrement=False)
+    number = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+
+class PullRequestShaChange(db.Model):
+    """A log of the pull requests whose shas changed, in order, so that
+    in-memory indexes can apply changes made by other processes (see
+    `cinch.sha_index`)
+
+    Only the latest entries are kept.
+    """
+    __tablename__ = "pull_request_sha_changes"
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, nullable=False)
+    number = db.Column(db.Integer, nullable=False)
+
+
+class MasterRecompute(db.Model):
+    """Progress of the latest recompute of a project's pull requests after
+    its master moved
+
+    The pull requests are split between tasks, which may be handled by
+    different workers. Each new recompute of a project bumps `generation`,
+    superseding tasks of earlier ones.
+    """
+    __tablename__ = "master_recomputes"
+
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'),
+                           primary_key=True, autoincrement=False)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+    master_sha = db.Column(db.String(40), nullable=True)
+    # number of tasks not yet done
+    pending = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    project = db.relationship('Project')
+
+
+class CacheVersion(db.Model):
+    """The current version of the data behind caches of this name (see
+    `cinch.cache`). Changed whenever the data is
+    """
+    __tablename__ = "cache_versions"
+
+    name = db.Column(db.String(STRING_LENGTH), primary_key=True)
+    version = db.Column(db.String(32), nullable=False)
+
+
 """
 class CodeReview():
     commit_sha
@@ -7,11 +7,13 @@ eventlet.monkey_patch()
 
 from nameko.runners import ServiceRunner
 
-from cinch.worker import get_nameko_config, RepoWorker
+from cinch.worker import get_nameko_config, git_pool, RepoWorker
 
 
 def run_worker():
     config = get_nameko_config()
+    # fork before any connections are opened
+    git_pool.start()
 
     service_runner = ServiceRunner(config)
     service_runner.add_service(RepoWorker)
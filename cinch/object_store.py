@@ -0,0 +1,527 @@
+"""Read git objects and refs directly from a repository's files
+
+Supports loose objects, version 2 pack indexes, deltified pack entries,
+alternates (e.g. shared object stores), loose refs and ``packed-refs``.
+This is enough to read commits and resolve refs without starting git.
+Commit graph files are read for the parents and generation numbers of the
+commits they cover.
+"""
+
+import binascii
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+
+OBJECT_TYPES = {
+    1: 'commit',
+    2: 'tree',
+    3: 'blob',
+    4: 'tag',
+}
+OFS_DELTA = 6
+REF_DELTA = 7
+
+PACK_INDEX_SIGNATURE = b'\377tOc'
+PACK_INDEX_VERSION = 2
+
+COMMIT_GRAPH_SIGNATURE = b'CGPH'
+COMMIT_GRAPH_VERSION = 1
+COMMIT_GRAPH_HASH_VERSION = 1  # sha1
+# parent positions of commit graph entries
+GRAPH_PARENT_NONE = 0x70000000
+# set on the second parent of octopus merges, whose parents (after the
+# first) are listed in the extra edges chunk, and on the last of those
+GRAPH_EXTRA_EDGES = 0x80000000
+
+# amount of compressed data read from a pack at a time
+INFLATE_CHUNK_SIZE = 16 * 1024
+
+SHA_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
+# the order git tries when looking up an abbreviated ref name
+REF_LOOKUP_PATTERNS = [
+    '{}',
+    'refs/{}',
+    'refs/tags/{}',
+    'refs/heads/{}',
+    'refs/remotes/{}',
+    'refs/remotes/{}/HEAD',
+]
+SYMBOLIC_REF_PREFIX = 'ref: '
+# max number of symbolic refs followed (as per git)
+MAX_SYMBOLIC_REF_DEPTH = 5
+
+
+class ObjectStoreError(Exception):
+    pass
+
+
+def _map_file(filename):
+    with open(filename, 'rb') as handle:
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _find_sha(data, fanout, shas_start, binsha):
+    """Return the position of `binsha` in a sorted table of binary shas
+    with a fanout table (as in pack indexes), or None if not present
+    """
+    first = ord(binsha[:1])
+    low = fanout[first - 1] if first else 0
+    high = fanout[first]
+    while low < high:
+        middle = (low + high) // 2
+        start = shas_start + 20 * middle
+        current = data[start:start + 20]
+        if current < binsha:
+            low = middle + 1
+        elif current > binsha:
+            high = middle
+        else:
+            return middle
+    return None
+
+
+def apply_delta(base, delta):
+    """Apply a git delta to `base`, returning the target object data"""
+    delta = bytearray(delta)
+    pos = 0
+
+    def read_size(pos):
+        size = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return size, pos
+
+    base_size, pos = read_size(pos)
+    target_size, pos = read_size(pos)
+    if base_size != len(base):
+        raise ObjectStoreError('delta base size mismatch')
+
+    result = []
+    while pos < len(delta):
+        opcode = delta[pos]
+        pos += 1
+        if opcode & 0x80:
+            # copy from base
+            offset = size = 0
+            for i in range(4):
+                if opcode & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if opcode & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            result.append(bytes(base[offset:offset + size]))
+        elif opcode:
+            # insert new data
+            result.append(bytes(delta[pos:pos + opcode]))
+            pos += opcode
+        else:
+            raise ObjectStoreError('invalid delta opcode')
+
+    target = b''.join(result)
+    if len(target) != target_size:
+        raise ObjectStoreError('delta target size mismatch')
+    return target
+
+
+class PackIndex(object):
+    """A version 2 ``.idx`` file, mapping object shas to pack offsets"""
+
+    def __init__(self, filename):
+        self._map = _map_file(filename)
+        signature = self._map[:4]
+        version, = struct.unpack('>I', self._map[4:8])
+        if (signature != PACK_INDEX_SIGNATURE or
+                version != PACK_INDEX_VERSION):
+            raise ObjectStoreError(
+                'unsupported pack index {}'.format(filename))
+
+        self._fanout = struct.unpack('>256I', self._map[8:8 + 256 * 4])
+        self.count = self._fanout[255]
+        self._shas_start = 8 + 256 * 4
+        # shas are followed by crc32s, then offsets
+        self._offsets_start = self._shas_start + 24 * self.count
+        self._large_offsets_start = self._offsets_start + 4 * self.count
+
+    def close(self):
+        self._map.close()
+
+    def find(self, binsha):
+        """Return the pack offset of the object, or None if not present"""
+        position = _find_sha(
+            self._map, self._fanout, self._shas_start, binsha)
+        if position is None:
+            return None
+        return self._offset(position)
+
+    def _offset(self, position):
+        start = self._offsets_start + 4 * position
+        offset, = struct.unpack('>I', self._map[start:start + 4])
+        if offset & 0x80000000:
+            start = self._large_offsets_start + 8 * (offset & 0x7fffffff)
+            offset, = struct.unpack('>Q', self._map[start:start + 8])
+        return offset
+
+
+class Pack(object):
+    """A ``.pack`` file and its index"""
+
+    def __init__(self, pack_filename, index_filename):
+        self.index = PackIndex(index_filename)
+        self._map = _map_file(pack_filename)
+
+    def close(self):
+        self.index.close()
+        self._map.close()
+
+    def _read_header(self, offset):
+        data = bytearray(self._map[offset:offset + 32])
+        pos = 0
+        byte = data[pos]
+        pos += 1
+        type_number = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            byte = data[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+
+        base = None
+        if type_number == OFS_DELTA:
+            byte = data[pos]
+            pos += 1
+            base_distance = byte & 0x7f
+            while byte & 0x80:
+                byte = data[pos]
+                pos += 1
+                base_distance = ((base_distance + 1) << 7) | (byte & 0x7f)
+            base = offset - base_distance
+        elif type_number == REF_DELTA:
+            base = bytes(data[pos:pos + 20])
+            pos += 20
+
+        return type_number, size, base, offset + pos
+
+    def _inflate(self, offset, size):
+        decompressor = zlib.decompressobj()
+        chunks = []
+        end = len(self._map)
+        while offset < end:
+            chunk = self._map[offset:offset + INFLATE_CHUNK_SIZE]
+            offset += INFLATE_CHUNK_SIZE
+            chunks.append(decompressor.decompress(chunk))
+            if decompressor.unused_data:
+                break
+        chunks.append(decompressor.flush())
+        data = b''.join(chunks)
+        if len(data) != size:
+            raise ObjectStoreError('object size mismatch')
+        return data
+
+    def read(self, offset, store):
+        """Return (type, data) for the object at `offset`
+
+        Delta chains are resolved iteratively; `store` is used to look up
+        bases of ref deltas.
+        """
+        deltas = []
+        while True:
+            type_number, size, base, data_offset = self._read_header(offset)
+            if type_number in OBJECT_TYPES:
+                object_type = OBJECT_TYPES[type_number]
+                data = self._inflate(data_offset, size)
+                break
+
+            deltas.append(self._inflate(data_offset, size))
+            if type_number == OFS_DELTA:
+                offset = base
+            elif type_number == REF_DELTA:
+                base_offset = self.index.find(base)
+                if base_offset is not None:
+                    offset = base_offset
+                else:
+                    result = store.read(binascii.hexlify(base))
+                    if result is None:
+                        raise ObjectStoreError('missing delta base')
+                    object_type, data = result
+                    break
+            else:
+                raise ObjectStoreError(
+                    'unknown object type {}'.format(type_number))
+
+        for delta in reversed(deltas):
+            data = apply_delta(data, delta)
+        return object_type, data
+
+
+class CommitGraph(object):
+    """A ``commit-graph`` file, as written by ``git commit-graph write``
+
+    Only single files are supported, not split commit graph chains.
+    """
+
+    def __init__(self, filename):
+        self._map = _map_file(filename)
+        signature = self._map[:4]
+        version, hash_version, chunk_count, base_count = struct.unpack(
+            '>4B', self._map[4:8])
+        if (signature != COMMIT_GRAPH_SIGNATURE or
+                version != COMMIT_GRAPH_VERSION or
+                hash_version != COMMIT_GRAPH_HASH_VERSION or
+                base_count):
+            raise ObjectStoreError(
+                'unsupported commit graph {}'.format(filename))
+
+        chunks = {}
+        for index in range(chunk_count):
+            start = 8 + 12 * index
+            offset, = struct.unpack('>Q', self._map[start + 4:start + 12])
+            chunks[self._map[start:start + 4]] = offset
+        try:
+            fanout_start = chunks[b'OIDF']
+            self._shas_start = chunks[b'OIDL']
+            self._data_start = chunks[b'CDAT']
+        except KeyError:
+            raise ObjectStoreError(
+                'incomplete commit graph {}'.format(filename))
+        self._edges_start = chunks.get(b'EDGE')
+
+        self._fanout = struct.unpack(
+            '>256I', self._map[fanout_start:fanout_start + 256 * 4])
+        self.count = self._fanout[255]
+
+    def close(self):
+        self._map.close()
+
+    def _sha(self, position):
+        start = self._shas_start + 20 * position
+        return binascii.hexlify(self._map[start:start + 20])
+
+    def _extra_edges(self, edge):
+        while True:
+            start = self._edges_start + 4 * edge
+            value, = struct.unpack('>I', self._map[start:start + 4])
+            yield value & ~GRAPH_EXTRA_EDGES
+            if value & GRAPH_EXTRA_EDGES:
+                return
+            edge += 1
+
+    def read(self, hexsha):
+        """Return (parents, generation) for a commit, or None if the graph
+        doesn't cover it
+
+        The generation is the length of the longest path from the commit
+        to a root commit (its topological level).
+        """
+        position = _find_sha(
+            self._map, self._fanout, self._shas_start,
+            binascii.unhexlify(hexsha))
+        if position is None:
+            return None
+
+        # after the tree sha
+        start = self._data_start + 36 * position + 20
+        first, second, generation = struct.unpack(
+            '>3I', self._map[start:start + 12])
+        # the top 30 bits; the rest are part of the commit time
+        generation >>= 2
+        if not generation:
+            return None  # written without generation numbers
+
+        positions = []
+        if first != GRAPH_PARENT_NONE:
+            positions.append(first)
+        if second & GRAPH_EXTRA_EDGES:
+            positions.extend(
+                self._extra_edges(second & ~GRAPH_EXTRA_EDGES))
+        elif second != GRAPH_PARENT_NONE:
+            positions.append(second)
+
+        return tuple(self._sha(p) for p in positions), generation
+
+
+class ObjectStore(object):
+    """Reads objects from the object directories of a repo (its own, and
+    any alternates)
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self._objects_dirs = None
+        self._packs = {}
+        self._lock = threading.Lock()
+
+    @property
+    def objects_dirs(self):
+        if self._objects_dirs is None:
+            objects_dir = os.path.join(self.git_dir, 'objects')
+            objects_dirs = [objects_dir]
+            alternates = os.path.join(objects_dir, 'info', 'alternates')
+            if os.path.exists(alternates):
+                with open(alternates) as handle:
+                    for line in handle:
+                        line = line.strip()
+                        if line and not line.startswith('#'):
+                            objects_dirs.append(
+                                os.path.join(objects_dir, line))
+            self._objects_dirs = objects_dirs
+        return self._objects_dirs
+
+    def close(self):
+        with self._lock:
+            for pack in self._packs.values():
+                pack.close()
+            self._packs.clear()
+
+    def scan_packs(self):
+        """Pick up new packs (e.g. after a fetch) and drop deleted ones"""
+        found = set()
+        for objects_dir in self.objects_dirs:
+            pack_dir = os.path.join(objects_dir, 'pack')
+            try:
+                filenames = os.listdir(pack_dir)
+            except OSError:
+                continue
+            for filename in filenames:
+                if not filename.endswith('.idx'):
+                    continue
+                index_filename = os.path.join(pack_dir, filename)
+                pack_filename = index_filename[:-len('.idx')] + '.pack'
+                if os.path.exists(pack_filename):
+                    found.add((pack_filename, index_filename))
+
+        with self._lock:
+            # not closed, as other threads may be reading them; their maps
+            # are closed once no reader holds them
+            for key in set(self._packs) - found:
+                del self._packs[key]
+            for key in found - set(self._packs):
+                self._packs[key] = Pack(*key)
+
+    def _read_loose(self, hexsha):
+        for objects_dir in self.objects_dirs:
+            filename = os.path.join(objects_dir, hexsha[:2], hexsha[2:])
+            try:
+                with open(filename, 'rb') as handle:
+                    raw = zlib.decompress(handle.read())
+            except IOError:
+                continue
+            header, _, data = raw.partition(b'\0')
+            object_type, _ = header.split()
+            return object_type.decode('ascii'), data
+        return None
+
+    def _read_packed(self, binsha):
+        with self._lock:
+            packs = list(self._packs.values())
+        for pack in packs:
+            offset = pack.index.find(binsha)
+            if offset is not None:
+                return pack.read(offset, self)
+        return None
+
+    def read(self, hexsha):
+        """Return (type, data) for an object, or None if not present"""
+        binsha = binascii.unhexlify(hexsha)
+        result = self._read_packed(binsha)
+        if result is None:
+            result = self._read_loose(hexsha)
+        if result is None:
+            # may have been repacked, or fetched since we last looked
+            self.scan_packs()
+            result = self._read_packed(binsha)
+        return result
+
+
+class RefStore(object):
+    """Resolves ref names using loose ref files and ``packed-refs``"""
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self._packed_refs = {}
+        self._packed_refs_stat = None
+
+    @property
+    def packed_refs(self):
+        filename = os.path.join(self.git_dir, 'packed-refs')
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return {}
+        stat_key = (stat.st_mtime, stat.st_size, stat.st_ino)
+        if stat_key != self._packed_refs_stat:
+            packed_refs = {}
+            with open(filename) as handle:
+                for line in handle:
+                    # skip comments and peeled tags
+                    if line.startswith('#') or line.startswith('^'):
+                        continue
+                    sha, name = line.split()
+                    packed_refs[name] = sha
+            self._packed_refs = packed_refs
+            self._packed_refs_stat = stat_key
+        return self._packed_refs
+
+    def read_ref(self, name, depth=0):
+        """Return the sha for a full ref name, or None"""
+        if depth > MAX_SYMBOLIC_REF_DEPTH:
+            return None
+        filename = os.path.join(self.git_dir, *name.split('/'))
+        try:
+            with open(filename) as handle:
+                content = handle.read().strip()
+        except IOError:
+            return self.packed_refs.get(name)
+
+        if content.startswith(SYMBOLIC_REF_PREFIX):
+            target = content[len(SYMBOLIC_REF_PREFIX):]
+            return self.read_ref(target, depth + 1)
+        if SHA_PATTERN.match(content):
+            return content
+        return None
+
+    def list_refs(self, prefix):
+        """Return a dict mapping the full names of all refs under `prefix`
+        (e.g. ``refs/remotes/``) to their shas
+        """
+        refs = {
+            name: sha for name, sha in self.packed_refs.items()
+            if name.startswith(prefix)
+        }
+        # loose refs take precedence
+        top = os.path.join(self.git_dir, *prefix.strip('/').split('/'))
+        for dirpath, _, filenames in os.walk(top):
+            for filename in filenames:
+                if filename.endswith('.lock'):
+                    continue
+                path = os.path.relpath(
+                    os.path.join(dirpath, filename), self.git_dir)
+                name = '/'.join(path.split(os.sep))
+                sha = self.read_ref(name)
+                if sha is not None:
+                    refs[name] = sha
+        return refs
+
+    def resolve(self, name):
+        """Return the sha for a (possibly abbreviated) ref name, or None"""
+        if '..' in name.split('/'):
+            return None
+        for pattern in REF_LOOKUP_PATTERNS:
+            sha = self.read_ref(pattern.format(name))
+            if sha is not None:
+                return sha
+        return None
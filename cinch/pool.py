@@ -0,0 +1,118 @@
+"""Run CPU and IO heavy work (e.g. git) in separate processes
+
+The worker runs under eventlet, where long running computations in a green
+thread hold up every other green thread, including the ones handling AMQP
+heartbeats. Work sent to a `ProcessPool` runs in another process, while
+the calling green thread waits on a (cooperative) `select`.
+"""
+
+import logging
+import multiprocessing
+import select
+import threading
+import traceback
+import zlib
+
+
+_log = logging.getLogger(__name__)
+
+
+class PoolError(Exception):
+    pass
+
+
+def _serve(connection):
+    """Main loop of a pool process. Runs functions sent by the parent"""
+    while True:
+        try:
+            func, args = connection.recv()
+        except (EOFError, IOError):
+            return  # parent went away
+
+        try:
+            result = (True, func(*args))
+        except Exception:
+            result = (False, traceback.format_exc())
+        connection.send(result)
+
+
+class PoolProcess(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.process = None
+        self.connection = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_serve, args=(child_connection,))
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.connection.close()
+        self.process.terminate()
+        self.process.join()
+        self.process = None
+
+    def run(self, func, args):
+        if not self.is_alive():
+            self.stop()
+            self.start()
+
+        try:
+            self.connection.send((func, args))
+            # cooperative when monkey patched by eventlet
+            select.select([self.connection], [], [])
+            success, result = self.connection.recv()
+        except (EOFError, IOError) as ex:
+            _log.warning('pool process died: %s', ex)
+            self.stop()
+            raise PoolError('pool process died running {}'.format(func))
+
+        if not success:
+            raise PoolError(result)
+        return result
+
+
+class ProcessPool(object):
+    """A fixed number of processes to run functions in
+
+    Each call is given a `key`, and calls with the same key always run in
+    the same process (so e.g. per-repo caches stay warm). Functions and
+    their arguments and results must be picklable. With a `size` of 0,
+    functions are called inline.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._processes = [PoolProcess() for _ in range(size)]
+
+    def start(self):
+        """Start all processes up front
+
+        Otherwise processes are started as needed. Starting them before
+        opening any connections keeps those out of the forked processes.
+        """
+        for process in self._processes:
+            if not process.is_alive():
+                process.start()
+
+    def stop(self):
+        for process in self._processes:
+            process.stop()
+
+    def run(self, key, func, *args):
+        if not self.size:
+            return func(*args)
+
+        index = zlib.crc32(key) % self.size
+        process = self._processes[index]
+        with process.lock:
+            return process.run(func, args)
@@ -0,0 +1,286 @@
+"""Look up open pull requests by the shas of their heads and merge heads
+
+Used to find the pull requests affected by a jenkins build without
+scanning all pull requests. Changes to pull requests are picked up as they
+are flushed, in any process.
+
+By default the index is kept in memory, built on startup (see
+`warm_sha_index`). Every process logs the pull requests it changes, and
+the index applies the changes logged since it was last used, whichever
+process made them. With ``SHA_INDEX`` set to ``database`` it is kept in
+the ``pull_request_shas`` table instead, which survives restarts (and is
+backfilled by ``init_db.py``).
+"""
+
+from itertools import chain
+
+from sqlalchemy import and_, event, func
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from cinch import app, db
+from cinch.cache import OPEN_PULL_REQUEST_SHAS, VersionedCache, bump_version
+from cinch.models import (
+    PullRequest, PullRequestSha, PullRequestShaChange, YIELD_PER)
+
+
+INDEX_MEMORY = 'memory'
+INDEX_DATABASE = 'database'
+INDEXES = (INDEX_MEMORY, INDEX_DATABASE)
+
+# changes to these change the entries of a pull request
+INDEXED_ATTRIBUTES = ('head', 'merge_head', 'is_open')
+
+# changes logged for in-memory indexes to catch up with; those further
+# behind are rebuilt
+KEPT_CHANGES = 10000
+
+
+def get_index_type():
+    index_type = app.config.get('SHA_INDEX', INDEX_MEMORY)
+    if index_type not in INDEXES:
+        raise RuntimeError(
+            'SHA_INDEX must be one of {}, not {!r}'.format(
+                ', '.join(INDEXES), index_type)
+        )
+    return index_type
+
+
+def get_shas(pull_request):
+    """Return the shas a pull request is found by (none once closed)"""
+    if not pull_request.is_open:
+        return set()
+    return {
+        sha for sha in (pull_request.head, pull_request.merge_head)
+        if sha is not None
+    }
+
+
+class ShaIndex(object):
+    """The in-memory index, as of the change logged as `change_id`
+
+    `shas` maps shas to sets of the (project id, number) of the open pull
+    requests with that head or merge head, and `pull_requests` maps each
+    of those to its shas.
+    """
+
+    def __init__(self, change_id, shas, pull_requests):
+        self.change_id = change_id
+        self.shas = shas
+        self.pull_requests = pull_requests
+
+
+def get_last_change_id():
+    return db.session.query(func.max(PullRequestShaChange.id)).scalar() or 0
+
+
+def read_shas(query):
+    """Return a dict mapping the (project id, number) of the open pull
+    requests of `query` (a `PullRequest` query) to their shas
+    """
+    query = query.with_entities(
+        PullRequest.project_id,
+        PullRequest.number,
+        PullRequest.head,
+        PullRequest.merge_head,
+    ).filter(
+        PullRequest.is_open == True,
+    )
+    pull_requests = {}
+    for project_id, number, head, merge_head in query.yield_per(YIELD_PER):
+        shas = {sha for sha in (head, merge_head) if sha is not None}
+        if shas:
+            pull_requests[(project_id, number)] = shas
+    return pull_requests
+
+
+def compute_sha_index():
+    # read first, so that changes made meanwhile are applied again later
+    change_id = get_last_change_id()
+    pull_requests = read_shas(db.session.query(PullRequest))
+    shas = {}
+    for key, pull_request_shas in pull_requests.items():
+        for sha in pull_request_shas:
+            shas.setdefault(sha, set()).add(key)
+    return ShaIndex(change_id, shas, pull_requests)
+
+
+def refresh_sha_index(index):
+    """Return a copy of `index` with the changes logged since applied, or
+    None if some of those aren't logged anymore
+    """
+    oldest, latest = db.session.query(
+        func.min(PullRequestShaChange.id),
+        func.max(PullRequestShaChange.id),
+    ).one()
+    if latest is None:
+        latest = 0
+    if latest < index.change_id:
+        # the log was reset, e.g. the database recreated
+        return None
+    if latest == index.change_id:
+        return index
+    if oldest > index.change_id + 1:
+        return None
+
+    changes = db.session.query(
+        PullRequestShaChange.id,
+        PullRequestShaChange.project_id,
+        PullRequestShaChange.number,
+    ).filter(
+        PullRequestShaChange.id > index.change_id,
+    ).order_by(PullRequestShaChange.id).all()
+    keys = {(project_id, number) for _, project_id, number in changes}
+    current = read_shas(db.session.query(PullRequest).filter(
+        PullRequest.project_id.in_({project_id for project_id, _ in keys}),
+        PullRequest.number.in_({number for _, number in keys}),
+    ))
+    pull_requests = dict(index.pull_requests)
+    updates = []
+    for key in keys:
+        shas = current.get(key, set())
+        updates.append((key, pull_requests.get(key, set()), shas))
+        if shas:
+            pull_requests[key] = shas
+        else:
+            pull_requests.pop(key, None)
+    return ShaIndex(
+        changes[-1][0], apply_changes(index.shas, updates), pull_requests)
+
+
+sha_index_cache = VersionedCache(
+    OPEN_PULL_REQUEST_SHAS, compute_sha_index, refresh_sha_index)
+
+
+def warm_sha_index():
+    """Build the in-memory index now, if used, rather than on first use
+
+    Call on startup, so that the first request doesn't wait for it.
+    """
+    if get_index_type() == INDEX_MEMORY:
+        sha_index_cache.get()
+
+
+def find_open_pull_requests(shas):
+    """Return the set of (project id, number) of the open pull requests with
+    any of `shas` as their head or merge head
+    """
+    if not shas:
+        return set()
+
+    if get_index_type() == INDEX_DATABASE:
+        return set(db.session.query(
+            PullRequestSha.project_id, PullRequestSha.number,
+        ).filter(
+            PullRequestSha.sha.in_(list(shas)),
+        ))
+
+    index = sha_index_cache.get().shas
+    found = set()
+    for sha in shas:
+        found.update(index.get(sha, ()))
+    return found
+
+
+def rebuild_pull_request_shas():
+    """Recompute the ``pull_request_shas`` table from the pull requests
+
+    Does not commit.
+    """
+    db.session.query(PullRequestSha).delete()
+    pull_requests = read_shas(db.session.query(PullRequest))
+    for (project_id, number), shas in pull_requests.items():
+        for sha in shas:
+            db.session.add(PullRequestSha(
+                sha=sha, project_id=project_id, number=number))
+
+
+def get_changed_pull_requests(session):
+    """Return the pull requests of `session` whose entries may change when
+    it is flushed
+    """
+    changed = [
+        instance for instance in chain(session.new, session.deleted)
+        if isinstance(instance, PullRequest)
+    ]
+    for instance in session.dirty:
+        if isinstance(instance, PullRequest) and any(
+                get_history(instance, attribute).has_changes()
+                for attribute in INDEXED_ATTRIBUTES):
+            changed.append(instance)
+    return changed
+
+
+def apply_changes(index, changes):
+    """Return a copy of the in-memory `index` with `changes` applied, a
+    list of the (project id, number), previous shas and new shas of pull
+    requests
+    """
+    index = dict(index)
+    for key, previous_shas, shas in changes:
+        for sha in previous_shas - shas:
+            keys = index.get(sha, set()) - {key}
+            if keys:
+                index[sha] = keys
+            else:
+                index.pop(sha, None)
+        for sha in shas - previous_shas:
+            index[sha] = index.get(sha, set()) | {key}
+    return index
+
+
+@event.listens_for(Session, 'before_flush')
+def bump_sha_index(session, flush_context, instances):
+    """Record that the index changes, in the same transaction
+
+    This also locks the version until the transaction ends, so changes are
+    logged (see `log_sha_index_changes`) in the order they are committed.
+    """
+    if get_changed_pull_requests(session):
+        bump_version(OPEN_PULL_REQUEST_SHAS, session)
+
+
+@event.listens_for(Session, 'after_flush')
+def log_sha_index_changes(session, flush_context):
+    """Log the pull requests whose shas change, for in-memory indexes to
+    apply, and forget the oldest entries
+    """
+    changed = get_changed_pull_requests(session)
+    if not changed:
+        return
+
+    table = PullRequestShaChange.__table__
+    for pull_request in changed:
+        result = session.execute(table.insert().values(
+            project_id=pull_request.project_id,
+            number=pull_request.number,
+        ))
+    change_id, = result.inserted_primary_key
+    session.execute(table.delete().where(
+        table.c.id <= change_id - KEPT_CHANGES))
+
+
+@event.listens_for(Session, 'after_flush')
+def update_pull_request_shas(session, flush_context):
+    """Maintain the ``pull_request_shas`` table, if used
+
+    Done after the flush, once new pull requests have their keys.
+    """
+    changed = get_changed_pull_requests(session)
+    if not changed or get_index_type() != INDEX_DATABASE:
+        return
+
+    table = PullRequestSha.__table__
+    for pull_request in changed:
+        session.execute(table.delete().where(and_(
+            table.c.project_id == pull_request.project_id,
+            table.c.number == pull_request.number,
+        )))
+        if pull_request in session.deleted:
+            continue
+        for sha in get_shas(pull_request):
+            session.execute(table.insert().values(
+                sha=sha,
+                project_id=pull_request.project_id,
+                number=pull_request.number,
+            ))
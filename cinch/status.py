@@ -0,0 +1,240 @@
+"""Publish commit statuses to github
+
+Statuses are queued and posted from a background thread, over a pool of
+keep-alive connections. Requests are paced using github's rate limit
+headers, and failed posts are retried with backoff.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import threading
+import time
+
+import requests
+
+
+_log = logging.getLogger(__name__)
+
+
+DEFAULT_BASE_URL = 'https://api.github.com/'
+
+# requests left in the rate limit window that we never use, e.g. to leave
+# some for manual use of the same token
+DEFAULT_RATE_LIMIT_RESERVE = 100
+# no pacing while more than this fraction of the rate limit is left
+PACING_THRESHOLD = 0.25
+
+# number of (sha, context) pairs whose last published status is remembered
+DEFAULT_PUBLISHED_CACHE_SIZE = 10000
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 1
+REQUEST_TIMEOUT = 30
+
+
+class StatusPublisher(object):
+    """Posts commit statuses using the worker's github token
+
+    .. warning::
+        do not use in any web-exposed views; they should use the
+        user's token, as provided by `cinch.auth.views.token_getter`
+
+    Statuses waiting to be posted are coalesced: only the latest status for
+    each sha and context is sent. Statuses identical to the one last
+    published for the same sha and context are not sent at all.
+    """
+
+    def __init__(self, token, base_url=DEFAULT_BASE_URL,
+                 reserve=DEFAULT_RATE_LIMIT_RESERVE,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+                 published_cache_size=DEFAULT_PUBLISHED_CACHE_SIZE):
+        self.base_url = base_url
+        self.reserve = reserve
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.published_cache_size = published_cache_size
+
+        # keeps connections alive between requests
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': 'token {}'.format(token),
+            'Content-Type': 'application/json',
+        })
+
+        # (resource, context) -> payload
+        self._pending = OrderedDict()
+        self._in_flight = 0
+        # (key, payload) being sent
+        self._sending = None
+        # (resource, context) -> payload, least recently published first
+        self._published = OrderedDict()
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = None
+
+        # from the latest response
+        self.rate_limit = None
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+
+        self.posted = 0
+        self.failed = 0
+        self.coalesced = 0
+        # posts avoided because the status hadn't changed
+        self.unchanged = 0
+
+    def publish(self, resource, payload):
+        """Queue a status for posting to `resource` (e.g.
+        ``repos/owner/name/statuses/sha``)
+        """
+        key = (resource, payload.get('context'))
+        with self._condition:
+            if payload == self._expected(key):
+                self.unchanged += 1
+                self._pending.pop(key, None)
+                return
+
+            if key in self._pending:
+                self.coalesced += 1
+            self._pending[key] = payload
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+
+    def stats(self):
+        """Return a dict of counts of statuses by what became of them, and
+        of those waiting to be posted
+        """
+        with self._condition:
+            return {
+                'posted': self.posted,
+                'failed': self.failed,
+                'coalesced': self.coalesced,
+                'unchanged': self.unchanged,
+                'pending': len(self._pending),
+            }
+
+    def _expected(self, key):
+        """Return the status github will have for `key` once the status
+        being sent (if any) has been, if known
+
+        Any pending status for `key` is about to be superseded, so is
+        ignored.
+        """
+        if self._sending is not None and self._sending[0] == key:
+            return self._sending[1]
+        return self._published.get(key)
+
+    def _record_published(self, key, payload):
+        self._published.pop(key, None)
+        self._published[key] = payload
+        while len(self._published) > self.published_cache_size:
+            self._published.popitem(last=False)
+
+    def flush(self, timeout=None):
+        """Wait until all queued statuses have been sent (or given up on)
+
+        Returns False if `timeout` seconds passed first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending or self._in_flight:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                key, payload = self._pending.popitem(last=False)
+                self._sending = (key, payload)
+                self._in_flight += 1
+
+            resource, _ = key
+            sent = False
+            try:
+                sent = self._send(resource, payload)
+            except Exception:
+                _log.exception('error posting status to %s', resource)
+            finally:
+                with self._condition:
+                    if sent:
+                        self.posted += 1
+                        self._record_published(key, payload)
+                    else:
+                        self.failed += 1
+                        # unknown; don't skip the next one
+                        self._published.pop(key, None)
+                    self._sending = None
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    def _pace(self):
+        """Return the number of seconds to wait before the next request"""
+        if self.rate_limit_remaining is None or self.rate_limit_reset is None:
+            return 0
+
+        until_reset = max(self.rate_limit_reset - time.time(), 0)
+        available = self.rate_limit_remaining - self.reserve
+        if available <= 0:
+            return until_reset
+        if self.rate_limit and available > self.rate_limit * PACING_THRESHOLD:
+            return 0
+        # spread what's left evenly over the rest of the window
+        return until_reset / available
+
+    def _update_rate_limit(self, headers):
+        try:
+            self.rate_limit = int(headers['X-RateLimit-Limit'])
+            self.rate_limit_remaining = int(headers['X-RateLimit-Remaining'])
+            self.rate_limit_reset = int(headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            pass
+
+    def _send(self, resource, payload):
+        url = self.base_url + resource
+        data = json.dumps(payload)
+
+        for attempt in range(self.max_retries + 1):
+            delay = self._pace()
+            if delay:
+                _log.debug('rate limited; waiting %.1fs', delay)
+                time.sleep(delay)
+
+            try:
+                response = self.session.post(
+                    url, data=data, timeout=REQUEST_TIMEOUT)
+            except requests.RequestException as ex:
+                _log.warning('error posting status to %s: %s', url, ex)
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+
+            self._update_rate_limit(response.headers)
+            status_code = response.status_code
+            if status_code < 300:
+                return True
+
+            if status_code == 403 and self.rate_limit_remaining == 0:
+                continue  # paced until the reset on the next attempt
+            if status_code == 403 and 'Retry-After' in response.headers:
+                # secondary rate limit
+                time.sleep(int(response.headers['Retry-After']))
+                continue
+            if status_code >= 500:
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+
+            _log.error(
+                'failed to post status to %s: %s %s',
+                url, status_code, response.content)
+            break
+
+        return False
@@ -6,6 +6,7 @@ from cinch.auth.decorators import requires_auth
 from cinch.check import run_checks
 from cinch.models import PullRequest, Project
 from cinch.admin import AdminView
+from cinch.jenkins.controllers import all_open_prs
 from cinch.jenkins.views import jenkins
 
 logger = logging.getLogger(__name__)
@@ -40,6 +41,8 @@ def index():
     pulls = dbsession.query(PullRequest).filter(
         PullRequest.is_open == True).all()
     projects = dbsession.query(Project).all()
+    # read jenkins statuses of all pull requests at once, for the checks
+    all_open_prs()
     ready_pull_requests = []
     for pull in pulls:
         pull.checks = list(run_checks(pull))
@@ -1,38 +1,86 @@
 """Nameko worker for async handling of updates"""
 
 from contextlib import contextmanager
+from datetime import datetime
 from functools import wraps
+import gc
+import heapq
+import itertools
 import logging
+import os
+import Queue
+import resource
+import threading
+import time
 from urlparse import urlparse
 
 from flask import url_for
-from flask.ext.github import GitHub
 from nameko.containers import MAX_WORKERS_CONFIG_KEY
 from nameko.events import Event, event_handler
 from nameko.messaging import AMQP_URI_CONFIG_KEY
 from nameko.standalone.events import event_dispatcher
+from nameko.timer import timer
 
 from cinch import app, db
+from cinch.cache import OPEN_PULL_REQUESTS, bump_version
 from cinch.check import run_checks
 from cinch.git import Repo
-from cinch.models import Project, PullRequest
+from cinch.models import MasterRecompute, Project, PullRequest, YIELD_PER
+from cinch.pool import ProcessPool
+from cinch.status import (
+    DEFAULT_BASE_URL, DEFAULT_RATE_LIMIT_RESERVE, StatusPublisher)
 
 
 _logger = logging.getLogger(__name__)
 
+# number of events handled concurrently. events for the same project are
+# always handled one at a time, in order
+DEFAULT_WORKER_CONCURRENCY = 10
 
-class WorkerGitHub(GitHub):
-    """for use by worker methods. uses the github token from app.config
+# how events are sent to `RepoWorker`: over AMQP to a separate worker
+# process, or to handlers in this process (see `LocalDispatcher`)
+DISPATCHER_AMQP = 'amqp'
+DISPATCHER_LOCAL = 'local'
+DISPATCHERS = (DISPATCHER_AMQP, DISPATCHER_LOCAL)
 
-    .. warning::
-        do not use in any web-exposed views; they should use the
-        user's token, as provided by `cinch.auth.views.token_getter`
-    """
-    def get_access_token(self):
-        return self.app.config['GITHUB_TOKEN']
+FULL_FETCH_INTERVAL_CONFIG_KEY = 'full_fetch_interval'
+DEFAULT_FULL_FETCH_INTERVAL = 60 * 60
+
+MAINTENANCE_INTERVAL_CONFIG_KEY = 'maintenance_interval'
+DEFAULT_MAINTENANCE_INTERVAL = 60 * 60
+
+MEMORY_GAUGE_INTERVAL_CONFIG_KEY = 'memory_gauge_interval'
+DEFAULT_MEMORY_GAUGE_INTERVAL = 5 * 60
+
+# priorities of work on a project; lower goes first. interactive work
+# (someone's waiting for a pull request) goes ahead of bulk recomputes
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_BULK: 'bulk',
+}
+
+# number of pull requests recomputed by each task of a bulk recompute. tasks
+# may run on different workers, and interactive work goes first in between
+DEFAULT_RECOMPUTE_CHUNK_SIZE = 10
+# only maintain repos that haven't been used for this many seconds
+DEFAULT_MAINTENANCE_IDLE_TIME = 5 * 60
+
+# the git work of event handlers runs here, keeping the event loop (and so
+# e.g. AMQP heartbeats) responsive. a size of 0 runs it inline
+git_pool = ProcessPool(int(app.config.get('GIT_PROCESS_POOL_SIZE', 0)))
 
+# held while a maintenance thread is running
+_maintenance_lock = threading.Lock()
 
-github = WorkerGitHub(app)
+
+status_publisher = StatusPublisher(
+    app.config.get('GITHUB_TOKEN'),
+    base_url=app.config.get('GITHUB_BASE_URL', DEFAULT_BASE_URL),
+    reserve=int(app.config.get(
+        'GITHUB_RATE_LIMIT_RESERVE', DEFAULT_RATE_LIMIT_RESERVE)),
+)
 
 
 if 'SERVER_URL' in app.config:
@@ -89,6 +137,28 @@ class PullRequestMoved(Event):
     type = 'pull_request_moved'
 
 
+class RecomputeScheduled(Event):
+    """ Some of the pull requests of this project need their ahead/behind
+    status, mergeable and merge head recomputing, after master moved. One
+    task of a `MasterRecompute`.
+
+    :Event data:
+        owner : str
+            Project owner
+        name : str
+            Project name
+        numbers : list of int
+            Pull request numbers
+        generation : int
+            `MasterRecompute.generation` of the recompute
+        priority : int
+            Priority of the task among work on the project (optional,
+            defaults to `PRIORITY_BULK`)
+    """
+
+    type = 'recompute_scheduled'
+
+
 class PullRequestStatusUpdated(Event):
     """ The build status for this pull request has changed.
 
@@ -101,6 +171,25 @@ class PullRequestStatusUpdated(Event):
     type = 'pull_request_status_updated'
 
 
+def get_timer_intervals():
+    """Return a dict mapping the config keys of `RepoWorker` timers to
+    their intervals in seconds
+    """
+    return {
+        FULL_FETCH_INTERVAL_CONFIG_KEY: int(app.config.get(
+            'FULL_FETCH_INTERVAL', DEFAULT_FULL_FETCH_INTERVAL)),
+        MAINTENANCE_INTERVAL_CONFIG_KEY: int(app.config.get(
+            'MAINTENANCE_INTERVAL', DEFAULT_MAINTENANCE_INTERVAL)),
+        MEMORY_GAUGE_INTERVAL_CONFIG_KEY: int(app.config.get(
+            'MEMORY_GAUGE_INTERVAL', DEFAULT_MEMORY_GAUGE_INTERVAL)),
+    }
+
+
+def get_worker_concurrency():
+    return int(app.config.get(
+        'WORKER_CONCURRENCY', DEFAULT_WORKER_CONCURRENCY))
+
+
 def get_nameko_config():
     amqp_uri = app.config.get('NAMEKO_AMQP_URI')
 
@@ -109,16 +198,27 @@ def get_nameko_config():
             'NAMEKO_AMQP_URI must be configured in order to run this worker'
         )
 
-    return {
+    config = {
         AMQP_URI_CONFIG_KEY: amqp_uri,
-
-        # we're not threadsafe, but don't need concurrency, only async
-        MAX_WORKERS_CONFIG_KEY: 1,
+        MAX_WORKERS_CONFIG_KEY: get_worker_concurrency(),
     }
+    config.update(get_timer_intervals())
+    return config
 
 
 @contextmanager
 def dispatcher():
+    backend = app.config.get('DISPATCHER', DISPATCHER_AMQP)
+    if backend not in DISPATCHERS:
+        raise RuntimeError(
+            'DISPATCHER must be one of {}, not {!r}'.format(
+                ', '.join(DISPATCHERS), backend)
+        )
+
+    if backend == DISPATCHER_LOCAL:
+        yield get_local_dispatcher().dispatch
+        return
+
     config = get_nameko_config()
     with event_dispatcher('cinch', config) as dispatch:
         yield dispatch
@@ -137,28 +237,394 @@ def worker_app_context(func):
     return wrapped
 
 
-def set_relative_states(pr, fetch=True):
-    """Set values of states that are relative to the base branch"""
+class ProjectQueue(object):
+    """Callers holding or waiting for the lock of a single project"""
+
+    def __init__(self):
+        # (priority, ticket) of the caller holding the lock
+        self.holder = None
+        # heap of (priority, ticket)
+        self.waiting = []
+
+
+class ProjectLocks(object):
+    """Serialise work on each project (and so on its local clone)
+
+    Callers waiting for the same project are let in by priority (lower
+    first), and in the order they arrived within each priority. Work on
+    different projects runs concurrently.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._tickets = itertools.count()
+        # key -> ProjectQueue
+        self._queues = {}
+        # priority -> [number of waits, total seconds waited, longest wait]
+        self.waits = {}
+
+    def __len__(self):
+        return len(self._queues)
+
+    def _acquire(self, queue, entry, on_queued=None):
+        heapq.heappush(queue.waiting, entry)
+        if on_queued is not None:
+            on_queued()
+        while queue.holder is not None or queue.waiting[0] != entry:
+            self._condition.wait()
+        heapq.heappop(queue.waiting)
+        queue.holder = entry
+
+    def _release(self, key, queue):
+        queue.holder = None
+        if not queue.waiting:
+            del self._queues[key]
+        self._condition.notify_all()
+
+    @contextmanager
+    def hold(self, key, priority=PRIORITY_INTERACTIVE, on_queued=None):
+        """Hold the lock for `key`
+
+        `on_queued` is called once the caller has its place in line, before
+        waiting for its turn.
+        """
+        start = time.time()
+        with self._condition:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = ProjectQueue()
+            self._acquire(
+                queue, (priority, next(self._tickets)), on_queued)
+
+            waited = time.time() - start
+            waits = self.waits.setdefault(priority, [0, 0, 0])
+            waits[0] += 1
+            waits[1] += waited
+            waits[2] = max(waits[2], waited)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._release(key, queue)
+
+    def wait_stats(self):
+        """Return a dict mapping priorities to (number of waits, average
+        wait, longest wait) in seconds
+        """
+        with self._condition:
+            return {
+                priority: (count, total / count, longest)
+                for priority, (count, total, longest) in self.waits.items()
+            }
+
+
+project_locks = ProjectLocks()
+
+
+class EventCoalescer(object):
+    """Keeps track of events waiting to be handled, so that only the
+    latest of several events for the same key is
+
+    Each event is given a sequence number on arrival. By the time it's its
+    turn, it may have been superseded by a newer event for the same key
+    (and is dropped), or covered by a handler for another event (and is
+    merged into that).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        # key -> sequence number of the latest event waiting
+        self._pending = {}
+        # key -> sequence number up to which events were handled by others
+        self._covered = {}
+        self.dropped = 0
+        self.merged = 0
+
+    def arrived(self, key):
+        """Register a new event, returning its sequence number"""
+        with self._lock:
+            sequence = next(self._sequence)
+            self._pending[key] = sequence
+            return sequence
+
+    def start(self, key, sequence):
+        """Return True if the event should be handled now"""
+        with self._lock:
+            if self._pending.get(key) == sequence:
+                del self._pending[key]
+                return True
+
+            covered = self._covered.get(key)
+            if covered is not None and covered >= sequence:
+                self.merged += 1
+                if covered == sequence:
+                    # no older events left
+                    del self._covered[key]
+            else:
+                self.dropped += 1
+            return False
+
+    def claim(self, keys):
+        """Mark waiting events for any of `keys` as handled by the caller
+
+        Returns the keys that had events waiting.
+        """
+        claimed = []
+        with self._lock:
+            for key in keys:
+                sequence = self._pending.pop(key, None)
+                if sequence is not None:
+                    self._covered[key] = sequence
+                    claimed.append(key)
+        return claimed
+
+
+coalescer = EventCoalescer()
+
+
+def master_moved_key(owner, name):
+    return (MasterMoved.type, owner, name)
+
+
+def pull_request_moved_key(owner, name, number):
+    return (PullRequestMoved.type, owner, name, number)
+
+
+# per thread state of handlers started by a `LocalDispatcher`
+_local_handler = threading.local()
+
+
+def handler_queued():
+    """Tell the `LocalDispatcher` that started the current handler (if
+    any) that the handler has its place in line for its project
+    """
+    queued = getattr(_local_handler, 'queued', None)
+    if queued is not None:
+        queued.set()
+
+
+def recompute_key(owner, name, generation, numbers):
+    return (RecomputeScheduled.type, owner, name, generation, tuple(numbers))
+
+
+def recompute_priority(event_data):
+    return event_data.get('priority', PRIORITY_BULK)
+
+
+def per_project(event_key, priority=PRIORITY_INTERACTIVE):
+    """Handle events for the same project one at a time, by `priority` and
+    then in order
+
+    Events are coalesced by `event_key(event_data)`; see `EventCoalescer`.
+    `priority` may also be a function of the event data.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapped(self, event_data):
+            key = event_key(event_data)
+            sequence = coalescer.arrived(key)
+            project = (event_data['owner'], event_data['name'])
+            if callable(priority):
+                event_priority = priority(event_data)
+            else:
+                event_priority = priority
+            with project_locks.hold(
+                    project, event_priority, on_queued=handler_queued):
+                if not coalescer.start(key, sequence):
+                    _logger.debug(
+                        'skipping superseded event %s (dropped %s, merged %s)',
+                        key, coalescer.dropped, coalescer.merged)
+                    return
+                return func(self, event_data)
+
+        return wrapped
+
+    return decorator
+
+
+def scoped_session(func):
+    """Remove the (per green thread) database session when done, so that
+    concurrent handlers never share a session or its identity map
+    """
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            db.session.remove()
+
+    return wrapped
+
 
-    project = pr.project
+def get_git_repo(project):
+    """Return the local clone for this project, cloning it if necessary"""
     git_repo = Repo.from_local_repo(project.owner, project.name)
     if not git_repo.is_repo():
         git_repo = Repo.setup_repo(project.owner, project.name)
+    return git_repo
+
 
-    if fetch:
-        git_repo.fetch()
+def compute_relative_states(git_repo, numbers, refs):
+    """Return a dict mapping each of the pull request `numbers` to a tuple
+    (behind, ahead, is_mergeable, merge_head)
 
+    Only does git work (no database access), so that it can run in
+    `git_pool`. All shas are looked up in `refs` (see `Repo.ref_snapshot`).
+    """
     # we currently assume that the base is master
-    behind, ahead = git_repo.compare_pr(pr.number)
-    is_mergeable = git_repo.is_mergeable(pr.number)
-    merge_head = git_repo.merge_head(pr.number)
+    if len(numbers) == 1:
+        number, = numbers
+        all_counts = {number: git_repo.compare_pr(number, refs=refs)}
+    else:
+        # compare all pull requests in a single pass over history
+        all_counts = git_repo.compare_prs(numbers, refs=refs)
 
+    states = {}
+    for number in numbers:
+        behind, ahead = all_counts[number]
+        is_mergeable = git_repo.is_mergeable(number, refs=refs)
+        merge_head = git_repo.merge_head(number, refs=refs)
+        states[number] = (behind, ahead, is_mergeable, merge_head)
+    return states
+
+
+def apply_relative_states(pr, states):
+    """Set states computed by `compute_relative_states` on `pr`"""
+    behind, ahead, is_mergeable, merge_head = states
     pr.behind_master = behind
     pr.ahead_of_master = ahead
     pr.is_mergeable = is_mergeable
     pr.merge_head = merge_head
 
 
+def set_relative_states(pull_requests, git_repo, refs):
+    """Set values of states that are relative to the base branch for
+    all of `pull_requests` (of the same project)
+
+    The git work is done in `git_pool`.
+    """
+    numbers = [pr.number for pr in pull_requests]
+    all_states = git_pool.run(
+        git_repo.path, compute_relative_states, git_repo, numbers, refs)
+    for pr in pull_requests:
+        apply_relative_states(pr, all_states[pr.number])
+
+
+def set_each_relative_states(pull_requests, git_repo, refs):
+    """Like `set_relative_states`, but if that fails, set the states of
+    each pull request on its own, logging those that fail, so that one
+    broken pull request doesn't hold up the others
+    """
+    try:
+        set_relative_states(pull_requests, git_repo, refs)
+        return
+    except Exception:
+        if len(pull_requests) == 1:
+            raise
+        _logger.warning(
+            'failed to compare pull requests of %s together, comparing '
+            'them one at a time', git_repo.path, exc_info=True)
+
+    for pull_request in pull_requests:
+        try:
+            set_relative_states([pull_request], git_repo, refs)
+        except Exception:
+            _logger.exception(
+                'failed to compare pull request %s of %s',
+                pull_request.number, git_repo.path)
+
+
+def start_recompute(project_id, master_sha, tasks):
+    """Record the start of a recompute of a project's pull requests in
+    `tasks` tasks, superseding any earlier recompute. Returns its generation
+    """
+    now = datetime.utcnow()
+    recompute = db.session.query(
+        MasterRecompute).with_for_update().get(project_id)
+    if recompute is None:
+        recompute = MasterRecompute(project_id=project_id, generation=0)
+        db.session.add(recompute)
+    else:
+        recompute.generation += 1
+    recompute.master_sha = master_sha
+    recompute.pending = tasks
+    recompute.started_at = now
+    recompute.completed_at = None if tasks else now
+    return recompute.generation
+
+
+def finish_recompute_task(project_id, generation):
+    """Count a task of a recompute as done, and commit
+
+    The last task to finish records completion of the recompute, and gets
+    True back.
+    """
+    query = db.session.query(MasterRecompute).filter(
+        MasterRecompute.project_id == project_id,
+        MasterRecompute.generation == generation,
+    )
+    query.update(
+        {MasterRecompute.pending: MasterRecompute.pending - 1},
+        synchronize_session=False)
+    completed = query.filter(
+        MasterRecompute.pending <= 0,
+        MasterRecompute.completed_at.is_(None),
+    ).update(
+        {MasterRecompute.completed_at: datetime.utcnow()},
+        synchronize_session=False)
+    db.session.commit()
+    return completed == 1
+
+
+def maintain_repos(projects, idle_time):
+    """Run maintenance on the repos of those of `projects` (a list of
+    (owner, name) tuples) that are idle
+
+    Doesn't hold up event handlers for the same projects: git's own locking
+    covers concurrent fetches, and unreachable objects are kept, so walks
+    meanwhile still find everything. Releases `_maintenance_lock` when done.
+    """
+    try:
+        for owner, name in projects:
+            git_repo = Repo.from_local_repo(owner, name)
+            if not os.path.isdir(git_repo.path):
+                continue
+            if not git_repo.is_idle(idle_time):
+                _logger.debug(
+                    'skipping maintenance of busy %s', git_repo.path)
+                continue
+            git_repo.maintain()
+    finally:
+        _maintenance_lock.release()
+
+
+def current_rss():
+    """Return the resident set size of this process in bytes, if known"""
+    try:
+        with open('/proc/self/statm') as handle:
+            pages = int(handle.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize()
+
+
+def memory_usage():
+    """Collect garbage, and return a dict describing memory use of this
+    process
+    """
+    collected = gc.collect()
+    return {
+        'rss': current_rss(),
+        # kilobytes on linux
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'gc_collected': collected,
+        'gc_objects': len(gc.get_objects()),
+    }
+
+
 def determine_pull_request_status(pull_request):
     """ Returns one of the following github compatible statuses for the given
     pull request:
@@ -183,25 +649,135 @@ class RepoWorker(object):
     name = 'cinch'
 
     @event_handler('cinch', MasterMoved, reliable_delivery=True)
+    @per_project(lambda event_data: master_moved_key(
+        event_data['owner'], event_data['name']), priority=PRIORITY_BULK)
+    @scoped_session
     def master_moved(self, event_data):
+        """Fetch master, and split recomputing the project's open pull
+        requests into `RecomputeScheduled` tasks that any worker can pick up
+        """
         project_owner = event_data['owner']
         project_name = event_data['name']
 
-        first = True
-        pull_requests = db.session.query(
-            PullRequest).join(Project).filter(
-                Project.owner == project_owner,
-                Project.name == project_name,
-                PullRequest.is_open,
-            )
+        project = db.session.query(Project).filter(
+            Project.owner == project_owner,
+            Project.name == project_name,
+        ).first()
+        if project is None:
+            return
+
+        heads = dict(db.session.query(
+            PullRequest.number, PullRequest.head,
+        ).filter(
+            PullRequest.project_id == project.id,
+            PullRequest.is_open,
+        ).yield_per(YIELD_PER))
+        numbers = sorted(heads)
+
+        master_sha = None
+        claimed_numbers = set()
+        if numbers:
+            git_repo = get_git_repo(project)
+
+            # we're about to recompute all pull requests. any waiting
+            # PullRequestMoved events only need their heads fetched
+            claimed = coalescer.claim([
+                pull_request_moved_key(project_owner, project_name, number)
+                for number in numbers
+            ])
+            claimed_numbers = set(key[-1] for key in claimed)
+            for number in sorted(claimed_numbers):
+                git_repo.fetch_pull_request(number, head=heads[number])
 
-        for pull_request in pull_requests:
-            set_relative_states(pull_request, fetch=first)
-            first = False
+            git_repo.fetch_master(numbers)
+            master_sha = git_repo.ref_snapshot().get('origin/master')
 
+        chunk_size = int(app.config.get(
+            'RECOMPUTE_CHUNK_SIZE', DEFAULT_RECOMPUTE_CHUNK_SIZE))
+        # pull requests that just moved keep the priority of their events
+        chunks = []
+        for priority, chunk_numbers in [
+            (PRIORITY_INTERACTIVE, sorted(claimed_numbers)),
+            (PRIORITY_BULK, [
+                number for number in numbers
+                if number not in claimed_numbers
+            ]),
+        ]:
+            chunks.extend(
+                (priority, chunk_numbers[start:start + chunk_size])
+                for start in range(0, len(chunk_numbers), chunk_size)
+            )
+        generation = start_recompute(project.id, master_sha, len(chunks))
         db.session.commit()
 
+        with dispatcher() as dispatch:
+            for priority, chunk in chunks:
+                dispatch(RecomputeScheduled(data={
+                    'owner': project_owner,
+                    'name': project_name,
+                    'numbers': chunk,
+                    'generation': generation,
+                    'priority': priority,
+                }))
+
+    @event_handler('cinch', RecomputeScheduled, reliable_delivery=True)
+    @per_project(lambda event_data: recompute_key(
+        event_data['owner'], event_data['name'], event_data['generation'],
+        event_data['numbers']), priority=recompute_priority)
+    @scoped_session
+    def recompute_pull_requests(self, event_data):
+        project_owner = event_data['owner']
+        project_name = event_data['name']
+        numbers = event_data['numbers']
+        generation = event_data['generation']
+
+        project = db.session.query(Project).filter(
+            Project.owner == project_owner,
+            Project.name == project_name,
+        ).one()
+        recompute = db.session.query(MasterRecompute).get(project.id)
+        if recompute is None or recompute.generation != generation:
+            _logger.debug(
+                'skipping task of superseded recompute of %s/%s',
+                project_owner, project_name)
+            db.session.commit()
+            return
+        master_sha = recompute.master_sha
+
+        project_id = project.id
+        pull_requests = db.session.query(PullRequest).filter(
+            PullRequest.project_id == project_id,
+            PullRequest.number.in_(numbers),
+            PullRequest.is_open,
+        ).all()
+        # the task counts as done even if it fails, so that the recompute
+        # still completes
+        try:
+            if pull_requests:
+                # master may have been fetched by another worker (and
+                # clone). otherwise, only merge heads that weren't fetched
+                # with it
+                git_repo = get_git_repo(project)
+                git_repo.fetch_master(numbers, sha=master_sha)
+                git_repo.fetch_pull_requests(
+                    {pr.number: pr.head for pr in pull_requests})
+                refs = git_repo.ref_snapshot()
+                set_each_relative_states(pull_requests, git_repo, refs)
+                bump_version(OPEN_PULL_REQUESTS)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            if finish_recompute_task(project_id, generation):
+                _logger.info(
+                    'recomputed pull requests of %s/%s for master %s',
+                    project_owner, project_name, master_sha)
+
     @event_handler('cinch', PullRequestMoved, reliable_delivery=True)
+    @per_project(lambda event_data: pull_request_moved_key(
+        event_data['owner'], event_data['name'], event_data['number']))
+    @scoped_session
     def pull_request_moved(self, event_data):
         project_owner = event_data['owner']
         project_name = event_data['name']
@@ -213,12 +789,99 @@ class RepoWorker(object):
                 Project.name == project_name,
                 PullRequest.number == number,
             ).one()
-        set_relative_states(pull_request, fetch=True)
+        git_repo = get_git_repo(pull_request.project)
+        git_repo.fetch_pull_request(number, head=pull_request.head)
+        refs = git_repo.ref_snapshot()
+        set_relative_states([pull_request], git_repo, refs)
 
+        bump_version(OPEN_PULL_REQUESTS)
         db.session.commit()
 
+    @timer(
+        interval=DEFAULT_FULL_FETCH_INTERVAL,
+        config_key=FULL_FETCH_INTERVAL_CONFIG_KEY,
+    )
+    @scoped_session
+    def fetch_all(self):
+        """Events only fetch the refs they need. Periodically fetch
+        everything, to pick up anything we may have missed
+        """
+        projects = db.session.query(Project.owner, Project.name).all()
+        db.session.commit()
+
+        for owner, name in projects:
+            with project_locks.hold((owner, name), PRIORITY_BULK):
+                git_repo = Repo.from_local_repo(owner, name)
+                if git_repo.is_repo():
+                    git_repo.fetch()
+
+    @timer(
+        interval=DEFAULT_MAINTENANCE_INTERVAL,
+        config_key=MAINTENANCE_INTERVAL_CONFIG_KEY,
+    )
+    @scoped_session
+    def maintain(self):
+        """Keep commit-graphs, bitmaps and packs of idle repos up to date
+
+        Maintenance runs in a separate thread, so as not to hold up event
+        handlers.
+        """
+        if not _maintenance_lock.acquire(False):
+            return  # still running from last time
+
+        projects = db.session.query(Project.owner, Project.name).all()
+        db.session.commit()
+
+        idle_time = int(app.config.get(
+            'MAINTENANCE_IDLE_TIME', DEFAULT_MAINTENANCE_IDLE_TIME))
+        thread = threading.Thread(
+            target=maintain_repos, args=(projects, idle_time))
+        thread.daemon = True
+        thread.start()
+
+    @timer(
+        interval=DEFAULT_MEMORY_GAUGE_INTERVAL,
+        config_key=MEMORY_GAUGE_INTERVAL_CONFIG_KEY,
+    )
+    def memory_gauge(self):
+        """Log memory use, e.g. to spot leaks in this long running process"""
+        usage = memory_usage()
+        _logger.info(
+            'memory: rss=%s max_rss=%s gc_collected=%s gc_objects=%s',
+            usage['rss'], usage['max_rss'], usage['gc_collected'],
+            usage['gc_objects'])
+        return usage
+
+    @timer(
+        interval=DEFAULT_MEMORY_GAUGE_INTERVAL,
+        config_key=MEMORY_GAUGE_INTERVAL_CONFIG_KEY,
+    )
+    def wait_gauge(self):
+        """Log how long work waited for its project, by priority"""
+        stats = project_locks.wait_stats()
+        for priority, (count, average, longest) in sorted(stats.items()):
+            _logger.info(
+                'waits for %s work: count=%s average=%.3fs longest=%.3fs',
+                PRIORITY_NAMES.get(priority, priority), count, average,
+                longest)
+        return stats
+
+    @timer(
+        interval=DEFAULT_MEMORY_GAUGE_INTERVAL,
+        config_key=MEMORY_GAUGE_INTERVAL_CONFIG_KEY,
+    )
+    def status_gauge(self):
+        """Log what became of the statuses published to github"""
+        stats = status_publisher.stats()
+        _logger.info(
+            'statuses: posted=%(posted)s unchanged=%(unchanged)s '
+            'coalesced=%(coalesced)s failed=%(failed)s pending=%(pending)s',
+            stats)
+        return stats
+
     @event_handler('cinch', PullRequestStatusUpdated, reliable_delivery=True)
     @worker_app_context
+    @scoped_session
     def pull_request_status_updated(self, event_data):
         pull_request = db.session.query(PullRequest).get(
             event_data['pull_request'])
@@ -248,4 +911,132 @@ class RepoWorker(object):
             project=project.name,
             sha=pull_request.head,
         )
-        github.post(status_uri, payload)
+        status_publisher.publish(status_uri, payload)
+
+
+class LocalDispatcher(object):
+    """Handles events in this process, calling `RepoWorker` handlers
+    directly from a pool of threads, so no broker or separate worker
+    process is needed (e.g. for single node deployments)
+
+    Handlers are started in the order their events were dispatched, and a
+    handler of a per project event takes its place in line for the project
+    before the next one is started. So, as in the worker, events for the
+    same project are handled one at a time, in order.
+
+    Unlike with AMQP, events not yet handled are lost if the process exits,
+    and events whose handlers fail are not redelivered.
+    """
+
+    def __init__(self, concurrency=DEFAULT_WORKER_CONCURRENCY):
+        self.service = RepoWorker()
+        self._handlers = {
+            MasterMoved.type: self.service.master_moved,
+            RecomputeScheduled.type: self.service.recompute_pull_requests,
+            PullRequestMoved.type: self.service.pull_request_moved,
+            PullRequestStatusUpdated.type: (
+                self.service.pull_request_status_updated),
+        }
+        # handlers decorated with `per_project`
+        self._per_project = set([
+            MasterMoved.type, RecomputeScheduled.type, PullRequestMoved.type])
+        self._timers = [
+            (self.service.fetch_all, FULL_FETCH_INTERVAL_CONFIG_KEY),
+            (self.service.maintain, MAINTENANCE_INTERVAL_CONFIG_KEY),
+            (self.service.memory_gauge, MEMORY_GAUGE_INTERVAL_CONFIG_KEY),
+            (self.service.wait_gauge, MEMORY_GAUGE_INTERVAL_CONFIG_KEY),
+            (self.service.status_gauge, MEMORY_GAUGE_INTERVAL_CONFIG_KEY),
+        ]
+
+        self._events = Queue.Queue()
+        self._slots = threading.Semaphore(concurrency)
+        self._condition = threading.Condition(threading.Lock())
+        # events dispatched but not yet handled
+        self._unfinished = 0
+
+        self._feeder = self._spawn(self._feed)
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def start_timers(self, intervals=None):
+        """Run the timers of `RepoWorker` in background threads"""
+        if intervals is None:
+            intervals = get_timer_intervals()
+        for method, config_key in self._timers:
+            self._spawn(self._repeat, method, intervals[config_key])
+
+    def _repeat(self, method, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                method()
+            except Exception:
+                _logger.exception('error running %s', method.__name__)
+
+    def dispatch(self, event):
+        if event.type not in self._handlers:
+            raise ValueError('No handler for {} events'.format(event.type))
+        with self._condition:
+            self._unfinished += 1
+        self._events.put(event)
+
+    def join(self, timeout=None):
+        """Wait until all dispatched events have been handled
+
+        Returns False if `timeout` seconds passed first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._unfinished:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+        return True
+
+    def _feed(self):
+        while True:
+            event = self._events.get()
+            self._slots.acquire()
+            queued = threading.Event()
+            if event.type not in self._per_project:
+                queued.set()
+            self._spawn(self._handle, event, queued)
+            # until the handler is in line for its project (or done)
+            queued.wait()
+
+    def _handle(self, event, queued):
+        _local_handler.queued = queued
+        try:
+            self._handlers[event.type](event.data)
+        except Exception:
+            _logger.exception('error handling %s event', event.type)
+        finally:
+            _local_handler.queued = None
+            queued.set()
+            self._slots.release()
+            with self._condition:
+                self._unfinished -= 1
+                self._condition.notify_all()
+
+
+_local_dispatcher = None
+_local_dispatcher_lock = threading.Lock()
+
+
+def get_local_dispatcher():
+    """Return the `LocalDispatcher` of this process, starting it (and the
+    worker's timers) on first use
+    """
+    global _local_dispatcher
+    with _local_dispatcher_lock:
+        if _local_dispatcher is None:
+            _local_dispatcher = LocalDispatcher(get_worker_concurrency())
+            _local_dispatcher.start_timers()
+        return _local_dispatcher
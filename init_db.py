@@ -1,2 +1,11 @@
 from cinch import db
+from cinch.jenkins.controllers import rebuild_job_sha_statuses
+from cinch.sha_index import (
+    INDEX_DATABASE, get_index_type, rebuild_pull_request_shas)
+
 db.create_all()
+# backfill statuses of builds recorded before they were maintained
+rebuild_job_sha_statuses()
+if get_index_type() == INDEX_DATABASE:
+    rebuild_pull_request_shas()
+db.session.commit()
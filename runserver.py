@@ -1,2 +1,6 @@
 from cinch import app
+from cinch.sha_index import warm_sha_index
+
+with app.app_context():
+    warm_sha_index()
 app.run(debug=True, host="0.0.0.0")
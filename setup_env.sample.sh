@@ -30,3 +30,67 @@ export CINCH_ADMIN_USERS=
 
 # URL to jenkins instance (for links to builds)
 export CINCH_JENKINS_URL=
+
+# Maximum number of merge results cached per repository (default 1000)
+# export CINCH_MERGE_CACHE_SIZE=1000
+
+# Set to use `git merge-tree --write-tree` for mergeability checks, if the
+# installed git supports it (2.38+)
+# export CINCH_MERGE_TREE_WRITE_TREE=1
+
+# Events only fetch the refs they touch. Seconds between full fetches of all
+# repositories, to reconcile anything missed (default 3600)
+# export CINCH_FULL_FETCH_INTERVAL=3600
+
+# Seconds within which repeated fetches of the same refs are skipped
+# (default 0; concurrent fetches are always merged)
+# export CINCH_FETCH_COALESCE_WINDOW=0
+
+# How new repositories are cloned under REPO_BASE_DIR. One of `full`
+# (default), `shared` (repos of the same owner share an object store) or
+# `partial` (blobs are only fetched when needed for merge checks)
+# export CINCH_CLONE_STRATEGY=full
+
+# Seconds between background maintenance (commit-graph, bitmaps, repacking)
+# of the local clones (default 3600), and how long a clone must have been
+# unused before it is maintained (default 300)
+# export CINCH_MAINTENANCE_INTERVAL=3600
+# export CINCH_MAINTENANCE_IDLE_TIME=300
+
+# How local clones are read for ref lookups and commit walks: `cat-file`
+# (persistent git processes, default) or `native` (reads pack files and refs
+# directly, without git processes)
+# export CINCH_GIT_BACKEND=cat-file
+
+# Number of events the worker handles concurrently (default 10). Events for
+# the same project are always handled one at a time, in order
+# export CINCH_WORKER_CONCURRENCY=10
+
+# Number of processes the worker runs git comparisons and merge checks in, so
+# they don't hold up its event loop (default 0, running them inline)
+# export CINCH_GIT_PROCESS_POOL_SIZE=0
+
+# Requests of the GITHUB_TOKEN rate limit the worker leaves unused when
+# posting commit statuses (default 100)
+# export CINCH_GITHUB_RATE_LIMIT_RESERVE=100
+
+# Seconds between the worker logging its memory use, how long work waited
+# for its project, and what became of the statuses it published (default
+# 300)
+# export CINCH_MEMORY_GAUGE_INTERVAL=300
+
+# Number of pull requests recomputed by each task when master moves. Tasks
+# are shared between workers, and updates of single pull requests of the
+# same project can go first in between (default 10)
+# export CINCH_RECOMPUTE_CHUNK_SIZE=10
+
+# How the web app sends events to the worker: "amqp" (default) to a separate
+# worker process via NAMEKO_AMQP_URI, or "local" to handle them in the web
+# process itself, without a broker
+# export CINCH_DISPATCHER=amqp
+
+# Where pull requests are looked up by sha when jenkins builds change:
+# "memory" (default), built on startup and then updated with the changes
+# every process logs, or "database", kept in a table that survives
+# restarts. Run init_db.py after switching to "database"
+# export CINCH_SHA_INDEX=memory
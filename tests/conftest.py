@@ -22,11 +22,14 @@ def pytest_configure(config):
 def session():
     # importing at the module level messes up coverage
     from cinch import db
+    from cinch.sha_index import sha_index_cache
 
     def drop_and_recreate_db():
         db.session.remove()  # make sure we start with a new session
         db.drop_all()
         db.create_all()
+        # otherwise kept up to date with the log of the previous database
+        sha_index_cache.clear()
 
     drop_and_recreate_db()
     return db.session
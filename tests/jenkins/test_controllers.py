@@ -1,15 +1,19 @@
 from collections import OrderedDict
 from itertools import count
 
+from flask import g
 from mock import patch
+import pytest
 from sqlalchemy import event
 from sqlalchemy.engine import Engine
 
 from cinch.models import Project, PullRequest
-from cinch.jenkins.models import Job, BuildSha
+from cinch.jenkins.models import Job, Build, BuildSha, JobShaStatus
 from cinch.jenkins.controllers import (
-    clear_g_cache, record_job_result, record_job_sha, all_open_prs,
-    get_job_sha_statuses, jenkins_check, get_or_create_build, get_prs_for_build
+    add_job_sha_status, clear_g_cache, record_job_result, record_job_sha,
+    all_open_prs, get_job_build_query, get_job_sha_statuses, jenkins_check,
+    get_or_create_build, get_prs_for_build, get_pull_request_builds,
+    pull_request_builds, rebuild_job_sha_statuses, sha_signature
 )
 
 counter = count()
@@ -35,7 +39,7 @@ class QueryCounter():
 def has_successful_builds(pull_request, job):
     clear_g_cache()
     pr_map = all_open_prs()
-    job_number = pr_map[pull_request][job]
+    job_number = pr_map[(pull_request.number, pull_request.project_id)][job]
     return (job_number is not None)
 
 
@@ -59,6 +63,12 @@ def make_pr(session, project_name, sha):
     return pull_request
 
 
+def signature(shas, *values):
+    """Test helper for the signature of `values` for the projects in `shas`
+    """
+    return sha_signature(dict(zip(shas.keys(), values)))
+
+
 def get_shas(job, shas):
     """Test helper for checking single jobs"""
     job_shas = get_job_sha_statuses({job: shas})
@@ -169,7 +179,7 @@ class TestGetSuccessfulJobShas(object):
             shas,
         )
         assert successful == {
-            ('sha1',): (1, True),
+            signature(shas, 'sha1'): (1, True),
         }
 
     def test_multi_project_job(self, fixtures):
@@ -186,7 +196,7 @@ class TestGetSuccessfulJobShas(object):
         record_job_result('app_integration', 2, True, "passed")
 
         successful = get_shas(fixtures['app_integration'].id, shas)
-        assert successful[('sha2', 'sha3')] == (2, True)
+        assert successful[signature(shas, 'sha2', 'sha3')] == (2, True)
 
     def test_multiple_builds(self, fixtures):
         library = fixtures['library']
@@ -206,8 +216,8 @@ class TestGetSuccessfulJobShas(object):
 
         successful = get_shas(fixtures['app_integration'].id, shas)
         assert successful == {
-            ('sha2', 'sha3'): (2, True),
-            ('sha4', 'sha5'): (4, True),
+            signature(shas, 'sha2', 'sha3'): (2, True),
+            signature(shas, 'sha4', 'sha5'): (4, True),
         }
 
     def test_unsuccesful_builds(self, fixtures):
@@ -228,8 +238,8 @@ class TestGetSuccessfulJobShas(object):
 
         sha_statuses = get_shas(fixtures['app_integration'].id, shas)
         assert sha_statuses == {
-            ('sha2', 'sha3'): (2, True),
-            ('sha4', 'sha5'): (4, False),
+            signature(shas, 'sha2', 'sha3'): (2, True),
+            signature(shas, 'sha4', 'sha5'): (4, False),
         }
 
     def test_other_job_ignored(self, fixtures):
@@ -251,7 +261,7 @@ class TestGetSuccessfulJobShas(object):
             },
         })
         assert successful_job_shas[library_unit.id] == {
-            ('sha1',): (1, True),
+            sha_signature({library.id: 'sha1'}): (1, True),
         }
         assert successful_job_shas[app_unit.id] == {}
 
@@ -286,10 +296,10 @@ class TestGetSuccessfulJobShas(object):
         })
         assert successful == {
             app_integration.id: {
-                ('sha2', 'sha3'): (1, True),
+                signature(shas, 'sha2', 'sha3'): (1, True),
             },
             app_integration2.id: {
-                ('sha4', 'sha5'): (1, True)
+                signature(shas, 'sha4', 'sha5'): (1, True)
             },
         }
 
@@ -341,6 +351,202 @@ class TestGetSuccessfulJobShas(object):
         assert qc.count == 2
 
 
+class TestJobShaStatuses(object):
+    @pytest.fixture
+    def shas(self, fixtures):
+        return OrderedDict([
+            (fixtures['app'].id, ''),
+            (fixtures['library'].id, ''),
+        ])
+
+    def record_build(self, build_number, app_sha, library_sha, success):
+        record_job_sha(
+            'app_integration', build_number, 'owner', 'app', app_sha)
+        record_job_sha(
+            'app_integration', build_number, 'owner', 'library', library_sha)
+        if success is not None:
+            record_job_result(
+                'app_integration', build_number, success, "passed")
+
+    def get_shas(self, fixtures):
+        return get_shas(fixtures['app_integration'].id, {})
+
+    def test_pending_build(self, fixtures, shas):
+        record_job_sha('app_integration', 1, 'owner', 'app', 'sha1')
+        # not all shas recorded yet
+        assert self.get_shas(fixtures) == {}
+
+        self.record_build(1, 'sha1', 'sha2', None)
+        assert self.get_shas(fixtures) == {
+            signature(shas, 'sha1', 'sha2'): (1, None),
+        }
+
+        record_job_result('app_integration', 1, False, "failed")
+        assert self.get_shas(fixtures) == {
+            signature(shas, 'sha1', 'sha2'): (1, False),
+        }
+
+    def test_success_preferred(self, fixtures, shas):
+        self.record_build(1, 'sha1', 'sha2', False)
+        self.record_build(2, 'sha1', 'sha2', True)
+        self.record_build(3, 'sha1', 'sha2', False)
+        self.record_build(4, 'sha1', 'sha2', None)
+        assert self.get_shas(fixtures) == {
+            signature(shas, 'sha1', 'sha2'): (2, True),
+        }
+
+        # latest success
+        self.record_build(5, 'sha1', 'sha2', True)
+        assert self.get_shas(fixtures) == {
+            signature(shas, 'sha1', 'sha2'): (5, True),
+        }
+
+    def test_demoted_build(self, fixtures, shas):
+        self.record_build(1, 'sha1', 'sha2', True)
+        self.record_build(2, 'sha1', 'sha2', True)
+
+        record_job_result('app_integration', 2, False, "failed")
+        assert self.get_shas(fixtures) == {
+            signature(shas, 'sha1', 'sha2'): (1, True),
+        }
+
+    def test_changed_sha(self, fixtures, shas):
+        self.record_build(1, 'sha1', 'sha2', True)
+        record_job_sha('app_integration', 1, 'owner', 'app', 'sha3')
+        assert self.get_shas(fixtures) == {
+            signature(shas, 'sha3', 'sha2'): (1, True),
+        }
+
+    def test_rebuild(self, session, fixtures, shas):
+        self.record_build(1, 'sha1', 'sha2', True)
+        self.record_build(2, 'sha1', 'sha2', False)
+        self.record_build(3, 'sha3', 'sha2', None)
+        maintained = self.get_shas(fixtures)
+
+        session.query(JobShaStatus).delete()
+        rebuild_job_sha_statuses()
+        session.commit()
+        assert self.get_shas(fixtures) == maintained
+
+    def test_added_concurrently(self, session, fixtures, shas):
+        job_id = fixtures['app_integration'].id
+        key = signature(shas, 'sha1', 'sha2')
+        self.record_build(1, 'sha1', 'sha2', True)
+
+        assert add_job_sha_status(job_id, key, 2, False) is None
+        session.commit()
+        assert self.get_shas(fixtures) == {key: (1, True)}
+
+    def test_update_added_concurrently(self, session, fixtures, shas):
+        table = JobShaStatus.__table__
+
+        def add_concurrently(job_id, signature, build_number, success):
+            # another build's status is added between our read and insert
+            session.execute(table.insert().values(
+                job_id=job_id, signature=signature,
+                build_number=1, success=True,
+            ))
+            return add_job_sha_status(
+                job_id, signature, build_number, success)
+
+        with patch('cinch.jenkins.controllers.add_job_sha_status',
+                   side_effect=add_concurrently):
+            self.record_build(2, 'sha1', 'sha2', False)
+        session.commit()
+        assert self.get_shas(fixtures) == {
+            signature(shas, 'sha1', 'sha2'): (1, True),
+        }
+
+
+class TestCandidateShas(object):
+    @pytest.fixture(autouse=True)
+    def builds(self, fixtures):
+        for build_number in range(5):
+            record_job_sha(
+                'app_integration', build_number, 'owner', 'app',
+                'app{}'.format(build_number))
+            record_job_sha(
+                'app_integration', build_number, 'owner', 'library',
+                'library')
+            record_job_result('app_integration', build_number, True, "passed")
+
+    def test_build_query(self, fixtures):
+        project_ids = [fixtures['app'].id, fixtures['library'].id]
+        query, sha_columns = get_job_build_query(
+            fixtures['app_integration'].id, project_ids, {
+                fixtures['app'].id: ['app1', 'app3', 'unknown'],
+            })
+        results = query.values(Build.build_number, *sha_columns)
+        assert sorted(results) == [
+            (1, 'app1', 'library'),
+            (3, 'app3', 'library'),
+        ]
+
+    def test_statuses(self, fixtures):
+        app_integration_id = fixtures['app_integration'].id
+        app_unit_id = fixtures['app_unit'].id
+        shas = OrderedDict([
+            (fixtures['app'].id, ''),
+            (fixtures['library'].id, ''),
+        ])
+        wanted = signature(shas, 'app2', 'library')
+
+        with QueryCounter() as qc:
+            statuses = get_job_sha_statuses(
+                {app_integration_id: shas, app_unit_id: shas},
+                {app_integration_id: {wanted, 'unknown'}, app_unit_id: []},
+            )
+        assert statuses == {
+            app_integration_id: {wanted: (2, True)},
+            app_unit_id: {},
+        }
+        # nothing to look up for app_unit
+        assert qc.count == 1
+
+    def test_all_open_prs(self, session, fixtures, app_context):
+        set_master(session, 'library', 'library')
+        pr = make_pr(session, 'app', 'app3')
+
+        clear_g_cache()
+        pr_map = all_open_prs()
+        pr_builds = pr_map[(pr.number, pr.project_id)]
+        assert pr_builds[fixtures['app_integration'].id] == (3, True)
+        assert pr_builds[fixtures['app_unit'].id] == (None, None)
+
+    def test_pull_request_builds(self, session, fixtures, app_context):
+        set_master(session, 'library', 'library')
+        pr = make_pr(session, 'app', 'app3')
+        closed = make_pr(session, 'app', 'app1')
+        closed.is_open = False
+        session.commit()
+        app_integration_id = fixtures['app_integration'].id
+        app_unit_id = fixtures['app_unit'].id
+
+        clear_g_cache()
+        pr.project.jobs, closed.project.jobs  # loaded
+        with QueryCounter() as qc:
+            pr_map = get_pull_request_builds([pr, closed])
+        # the jobs of app, and a status lookup for each
+        assert qc.count == 3
+        assert pr_map == {
+            (pr.number, pr.project_id): {
+                app_integration_id: (3, True),
+                app_unit_id: (None, None),
+            },
+            (closed.number, closed.project_id): {
+                app_integration_id: (1, True),
+                app_unit_id: (None, None),
+            },
+        }
+
+        key = (pr.number, pr.project_id)
+        assert pull_request_builds(pr) == all_open_prs()[key]
+        # already read for all open pull requests
+        with QueryCounter() as qc:
+            pull_request_builds(pr)
+        assert qc.count == 0
+
+
 def build_check(session, project_name, sha):
     clear_g_cache()
     pr = make_pr(session, project_name, sha)
@@ -408,3 +614,27 @@ def test_multiple_builds_for_same_job_and_sha(session, app_context):
     record_job_result('job', 2, False, "passed")
 
     assert build_check(session, 'project', sha)
+
+
+def test_open_prs_shared_between_requests(session, fixtures, app_context):
+    set_master(session, 'library', 'library')
+    pr = make_pr(session, 'app', 'app1')
+    key = (pr.number, pr.project_id)
+    app_integration_id = fixtures['app_integration'].id
+
+    clear_g_cache()
+    assert all_open_prs()[key][app_integration_id] == (None, None)
+
+    # a new request
+    getattr(g, '_cache').clear()
+    with QueryCounter() as qc:
+        all_open_prs()
+    # just the version check
+    assert qc.count == 1
+
+    record_job_sha('app_integration', 1, 'owner', 'app', 'app1')
+    record_job_sha('app_integration', 1, 'owner', 'library', 'library')
+    record_job_result('app_integration', 1, True, "passed")
+
+    getattr(g, '_cache').clear()
+    assert all_open_prs()[key][app_integration_id] == (1, True)
@@ -220,3 +220,20 @@ def test_statuses(session, fixtures, app_context):
     # failed
     record_job_result('library_unit', 1, False, "")
     assert job_status(app_context, pull_request, 'library_unit') is False
+
+
+def test_closed_pull_request_view(fixtures, app_context):
+    pull_request = PullRequest(
+        is_open=False,
+        number=1,
+        project=fixtures['library'],
+        head='sha1',
+        owner='',
+        title='',
+    )
+    db.session.add(pull_request)
+    db.session.commit()
+
+    record_job_sha('library_unit', 1, 'owner', 'library', 'sha1')
+    record_job_result('library_unit', 1, True, "")
+    assert job_status(app_context, pull_request, 'library_unit') is True
@@ -0,0 +1,67 @@
+from cinch import db
+from cinch.cache import VersionedCache, bump_version, get_version
+
+
+def make_cache(name='test'):
+    values = []
+
+    def compute():
+        values.append(len(values))
+        return values[-1]
+
+    return VersionedCache(name, compute)
+
+
+def test_bump_version(session):
+    assert get_version('test') is None
+    first = bump_version('test')
+    session.commit()
+    assert get_version('test') == first
+
+    second = bump_version('test')
+    session.commit()
+    assert second != first
+    assert get_version('test') == second
+
+
+def test_reused_until_version_changes(session):
+    cache = make_cache()
+    assert cache.get() == 0
+    assert cache.get() == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    bump_version('test')
+    db.session.commit()
+    assert cache.get() == 1
+    assert cache.get() == 1
+
+    # other names don't affect it
+    bump_version('other')
+    db.session.commit()
+    assert cache.get() == 1
+
+
+
+def test_refreshed(session):
+    refreshed = []
+
+    def refresh(value):
+        refreshed.append(value)
+        # can't the second time
+        if len(refreshed) == 1:
+            return value + 10
+
+    cache = make_cache()
+    cache.refresh = refresh
+    assert cache.get() == 0
+
+    bump_version('test')
+    db.session.commit()
+    assert cache.get() == 10
+    assert cache.misses == 1
+
+    bump_version('test')
+    db.session.commit()
+    assert cache.get() == 1
+    assert refreshed == [0, 10]
+    assert cache.misses == 2
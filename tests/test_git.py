@@ -1,18 +1,29 @@
+import os
+import pickle
+import subprocess
+import shutil
+import threading
+import time
+
 from mock import patch
 import pytest
 
 from cinch import app
-from cinch import git
+from cinch import git as git_module
 from cinch.git import Repo
 
 pytestmark = pytest.mark.slow
 
 
-@pytest.yield_fixture(scope='module')
+@pytest.yield_fixture(scope='module', params=sorted(git_module.BACKENDS))
 def tmp_base_dir(request):
     # builtin tmpdir fixture is function scoped :(
     tmpdir = request.config._tmpdirhandler.mktemp('cinch_repos')
-    with patch.object(app, 'config', {'REPO_BASE_DIR': tmpdir.strpath}):
+    config = {
+        'REPO_BASE_DIR': tmpdir.strpath,
+        'GIT_BACKEND': request.param,
+    }
+    with patch.object(app, 'config', config):
         yield
     tmpdir.remove()
 
@@ -20,7 +31,8 @@ def tmp_base_dir(request):
 @pytest.fixture(scope='module')
 def repo(tmp_base_dir):
     public_url_template = "https://github.com/{}/{}.git"
-    with patch.object(git, 'GITHUB_URL_TEMPLATE', public_url_template):
+    with patch.object(
+            git_module, 'GITHUB_URL_TEMPLATE', public_url_template):
         repo = Repo.setup_repo('onefinestay', 'cinch')
     return repo
 
@@ -48,3 +60,725 @@ def test_merge_head(repo):
     # can't reliably test the result of this, but at least calling it shouldn't
     # raise any exceptions
     repo.merge_head(1)
+
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'cinch',
+    'GIT_AUTHOR_EMAIL': 'cinch@example.com',
+    'GIT_COMMITTER_NAME': 'cinch',
+    'GIT_COMMITTER_EMAIL': 'cinch@example.com',
+}
+
+
+def git(cwd, *args):
+    env = dict(os.environ, **GIT_ENV)
+    return subprocess.check_output(('git',) + args, cwd=cwd, env=env).strip()
+
+
+def commit(cwd, filename, content):
+    with open(os.path.join(cwd, filename), 'w') as handle:
+        handle.write(content)
+    git(cwd, 'add', filename)
+    git(cwd, 'commit', '-q', '-m', '{}: {}'.format(filename, content))
+    return git(cwd, 'rev-parse', 'HEAD')
+
+
+@pytest.yield_fixture(scope='module')
+def upstream(request):
+    """A local stand-in for a github repo
+
+    master has three commits. Pull request 1 branches from the first and
+    adds two commits touching another file. Pull request 2 conflicts with
+    master.
+    """
+    tmpdir = request.config._tmpdirhandler.mktemp('upstream')
+    path = tmpdir.join('owner', 'project').strpath
+    os.makedirs(path)
+
+    git(path, 'init', '-q')
+    git(path, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+    commit(path, 'README', 'one')
+    git(path, 'checkout', '-q', '-b', 'feature')
+    commit(path, 'feature', 'one')
+    commit(path, 'feature', 'two')
+    git(path, 'checkout', '-q', 'master')
+    git(path, 'checkout', '-q', '-b', 'conflict')
+    commit(path, 'README', 'conflict')
+    git(path, 'checkout', '-q', 'master')
+    commit(path, 'README', 'two')
+    commit(path, 'README', 'three')
+
+    git(path, 'update-ref', 'refs/pull/1/head', 'feature')
+    git(path, 'update-ref', 'refs/pull/2/head', 'conflict')
+    git(path, 'checkout', '-q', '-b', 'merge1', 'master')
+    git(path, 'merge', '-q', '--no-edit', 'feature')
+    git(path, 'update-ref', 'refs/pull/1/merge', 'merge1')
+    git(path, 'checkout', '-q', 'master')
+
+    url_template = os.path.join(tmpdir.strpath, '{}', '{}')
+    with patch.object(git_module, 'GITHUB_URL_TEMPLATE', url_template):
+        yield path
+    tmpdir.remove()
+
+
+@pytest.yield_fixture(scope='module')
+def local_repo(tmp_base_dir, upstream):
+    repo = Repo.setup_repo('owner', 'project')
+    yield repo
+    git_module.close_backends()
+
+
+def test_local_compare(local_repo):
+    assert local_repo.compare_pr(1) == (2, 2)
+    assert local_repo.compare_pr(2) == (2, 1)
+    assert local_repo.compare('origin/master', 'pr_head/1') == 2
+
+
+def test_local_compare_matches_rev_list(local_repo):
+    for base, branch in [
+        ('pr_head/1', 'origin/master'),
+        ('pr_merge/1', 'origin/master'),
+        ('origin/master', 'pr_merge/1'),
+        ('pr_head/2', 'pr_head/1'),
+    ]:
+        expected = local_repo.cmd(
+            ['rev-list', '--count', '{}..{}'.format(base, branch)])
+        assert local_repo.compare(base, branch) == int(expected)
+
+
+def test_local_merge_head(local_repo, upstream):
+    assert local_repo.merge_head(1) == git(upstream, 'rev-parse', 'merge1')
+    assert local_repo.merge_head(2) is None
+
+
+def test_ref_snapshot(local_repo, upstream):
+    refs = local_repo.ref_snapshot()
+    assert refs['origin/master'] == git(upstream, 'rev-parse', 'master')
+    assert refs['pr_head/1'] == git(upstream, 'rev-parse', 'feature')
+    assert refs['pr_merge/1'] == git(upstream, 'rev-parse', 'merge1')
+    assert 'pr_merge/2' not in refs
+    for name in refs:
+        assert local_repo.backend.resolve(name) == refs[name]
+
+    with pytest.raises(TypeError):
+        refs['origin/master'] = None
+
+
+def test_ref_snapshot_reused_until_fetch(local_repo, upstream):
+    local_repo.backend.invalidate_refs()
+    with patch.object(
+            git_module.subprocess, 'check_output',
+            wraps=git_module.subprocess.check_output) as check_output:
+        refs = local_repo.ref_snapshot()
+        local_repo.compare_prs([1, 2])
+        local_repo.compare_pr(2)
+        local_repo.is_mergeable(1)
+        local_repo.merge_head(1)
+    for_each_refs = [
+        args for args, _ in check_output.call_args_list
+        if 'for-each-ref' in args[0]
+    ]
+    assert len(for_each_refs) <= 1
+    assert local_repo.ref_snapshot() is refs
+
+    local_repo.fetch_master([1])
+    new_refs = local_repo.ref_snapshot()
+    assert new_refs is not refs
+    assert new_refs == refs
+
+
+def test_repo_and_snapshot_picklable(local_repo):
+    # for use with `cinch.pool`
+    refs = local_repo.ref_snapshot()
+    assert pickle.loads(pickle.dumps(refs)) == refs
+    repo = pickle.loads(pickle.dumps(local_repo))
+    assert repo.path == local_repo.path
+    assert repo.compare_pr(1, refs=refs) == (2, 2)
+
+
+def test_ref_snapshot_packed_refs(local_repo):
+    expected = dict(local_repo.ref_snapshot())
+    local_repo.cmd(['pack-refs', '--all'])
+    local_repo.backend.invalidate_refs()
+    assert dict(local_repo.ref_snapshot()) == expected
+
+
+def test_is_repo(local_repo, tmp_base_dir):
+    assert local_repo.is_repo()
+    assert not Repo.from_local_repo('owner', 'missing').is_repo()
+
+
+def test_backend_reuses_processes(local_repo):
+    local_repo.compare_pr(1)
+    with patch.object(git_module.subprocess, 'Popen') as popen:
+        assert local_repo.is_repo()
+        local_repo.compare_pr(1)
+        local_repo.merge_head(1)
+    assert popen.call_count == 0
+
+
+def test_compare_pr_loads_history(local_repo):
+    backend = local_repo.backend
+    backend.master_counts.clear()
+    refs = local_repo.ref_snapshot()
+    with patch.object(
+            backend, 'load_history', wraps=backend.load_history) as load:
+        assert local_repo.compare_pr(1) == (2, 2)
+    load.assert_called_once_with([refs['origin/master'], refs['pr_head/1']])
+
+
+def test_backend_restarts_dead_process(local_repo):
+    backend = local_repo.backend
+    if not isinstance(backend, git_module.CatFileBackend):
+        pytest.skip('no processes to restart')
+    assert local_repo.is_repo()
+
+    process = backend._check._process
+    starts = backend._check.starts
+    process.kill()
+    process.wait()
+
+    assert backend.resolve('pr_merge/1') is not None
+    assert backend._check._process is not process
+    assert backend._check.starts == starts + 1
+
+
+def test_compare_prs(local_repo):
+    assert local_repo.compare_prs([1, 2, -1]) == {
+        1: (2, 2),
+        2: (2, 1),
+        -1: (None, None),
+    }
+    assert local_repo.compare_prs([]) == {}
+
+
+def test_compare_prs_uses_single_rev_list(local_repo):
+    # fresh backend, with nothing cached
+    backend = git_module.CatFileBackend(local_repo.path)
+    repo = local_repo
+    try:
+        with patch.object(Repo, 'backend', backend):
+            with patch.object(
+                    git_module.subprocess, 'Popen',
+                    wraps=git_module.subprocess.Popen) as popen:
+                assert repo.compare_prs([1, 2]) == {1: (2, 2), 2: (2, 1)}
+                rev_lists = [
+                    args for args, _ in popen.call_args_list
+                    if 'rev-list' in args[0]
+                ]
+                assert len(rev_lists) == 1
+
+                # history is cached; nothing more to load
+                repo.compare_prs([1, 2])
+                rev_lists = [
+                    args for args, _ in popen.call_args_list
+                    if 'rev-list' in args[0]
+                ]
+                assert len(rev_lists) == 1
+    finally:
+        backend.close()
+
+
+def test_counts_after_fast_forward(tmp_base_dir, tmpdir):
+    path = tmpdir.strpath
+    git(path, 'init', '-q')
+    commit(path, 'base', '1')
+    git(path, 'checkout', '-q', '-b', 'a')
+    commit(path, 'a', '1')
+    tip_a = commit(path, 'a', '2')
+    git(path, 'checkout', '-q', '-b', 'b', 'master')
+    tip_b = commit(path, 'b', '1')
+    git(path, 'checkout', '-q', 'master')
+    old = commit(path, 'master', '2')
+    git(path, 'merge', '-q', '--no-ff', '-m', 'merge a', 'a')
+    new = commit(path, 'master', '3')
+
+    repo = Repo(os.path.join(path, '.git'))
+    backend = repo.backend
+    tips = [tip_a, tip_b]
+    expected = [
+        int(git(path, 'rev-list', '--count', new, '^' + old, '^' + tip))
+        for tip in tips
+    ]
+    assert expected == [2, 4]
+    assert backend.count_new_many(old, new, tips) == (4, expected)
+    assert backend.count_new_many(new, old, tips) is None
+
+    # counted separately, e.g. in chunks
+    old_counts = repo._update_master_counts(old, [tip_a])
+    old_counts.update(repo._update_master_counts(old, [tip_b]))
+    with patch.object(backend, 'count_exclusive_many') as count:
+        new_counts = repo._update_master_counts(new, tips)
+    assert count.call_count == 0
+    assert new_counts == {
+        tip: counts for tip, counts in zip(
+            tips, backend.count_exclusive_many(new, tips))
+    }
+    assert new_counts != old_counts
+
+    # not a fast forward; counted from scratch
+    assert repo._update_master_counts(old, tips) == old_counts
+
+
+def test_merge_conflicts(local_repo):
+    master = local_repo.backend.resolve('origin/master')
+    pr_head = local_repo.backend.resolve('pr_head/2')
+    merge_base = local_repo.cmd(['merge-base', master, pr_head])
+    assert local_repo.merge_conflicts(merge_base, pr_head, master) == {
+        'README'}
+
+
+def test_is_mergeable_local(local_repo):
+    assert local_repo.is_mergeable(1) is True
+    assert local_repo.is_mergeable(2) is False
+    assert local_repo.is_mergeable(-1) is None
+
+
+def test_is_mergeable_cached(local_repo):
+    local_repo.is_mergeable(2)
+    with patch.object(Repo, 'merge_conflicts') as merge_conflicts:
+        assert local_repo.is_mergeable(2) is False
+    assert merge_conflicts.call_count == 0
+
+
+def test_is_mergeable_skips_unrelated_master_move(local_repo, tmpdir):
+    backend = local_repo.backend
+    master = backend.resolve('origin/master')
+    previous_master = backend.resolve('origin/master^')
+    pr_head = backend.resolve('pr_head/2')
+    merge_base = local_repo.cmd(['merge-base', master, pr_head])
+
+    with patch.object(backend, 'merge_cache', git_module.MergeCache(
+            tmpdir.join('cache.json').strpath)) as cache:
+        # conflicted on a path master hasn't touched since
+        cache.set(merge_base, pr_head, previous_master, False, ['other'])
+        with patch.object(Repo, 'merge_conflicts') as merge_conflicts:
+            assert local_repo.is_mergeable(2) is False
+        assert merge_conflicts.call_count == 0
+        assert cache.get(merge_base, pr_head, master) == (False, ['other'])
+
+    with patch.object(backend, 'merge_cache', git_module.MergeCache(
+            tmpdir.join('cache.json').strpath)) as cache:
+        # master changed the conflicting path; need to merge again
+        cache.set(merge_base, pr_head, previous_master, False, ['README'])
+        assert local_repo.is_mergeable(2) is False
+        assert cache.get(merge_base, pr_head, master) == (False, ['README'])
+
+
+def test_merge_cache_lru(tmpdir):
+    filename = tmpdir.join('cache.json').strpath
+    cache = git_module.MergeCache(filename, max_size=2)
+    cache.set('base', 'a', 'master', True, [])
+    cache.set('base', 'b', 'master', False, ['foo'])
+    assert cache.get('base', 'a', 'master') == (True, [])
+
+    # evicts b, the least recently used
+    cache.set('base', 'c', 'master', True, [])
+    assert len(cache) == 2
+    assert cache.get('base', 'b', 'master') is None
+    cache.save()
+
+    reloaded = git_module.MergeCache(filename, max_size=2)
+    assert reloaded.get('base', 'a', 'master') == (True, [])
+    assert reloaded.get('base', 'c', 'master') == (True, [])
+    assert reloaded.find_previous('base', 'c') == ('master', True, [])
+
+
+def test_merge_conflicts_write_tree(local_repo):
+    if git_module.git_version() < git_module.WRITE_TREE_MIN_VERSION:
+        pytest.skip('git too old for merge-tree --write-tree')
+
+    master = local_repo.backend.resolve('origin/master')
+    with patch.dict(app.config, {'MERGE_TREE_WRITE_TREE': '1'}):
+        with patch.object(Repo, '_merge_tree_conflicts') as merge_tree:
+            for number, expected in [(1, set()), (2, {'README'})]:
+                pr_head = local_repo.backend.resolve(
+                    'pr_head/{}'.format(number))
+                merge_base = local_repo.cmd(['merge-base', master, pr_head])
+                assert local_repo.merge_conflicts(
+                    merge_base, pr_head, master) == expected
+    assert merge_tree.call_count == 0
+
+
+def test_merge_tree_stops_at_first_conflict(local_repo):
+    lines = [
+        'changed in both\n',
+        '  base   100644 {} README\n'.format('a' * 40),
+        '  our    100644 {} README\n'.format('b' * 40),
+        '  their  100644 {} README\n'.format('c' * 40),
+        '@@ -1 +1,5 @@\n',
+    ] + ['+diff\n'] * 1000 + ['']
+
+    with patch.object(git_module.subprocess, 'Popen') as popen:
+        process = popen.return_value
+        process.stdout.readline.side_effect = lines
+        process.poll.return_value = None
+
+        assert local_repo.merge_conflicts('base', 'head', 'master') == {
+            'README'}
+
+    assert process.stdout.readline.call_count == 5
+    assert process.kill.call_count == 1
+
+
+def test_merge_tree_failure(local_repo, tmpdir):
+    master = local_repo.backend.resolve('origin/master')
+    missing = '0' * 40
+    with pytest.raises(git_module.GitProcessError):
+        local_repo.merge_conflicts(master, missing, master)
+
+    backend = local_repo.backend
+    with patch.object(backend, 'merge_cache', git_module.MergeCache(
+            tmpdir.join('cache.json').strpath)) as cache:
+        with patch.object(Repo, 'cmd') as cmd:
+            cmd.return_value = master  # the merge base
+            refs = {'origin/master': master, 'pr_head/1': missing}
+            with pytest.raises(git_module.GitProcessError):
+                local_repo.is_mergeable(1, refs=refs)
+        # never cached as mergeable
+        assert len(cache) == 0
+
+
+@pytest.mark.parametrize('value,expected', [
+    (None, False),
+    ('', False),
+    ('0', False),
+    ('false', False),
+    ('1', True),
+    ('yes', True),
+])
+def test_config_flag(value, expected):
+    config = {} if value is None else {'FLAG': value}
+    with patch.object(app, 'config', config):
+        assert git_module.config_flag('FLAG') is expected
+
+
+def test_fetch_pull_request(local_repo, upstream):
+    git(upstream, 'update-ref', 'refs/pull/3/head', 'feature')
+    try:
+        assert local_repo.backend.resolve('pr_head/3') is None
+
+        with patch.object(Repo, 'cmd', wraps=local_repo.cmd) as cmd:
+            # no merge ref upstream; should still fetch the head
+            local_repo.fetch_pull_request(3)
+        (args,), kwargs = cmd.call_args
+        assert args[:2] == ['fetch', 'origin']
+        assert '--all' not in args
+
+        assert local_repo.backend.resolve('pr_head/3') == git(
+            upstream, 'rev-parse', 'feature')
+        assert local_repo.merge_head(3) is None
+    finally:
+        git(upstream, 'update-ref', '-d', 'refs/pull/3/head')
+
+
+def test_fetch_master(local_repo, upstream):
+    with patch.object(Repo, 'cmd', wraps=local_repo.cmd) as cmd:
+        local_repo.fetch_master([1, 2])
+    (args,), kwargs = cmd.call_args
+    assert args == [
+        'fetch', 'origin',
+        git_module.MASTER_REFSPEC,
+        git_module.PULL_REQUEST_MERGE_REFSPEC.format(1),
+        git_module.PULL_REQUEST_MERGE_REFSPEC.format(2),
+    ]
+    assert local_repo.backend.resolve('origin/master') == git(
+        upstream, 'rev-parse', 'master')
+
+
+def test_fetch_master_known_sha(local_repo, upstream):
+    master = git(upstream, 'rev-parse', 'master')
+    local_repo.fetch_master([1])
+    with patch.object(Repo, '_fetch') as fetch:
+        # the merge head of 1 was fetched with master
+        local_repo.fetch_master([1, 2], sha=master)
+    fetch.assert_called_once_with(
+        [git_module.PULL_REQUEST_MERGE_REFSPEC.format(2)])
+
+    with patch.object(Repo, '_fetch') as fetch:
+        local_repo.fetch_master([1], sha='unknown')
+    fetch.assert_called_once_with([
+        git_module.MASTER_REFSPEC,
+        git_module.PULL_REQUEST_MERGE_REFSPEC.format(1),
+    ])
+
+
+class FakeFetchRepo(object):
+    def __init__(self):
+        self.fetched = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def _fetch(self, refspecs):
+        self.fetched.append(refspecs)
+        self.started.set()
+        self.release.wait(5)
+
+
+def test_fetch_coordinator_window():
+    repo = FakeFetchRepo()
+    coordinator = git_module.FetchCoordinator(window=60)
+    coordinator.fetch(repo, ['a:refs/a', 'b:refs/b'])
+    coordinator.fetch(repo, ['a:refs/a'])
+    coordinator.fetch(repo, ['b:refs/b', 'c:refs/c'])
+
+    assert repo.fetched == [['a:refs/a', 'b:refs/b'], ['c:refs/c']]
+    assert coordinator.coalesced == 1
+
+    # a full fetch satisfies requests for anything
+    coordinator = git_module.FetchCoordinator(window=60)
+    coordinator.fetch(repo)
+    coordinator.fetch(repo, ['d:refs/d'])
+    assert repo.fetched[-1] is None
+    assert coordinator.fetches == 1
+
+
+def test_fetch_coordinator_merges_concurrent_requests():
+    repo = FakeFetchRepo()
+    repo.release.clear()
+    coordinator = git_module.FetchCoordinator()
+
+    first = threading.Thread(
+        target=coordinator.fetch, args=(repo, ['a:refs/a']))
+    first.start()
+    assert repo.started.wait(5)
+
+    # these queue up behind the running fetch, and are merged into one
+    waiting = [
+        threading.Thread(target=coordinator.fetch, args=(repo, [refspec]))
+        for refspec in ['b:refs/b', 'c:refs/c', 'b:refs/b']
+    ]
+    for thread in waiting:
+        thread.start()
+    time.sleep(0.1)
+    repo.release.set()
+
+    for thread in [first] + waiting:
+        thread.join(5)
+
+    assert repo.fetched == [['a:refs/a'], ['b:refs/b', 'c:refs/c']]
+    assert coordinator.fetches == 2
+    assert coordinator.coalesced == 2
+
+
+def test_fetch_pull_request_skips_known_head(local_repo, upstream):
+    head = git(upstream, 'rev-parse', 'refs/pull/1/head')
+    master = git(upstream, 'rev-parse', 'master')
+    local_repo.fetch_master([1])
+    with patch.object(Repo, '_fetch') as fetch:
+        local_repo.fetch_pull_request(1, head=head)
+        local_repo.fetch_master(sha=master)
+    assert fetch.call_count == 0
+
+    # the merge head moves with master
+    local_repo.fetch_master()
+    with patch.object(Repo, '_fetch') as fetch:
+        local_repo.fetch_pull_request(1, head=head)
+    fetch.assert_called_once_with(
+        [git_module.PULL_REQUEST_MERGE_REFSPEC.format(1)])
+
+    with patch.object(Repo, '_fetch') as fetch:
+        local_repo.fetch_pull_request(1, head='unknown')
+    assert fetch.call_count == 1
+
+
+def test_fetch_pull_requests(local_repo, upstream):
+    head = git(upstream, 'rev-parse', 'refs/pull/1/head')
+    local_repo.fetch_master([1])
+    with patch.object(Repo, '_fetch') as fetch:
+        local_repo.fetch_pull_requests({1: head, 2: 'unknown'})
+    # only the unknown one, in a single fetch
+    (refspecs,), _ = fetch.call_args
+    assert refspecs == [
+        git_module.PULL_REQUEST_HEAD_REFSPEC.format(2),
+        git_module.PULL_REQUEST_MERGE_REFSPEC.format(2),
+    ]
+
+
+@pytest.yield_fixture
+def file_url_upstream(upstream):
+    """Clone over file:// so local clones don't copy or hardlink objects"""
+    git(upstream, 'config', 'uploadpack.allowfilter', 'true')
+    url_template = 'file://' + git_module.GITHUB_URL_TEMPLATE
+    with patch.object(git_module, 'GITHUB_URL_TEMPLATE', url_template):
+        yield upstream
+
+
+def test_setup_repo_shared(tmpdir, file_url_upstream):
+    # a second project sharing history with the first (e.g. a fork)
+    os.symlink(
+        file_url_upstream,
+        os.path.join(os.path.dirname(file_url_upstream), 'fork'))
+
+    config = {
+        'REPO_BASE_DIR': tmpdir.strpath,
+        'CLONE_STRATEGY': git_module.CLONE_SHARED,
+    }
+    with patch.object(app, 'config', config):
+        repo = Repo.setup_repo('owner', 'project')
+        fork = Repo.setup_repo('owner', 'fork')
+
+    shared_objects = tmpdir.join(
+        'owner', git_module.SHARED_STORE_NAME, 'objects').strpath
+    for clone in (repo, fork):
+        alternates = os.path.join(clone.path, 'objects', 'info', 'alternates')
+        with open(alternates) as handle:
+            assert handle.read().strip() == shared_objects
+        assert 'count: 0' in clone.cmd(['count-objects', '-v'])
+
+    assert fork.compare_prs([1, 2]) == {1: (2, 2), 2: (2, 1)}
+    assert fork.is_mergeable(2) is False
+
+
+def test_setup_repo_partial(tmpdir, file_url_upstream):
+    config = {
+        'REPO_BASE_DIR': tmpdir.strpath,
+        'CLONE_STRATEGY': git_module.CLONE_PARTIAL,
+    }
+    with patch.object(app, 'config', config):
+        repo = Repo.setup_repo('owner', 'project')
+
+    assert repo.cmd(['config', 'remote.origin.promisor']) == 'true'
+    assert repo.cmd(['config', 'remote.pr_head.partialclonefilter']) == (
+        git_module.PARTIAL_CLONE_FILTER)
+    assert repo.compare_prs([1, 2]) == {1: (2, 2), 2: (2, 1)}
+    # blobs are fetched on demand
+    assert repo.is_mergeable(1) is True
+    assert repo.is_mergeable(2) is False
+
+
+def test_setup_repo_unknown_strategy(tmpdir):
+    config = {
+        'REPO_BASE_DIR': tmpdir.strpath,
+        'CLONE_STRATEGY': 'foo',
+    }
+    with patch.object(app, 'config', config):
+        with pytest.raises(RuntimeError):
+            Repo.setup_repo('owner', 'project')
+
+
+def test_maintain(local_repo):
+    assert not local_repo.is_idle(60)
+    stats = local_repo.maintain()
+
+    assert set(stats) == {'finished', 'duration', 'walk_before', 'walk_after'}
+    assert local_repo.backend.maintenance_stats == stats
+    objects = os.path.join(local_repo.path, 'objects')
+    assert os.path.exists(os.path.join(objects, 'info', 'commit-graph'))
+    assert any(
+        filename.endswith('.bitmap')
+        for filename in os.listdir(os.path.join(objects, 'pack'))
+    )
+    # still works
+    assert local_repo.compare_prs([1, 2]) == {1: (2, 2), 2: (2, 1)}
+
+
+def test_maintain_already_running(local_repo):
+    with local_repo.backend.maintenance_lock:
+        assert local_repo.maintain() is None
+
+
+@pytest.yield_fixture
+def force_pushed_repo(tmp_base_dir, file_url_upstream):
+    """A clone of a copy of `upstream`, whose pull request 1 is then force
+    pushed, leaving its old (packed) head unreachable
+    """
+    upstream = file_url_upstream
+    owner_dir = os.path.join(
+        os.path.dirname(os.path.dirname(upstream)), 'force_pushed')
+    path = os.path.join(owner_dir, 'project')
+    git(upstream, 'clone', '-q', '--mirror', upstream, path)
+    try:
+        # the old head is only referenced by the pull request
+        git(path, 'update-ref', '-d', 'refs/heads/feature')
+        git(path, 'update-ref', '-d', 'refs/heads/merge1')
+
+        repo = Repo.setup_repo('force_pushed', 'project')
+        repo.maintain()
+        assert repo.compare_prs([1]) == {1: (2, 2)}
+
+        tree = git(path, 'rev-parse', 'refs/pull/1/head^{tree}')
+        new_head = git(path, 'commit-tree', tree, '-p', 'master', '-m', 'new')
+        git(path, 'update-ref', 'refs/pull/1/head', new_head)
+        # fast forward, so the merge is the head itself
+        git(path, 'update-ref', 'refs/pull/1/merge', new_head)
+        repo.fetch()
+        yield repo
+    finally:
+        git_module.close_backends()
+        shutil.rmtree(owner_dir)
+
+
+def test_maintain_after_force_push(force_pushed_repo):
+    force_pushed_repo.maintain()
+    assert force_pushed_repo.compare_prs([1]) == {1: (0, 1)}
+    assert force_pushed_repo.compare_prs([1, 2]) == {1: (0, 1), 2: (2, 1)}
+
+
+@pytest.yield_fixture
+def no_commit_graph():
+    """Walk as if maintenance hadn't written a commit graph yet"""
+    with patch.object(git_module.GitBackend, 'refresh_commit_graph'):
+        yield
+
+
+def test_load_history_missing_tip(local_repo, no_commit_graph):
+    backend = git_module.CatFileBackend(local_repo.path)
+    master = backend.resolve('origin/master')
+    pr_head = backend.resolve('pr_head/1')
+
+    # e.g. removed by gc since it was loaded
+    backend._loaded['0' * 40] = True
+    backend.load_history([master, pr_head])
+    assert backend.count_exclusive(master, pr_head) == (2, 2)
+    backend.close()
+
+
+def test_load_history_keeps_latest_tips(local_repo, no_commit_graph):
+    backend = git_module.CatFileBackend(local_repo.path)
+    master = backend.resolve('origin/master')
+    pr_head = backend.resolve('pr_head/1')
+    conflict = backend.resolve('pr_head/2')
+
+    with patch.object(backend, 'MAX_LOADED_TIPS', 2):
+        backend.load_history([master])
+        backend.load_history([pr_head])
+        backend.load_history([conflict])
+    assert list(backend._loaded) == [pr_head, conflict]
+    backend.close()
+
+
+def test_history_cache_bounded(local_repo, no_commit_graph):
+    backend = git_module.CatFileBackend(local_repo.path)
+    master = backend.resolve('origin/master')
+    pr_head = backend.resolve('pr_head/1')
+
+    backend.load_history([master, pr_head])
+    assert backend.count_exclusive(master, pr_head) == (2, 2)
+    assert backend._parents
+
+    with patch.object(backend, 'MAX_CACHED_COMMITS', 1):
+        assert backend.count_exclusive(master, pr_head) == (2, 2)
+    assert not backend._parents
+    assert not backend._generations
+    assert not backend._loaded
+    backend.close()
+
+
+def test_walk_uses_commit_graph(local_repo):
+    local_repo.maintain()
+    backend = git_module.get_backend(local_repo.path)
+    master = backend.resolve('origin/master')
+    pr_head = backend.resolve('pr_head/1')
+    expected = local_repo.cmd([
+        'rev-list', '--left-right', '--count',
+        '{}...{}'.format(master, pr_head)])
+
+    backend.drop_history()
+    with patch.object(backend, 'read_object') as read_object:
+        backend.load_history([master, pr_head])
+        counts = backend.count_exclusive(master, pr_head)
+    assert read_object.call_count == 0
+    assert counts == tuple(int(count) for count in expected.split())
+    assert not backend._parents
@@ -120,6 +120,46 @@ class TestPush(object):
         assert pr_loaded.ahead_of_master is None
         assert pr_loaded.behind_master is None
 
+    @pytest.mark.parametrize('payload,counts', [
+        ({'forced': False}, (1, 5)),
+        ({'forced': True}, (None, None)),
+        ({'before': '0' * 40}, (None, None)),
+        ({'commits': [{'id': 'sha{}'.format(i)} for i in range(20)]},
+         (None, None)),
+    ])
+    def test_master_fast_forward(self, session, project, hook_post, payload,
+                                 counts):
+        for number, head in [(1, 'sha1'), (2, 'merged')]:
+            session.add(PullRequest(
+                project=project, number=number, head=head, owner='me',
+                title='foo', ahead_of_master=1, behind_master=2, is_open=True,
+                is_mergeable=True,
+            ))
+        session.commit()
+        data = {
+            'repository': {
+                'name': project.name,
+                'owner': {
+                    'name': project.owner,
+                },
+            },
+            'ref': "refs/heads/master",
+            'before': 'before',
+            'after': 'after',
+            'forced': False,
+            'commits': [{'id': 'merged'}, {'id': 'after'}, {'id': 'other'}],
+        }
+        data.update(payload)
+        res = hook_post(data, 'push')
+        assert res.data == Responses.MASTER_PUSH_OK
+
+        pr1 = session.query(PullRequest).get((1, project.id))
+        assert (pr1.ahead_of_master, pr1.behind_master) == counts
+        assert pr1.is_mergeable is None
+        # merged by this push
+        pr2 = session.query(PullRequest).get((2, project.id))
+        assert pr2.behind_master is None
+
 
 class TestPullRequest(object):
     @pytest.fixture(autouse=True)
@@ -0,0 +1,206 @@
+import binascii
+import os
+import subprocess
+
+import pytest
+
+from cinch.object_store import (
+    CommitGraph, ObjectStore, RefStore, apply_delta)
+
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'cinch',
+    'GIT_AUTHOR_EMAIL': 'cinch@example.com',
+    'GIT_COMMITTER_NAME': 'cinch',
+    'GIT_COMMITTER_EMAIL': 'cinch@example.com',
+}
+
+
+def git(git_dir, *args):
+    env = dict(os.environ, **GIT_ENV)
+    return subprocess.check_output(
+        ('git', '--git-dir={}'.format(git_dir)) + args, env=env).strip()
+
+
+@pytest.fixture
+def git_dir(tmpdir):
+    """A bare repo with history that deltifies well"""
+    path = tmpdir.join('repo.git').strpath
+    subprocess.check_call(['git', 'init', '--quiet', '--bare', path])
+
+    content = ''.join('line {}\n'.format(i) for i in range(200))
+    parent = None
+    for i in range(10):
+        content += 'change {}\n'.format(i)
+        blob = hash_object(path, content)
+        tree = mktree(path, '100644 blob {}\tfile\n'.format(blob))
+        args = ['commit-tree', tree, '-m', 'commit {}'.format(i)]
+        if parent is not None:
+            args += ['-p', parent]
+        parent = git(path, *args)
+    git(path, 'update-ref', 'refs/heads/master', parent)
+    return path
+
+
+def hash_object(git_dir, content):
+    process = subprocess.Popen(
+        ['git', '--git-dir={}'.format(git_dir), 'hash-object', '-w',
+         '--stdin'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output, _ = process.communicate(content)
+    return output.strip()
+
+
+def mktree(git_dir, entries):
+    process = subprocess.Popen(
+        ['git', '--git-dir={}'.format(git_dir), 'mktree'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output, _ = process.communicate(entries)
+    return output.strip()
+
+
+def all_objects(git_dir):
+    output = git(
+        git_dir, 'cat-file', '--batch-all-objects',
+        '--batch-check=%(objectname) %(objecttype)')
+    return [line.split() for line in output.splitlines()]
+
+
+def assert_reads_all_objects(git_dir):
+    store = ObjectStore(git_dir)
+    objects = all_objects(git_dir)
+    assert objects
+    for sha, object_type in objects:
+        expected = git(git_dir, 'cat-file', object_type, sha)
+        read_type, data = store.read(sha)
+        assert read_type == object_type
+        assert data.strip() == expected
+    store.close()
+
+
+def test_loose_objects(git_dir):
+    assert_reads_all_objects(git_dir)
+
+
+def test_ofs_deltas(git_dir):
+    git(git_dir, 'repack', '-a', '-d', '-f', '-q', '--depth=50')
+    assert_reads_all_objects(git_dir)
+
+
+def test_ref_deltas(git_dir):
+    git(git_dir, '-c', 'repack.useDeltaBaseOffset=false',
+        'repack', '-a', '-d', '-f', '-q', '--depth=50')
+    assert_reads_all_objects(git_dir)
+
+
+def test_missing_object(git_dir):
+    store = ObjectStore(git_dir)
+    assert store.read('0' * 40) is None
+
+
+def test_new_packs_picked_up(git_dir):
+    store = ObjectStore(git_dir)
+    master = git(git_dir, 'rev-parse', 'master')
+    assert store.read(master)[0] == 'commit'
+
+    # objects move into a new pack; the old files are deleted
+    git(git_dir, 'repack', '-a', '-d', '-q')
+    git(git_dir, 'prune-packed')
+    assert store.read(master)[0] == 'commit'
+    git(git_dir, 'repack', '-a', '-d', '-f', '-q')
+    assert store.read(master)[0] == 'commit'
+
+
+def test_dropped_packs_still_readable(git_dir):
+    git(git_dir, 'repack', '-a', '-d', '-q')
+    store = ObjectStore(git_dir)
+    store.scan_packs()
+    # e.g. held by a thread that was reading while the repo was repacked
+    [pack] = store._packs.values()
+    master = git(git_dir, 'rev-parse', 'master')
+    offset = pack.index.find(binascii.unhexlify(master))
+
+    # a new commit, so the new pack is named differently
+    commit = git(
+        git_dir, 'commit-tree', 'master^{tree}', '-p', master, '-m', 'new')
+    git(git_dir, 'update-ref', 'refs/heads/master', commit)
+    git(git_dir, 'repack', '-a', '-d', '-q')
+    store.scan_packs()
+    assert pack not in store._packs.values()
+    assert pack.read(offset, store)[0] == 'commit'
+
+
+def test_alternates(git_dir, tmpdir):
+    path = tmpdir.join('borrower.git').strpath
+    subprocess.check_call(
+        ['git', 'clone', '--quiet', '--bare', '--shared', git_dir, path])
+
+    store = ObjectStore(path)
+    master = git(git_dir, 'rev-parse', 'master')
+    assert store.read(master)[0] == 'commit'
+
+
+def test_refs(git_dir):
+    refs = RefStore(git_dir)
+    master = git(git_dir, 'rev-parse', 'master')
+    first = git(git_dir, 'rev-parse', 'master~9')
+
+    git(git_dir, 'update-ref', 'refs/remotes/origin/master', master)
+    assert refs.resolve('master') == master
+    assert refs.resolve('HEAD') == master  # symbolic
+    assert refs.resolve('origin/master') == master
+    assert refs.resolve('refs/heads/master') == master
+    assert refs.resolve('unknown') is None
+    assert refs.resolve('../../etc/passwd') is None
+
+    git(git_dir, 'pack-refs', '--all')
+    assert refs.resolve('origin/master') == master
+
+    # loose refs take precedence over packed ones
+    git(git_dir, 'update-ref', 'refs/remotes/origin/master', first)
+    assert refs.resolve('origin/master') == first
+    git(git_dir, 'pack-refs', '--all')
+    assert refs.resolve('origin/master') == first
+
+
+def test_commit_graph(git_dir):
+    # an octopus merge of three branches off the first commit
+    tree = git(git_dir, 'rev-parse', 'master^{tree}')
+    first = git(git_dir, 'rev-parse', 'master~9')
+    parents = [
+        git(git_dir, 'commit-tree', tree, '-p', first, '-m', str(i))
+        for i in range(3)
+    ]
+    args = ['commit-tree', tree, '-m', 'octopus']
+    for parent in [git(git_dir, 'rev-parse', 'master')] + parents:
+        args += ['-p', parent]
+    octopus = git(git_dir, *args)
+    git(git_dir, 'update-ref', 'refs/heads/octopus', octopus)
+    git(git_dir, 'commit-graph', 'write', '--reachable')
+
+    graph = CommitGraph(os.path.join(
+        git_dir, 'objects', 'info', 'commit-graph'))
+    generations = {}
+    output = git(
+        git_dir, 'rev-list', '--parents', '--topo-order', '--reverse',
+        'octopus')
+    for line in output.splitlines():
+        sha = line.split()[0]
+        expected_parents = tuple(line.split()[1:])
+        generations[sha] = 1 + max(
+            [generations[parent] for parent in expected_parents] or [0])
+        assert graph.read(sha) == (expected_parents, generations[sha])
+    assert graph.read(octopus)[1] == 11
+    assert graph.read(tree) is None
+    graph.close()
+
+
+def test_apply_delta():
+    base = b'hello world'
+    delta = bytearray([
+        len(base),  # base size
+        11,  # target size
+        0x80 | 0x01 | 0x10, 0, 6,  # copy 6 bytes from offset 0
+        5,  # insert 5 bytes
+    ]) + b'there'
+    assert apply_delta(base, bytes(delta)) == b'hello there'
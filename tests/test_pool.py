@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from cinch.pool import PoolError, ProcessPool
+
+
+def fail():
+    raise ValueError('oops')
+
+
+def die():
+    os._exit(1)
+
+
+@pytest.yield_fixture
+def pool():
+    pool = ProcessPool(2)
+    yield pool
+    pool.stop()
+
+
+def test_runs_in_other_process(pool):
+    assert pool.run('key', os.getpid) != os.getpid()
+    assert pool.run('key', sum, [1, 2]) == 3
+
+
+def test_same_key_same_process(pool):
+    pids = set(pool.run('key', os.getpid) for _ in range(5))
+    assert len(pids) == 1
+
+
+def test_keys_spread_over_processes(pool):
+    pool.start()
+    pids = set(
+        pool.run('project{}'.format(i), os.getpid) for i in range(20))
+    assert len(pids) == 2
+
+
+def test_errors(pool):
+    with pytest.raises(PoolError) as exc_info:
+        pool.run('key', fail)
+    assert 'ValueError: oops' in str(exc_info.value)
+
+    # process is still usable
+    assert pool.run('key', sum, [1, 2]) == 3
+
+
+def test_dead_process_replaced(pool):
+    pid = pool.run('key', os.getpid)
+    with pytest.raises(PoolError):
+        pool.run('key', die)
+    new_pid = pool.run('key', os.getpid)
+    assert new_pid != pid
+
+
+def test_inline():
+    pool = ProcessPool(0)
+    assert pool.run('key', os.getpid) == os.getpid()
+    with pytest.raises(ValueError):
+        pool.run('key', fail)
@@ -0,0 +1,172 @@
+from mock import patch
+import pytest
+
+from cinch import app, db
+from cinch.cache import OPEN_PULL_REQUEST_SHAS, bump_version
+from cinch.models import (
+    Project, PullRequest, PullRequestSha, PullRequestShaChange)
+from cinch.sha_index import (
+    INDEX_DATABASE, INDEX_MEMORY, find_open_pull_requests,
+    rebuild_pull_request_shas, sha_index_cache, warm_sha_index)
+
+
+@pytest.yield_fixture(params=[INDEX_MEMORY, INDEX_DATABASE])
+def index_type(request):
+    with patch.dict(app.config, {'SHA_INDEX': request.param}):
+        yield request.param
+
+
+@pytest.fixture
+def project_id(session):
+    project = Project(owner='owner', name='name')
+    session.add(project)
+    session.add(PullRequest(
+        project=project, number=1, head='head1', owner='me', title='foo',
+        is_open=True,
+    ))
+    session.commit()
+    return project.id
+
+
+def get_pull_request(project_id, number):
+    return PullRequest.query.get((number, project_id))
+
+
+def test_maintained(session, index_type, project_id):
+    assert find_open_pull_requests(['head1']) == {(project_id, 1)}
+    assert find_open_pull_requests(['unknown']) == set()
+
+    pull_request = get_pull_request(project_id, 1)
+    pull_request.merge_head = 'merge1'
+    session.add(PullRequest(
+        project_id=project_id, number=2, head='head2', owner='me',
+        title='bar', is_open=True,
+    ))
+    session.commit()
+    assert find_open_pull_requests(['head1', 'merge1', 'head2']) == {
+        (project_id, 1), (project_id, 2)}
+
+    # moved
+    pull_request = get_pull_request(project_id, 1)
+    pull_request.head = 'head1b'
+    pull_request.merge_head = None
+    session.commit()
+    assert find_open_pull_requests(['head1', 'merge1']) == set()
+    assert find_open_pull_requests(['head1b']) == {(project_id, 1)}
+
+    # closed
+    get_pull_request(project_id, 2).is_open = False
+    session.commit()
+    assert find_open_pull_requests(['head2']) == set()
+
+    session.delete(get_pull_request(project_id, 1))
+    session.commit()
+    assert find_open_pull_requests(['head1b']) == set()
+
+
+def test_unrelated_changes(session, project_id):
+    find_open_pull_requests(['head1'])
+    misses = sha_index_cache.misses
+
+    get_pull_request(project_id, 1).title = 'renamed'
+    session.commit()
+    find_open_pull_requests(['head1'])
+    assert sha_index_cache.misses == misses
+
+
+def test_own_changes_applied(session, project_id):
+    find_open_pull_requests(['head1'])
+    misses = sha_index_cache.misses
+
+    get_pull_request(project_id, 1).head = 'head1b'
+    session.flush()
+    get_pull_request(project_id, 1).merge_head = 'merge1'
+    session.add(PullRequest(
+        project_id=project_id, number=2, head='head1b', owner='me',
+        title='bar', is_open=True,
+    ))
+    session.commit()
+    assert find_open_pull_requests(['head1']) == set()
+    assert find_open_pull_requests(['head1b', 'merge1']) == {
+        (project_id, 1), (project_id, 2)}
+
+    get_pull_request(project_id, 2).is_open = False
+    session.delete(get_pull_request(project_id, 1))
+    session.commit()
+    assert find_open_pull_requests(['head1b', 'merge1']) == set()
+    assert sha_index_cache.misses == misses
+
+
+def test_rolled_back_changes(session, project_id):
+    find_open_pull_requests(['head1'])
+
+    get_pull_request(project_id, 1).head = 'head1b'
+    session.flush()
+    session.rollback()
+    assert find_open_pull_requests(['head1']) == {(project_id, 1)}
+    assert find_open_pull_requests(['head1b']) == set()
+
+
+def test_changes_made_elsewhere(session, project_id):
+    find_open_pull_requests(['head1'])
+    misses = sha_index_cache.misses
+
+    # e.g. by another process, which logs the change as this one would
+    bump_version(OPEN_PULL_REQUEST_SHAS)
+    session.execute(PullRequest.__table__.update().values(head='head1c'))
+    session.add(PullRequestShaChange(project_id=project_id, number=1))
+    session.commit()
+
+    get_pull_request(project_id, 1).merge_head = 'merge1'
+    session.commit()
+    assert find_open_pull_requests(['head1', 'head1c', 'merge1']) == {
+        (project_id, 1)}
+    assert find_open_pull_requests(['head1']) == set()
+    assert sha_index_cache.misses == misses
+
+
+def test_changes_no_longer_logged(session, project_id):
+    find_open_pull_requests(['head1'])
+    misses = sha_index_cache.misses
+
+    with patch('cinch.sha_index.KEPT_CHANGES', 1):
+        get_pull_request(project_id, 1).head = 'head1b'
+        session.commit()
+        get_pull_request(project_id, 1).head = 'head1c'
+        session.commit()
+    assert session.query(PullRequestShaChange).count() == 1
+
+    assert find_open_pull_requests(['head1', 'head1b', 'head1c']) == {
+        (project_id, 1)}
+    assert find_open_pull_requests(['head1c']) == {(project_id, 1)}
+    assert sha_index_cache.misses == misses + 1
+
+
+def test_warm(session, index_type, project_id):
+    sha_index_cache.clear()
+    misses = sha_index_cache.misses
+    warm_sha_index()
+    assert find_open_pull_requests(['head1']) == {(project_id, 1)}
+    if index_type == INDEX_MEMORY:
+        # not built again on use
+        assert sha_index_cache.misses == misses + 1
+    else:
+        assert sha_index_cache.misses == misses
+
+
+def test_rebuild(session, project_id):
+    with patch.dict(app.config, {'SHA_INDEX': INDEX_DATABASE}):
+        get_pull_request(project_id, 1).merge_head = 'merge1'
+        session.commit()
+    maintained = set(db.session.query(PullRequestSha.sha))
+
+    rebuild_pull_request_shas()
+    session.commit()
+    assert set(db.session.query(PullRequestSha.sha)) == maintained
+    assert maintained == {('head1',), ('merge1',)}
+
+
+def test_unknown_index_type(session):
+    with patch.dict(app.config, {'SHA_INDEX': 'unknown'}):
+        with pytest.raises(RuntimeError):
+            find_open_pull_requests(['head1'])
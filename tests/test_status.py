@@ -0,0 +1,268 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from cinch.status import StatusPublisher
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with server.lock:
+            server.requests.append({
+                'path': self.path,
+                'payload': json.loads(body),
+                'authorization': self.headers.get('Authorization'),
+                'client': self.client_address,
+                'time': time.time(),
+            })
+            status, headers = server.responses.pop(0) if server.responses \
+                else (201, {})
+
+        headers = dict(server.rate_limit_headers(), **headers)
+        content = json.dumps({})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGitHub(ThreadingMixIn, HTTPServer):
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeGitHubHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        # (status, headers) to respond with, in order
+        self.responses = []
+        self.limit = 5000
+        self.remaining = 5000
+        self.reset = int(time.time()) + 3600
+        # (socket, thread) of each connection
+        self.connections = []
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(
+            target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        self.connections.append((request, thread))
+        thread.start()
+
+    def close(self):
+        """Stop serving, and wait for handlers of kept-alive connections"""
+        self.shutdown()
+        self.server_close()
+        for request, thread in self.connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # already closed
+            thread.join(5)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    def rate_limit_headers(self):
+        return {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': str(self.reset),
+        }
+
+
+@pytest.yield_fixture
+def fake_github():
+    server = FakeGitHub()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def publisher(fake_github):
+    return StatusPublisher(
+        'token', base_url=fake_github.base_url, reserve=10, backoff=0.01)
+
+
+def status(state, context='ci'):
+    return {'state': state, 'context': context}
+
+
+def test_posts_statuses(fake_github, publisher):
+    publisher.publish('repos/owner/name/statuses/sha1', status('pending'))
+    publisher.publish('repos/owner/name/statuses/sha2', status('success'))
+    assert publisher.flush(5)
+
+    assert [
+        (request['path'], request['payload'])
+        for request in fake_github.requests
+    ] == [
+        ('/repos/owner/name/statuses/sha1', status('pending')),
+        ('/repos/owner/name/statuses/sha2', status('success')),
+    ]
+    assert all(
+        request['authorization'] == 'token token'
+        for request in fake_github.requests)
+    assert publisher.posted == 2
+    assert publisher.rate_limit_remaining == 5000
+
+
+def test_reuses_connections(fake_github, publisher):
+    for sha in range(5):
+        publisher.publish(
+            'repos/owner/name/statuses/{}'.format(sha), status('success'))
+        assert publisher.flush(5)
+    clients = set(request['client'] for request in fake_github.requests)
+    assert len(fake_github.requests) == 5
+    assert len(clients) == 1
+
+
+def test_coalesces_pending_statuses(fake_github, publisher):
+    # hold up the sender, so the rest queue up
+    fake_github.lock.acquire()
+    try:
+        publisher.publish('repos/owner/name/statuses/sha0', status('pending'))
+        time.sleep(0.1)
+        for state in ['pending', 'failure', 'success']:
+            publisher.publish(
+                'repos/owner/name/statuses/sha1', status(state))
+        publisher.publish(
+            'repos/owner/name/statuses/sha1', status('pending', 'other'))
+    finally:
+        fake_github.lock.release()
+    assert publisher.flush(5)
+
+    assert [request['payload'] for request in fake_github.requests] == [
+        status('pending'), status('success'), status('pending', 'other')]
+    assert publisher.coalesced == 2
+
+
+def test_retries_server_errors(fake_github, publisher):
+    fake_github.responses = [(502, {}), (500, {})]
+    publisher.publish('repos/owner/name/statuses/sha1', status('success'))
+    assert publisher.flush(5)
+    assert len(fake_github.requests) == 3
+    assert publisher.posted == 1
+
+
+def test_gives_up(fake_github, publisher):
+    fake_github.responses = (
+        [(500, {})] * (publisher.max_retries + 1) + [(422, {})])
+    publisher.publish('repos/owner/name/statuses/sha1', status('success'))
+    assert publisher.flush(5)
+    assert len(fake_github.requests) == publisher.max_retries + 1
+    assert publisher.failed == 1
+
+    # client errors aren't retried
+    publisher.publish('repos/owner/name/statuses/sha1', status('success'))
+    assert publisher.flush(5)
+    assert publisher.failed == 2
+    assert len(fake_github.requests) == publisher.max_retries + 2
+
+
+def test_waits_for_rate_limit_reset(fake_github, publisher):
+    fake_github.remaining = publisher.reserve
+    fake_github.reset = int(time.time()) + 1
+
+    publisher.publish('repos/owner/name/statuses/sha1', status('success'))
+    assert publisher.flush(5)
+    fake_github.remaining = 5000
+    publisher.publish('repos/owner/name/statuses/sha2', status('success'))
+    assert publisher.flush(5)
+
+    first, second = fake_github.requests
+    assert second['time'] >= fake_github.reset - 0.01
+
+
+def test_paces_requests():
+    publisher = StatusPublisher('token')
+    assert publisher._pace() == 0
+
+    reset = time.time() + 100
+    publisher._update_rate_limit({
+        'X-RateLimit-Limit': '5000',
+        'X-RateLimit-Remaining': '4000',
+        'X-RateLimit-Reset': str(int(reset)),
+    })
+    assert publisher._pace() == 0
+
+    # spread what's left over the rest of the window
+    publisher.rate_limit_remaining = publisher.reserve + 50
+    assert 1 < publisher._pace() <= 2
+
+    publisher.rate_limit_remaining = publisher.reserve
+    assert 99 < publisher._pace() <= 100
+
+
+def test_skips_unchanged_statuses(fake_github, publisher):
+    resource = 'repos/owner/name/statuses/sha1'
+    publisher.publish(resource, status('pending'))
+    assert publisher.flush(5)
+    publisher.publish(resource, status('pending'))
+    publisher.publish(resource, status('pending', 'other'))
+    assert publisher.flush(5)
+    assert publisher.unchanged == 1
+    assert len(fake_github.requests) == 2
+    assert publisher.stats() == {
+        'posted': 2, 'failed': 0, 'coalesced': 0, 'unchanged': 1,
+        'pending': 0,
+    }
+
+    # a pending change reverted before it was sent
+    fake_github.lock.acquire()
+    try:
+        publisher.publish('repos/owner/name/statuses/sha0', status('pending'))
+        time.sleep(0.1)
+        publisher.publish(resource, status('success'))
+        publisher.publish(resource, status('pending'))
+    finally:
+        fake_github.lock.release()
+    assert publisher.flush(5)
+    assert publisher.unchanged == 2
+    assert [request['payload'] for request in fake_github.requests][2:] == [
+        status('pending')]
+
+    publisher.publish(resource, status('success'))
+    assert publisher.flush(5)
+    assert fake_github.requests[-1]['payload'] == status('success')
+
+
+def test_failed_statuses_not_remembered(fake_github, publisher):
+    resource = 'repos/owner/name/statuses/sha1'
+    fake_github.responses = [(422, {})]
+    publisher.publish(resource, status('pending'))
+    assert publisher.flush(5)
+    publisher.publish(resource, status('pending'))
+    assert publisher.flush(5)
+    assert publisher.unchanged == 0
+    assert publisher.posted == 1
+
+
+def test_published_cache_size(fake_github):
+    publisher = StatusPublisher(
+        'token', base_url=fake_github.base_url, published_cache_size=2)
+    for sha in range(3):
+        publisher.publish(
+            'repos/owner/name/statuses/{}'.format(sha), status('pending'))
+    assert publisher.flush(5)
+    publisher.publish('repos/owner/name/statuses/0', status('pending'))
+    publisher.publish('repos/owner/name/statuses/2', status('pending'))
+    assert publisher.flush(5)
+    assert publisher.unchanged == 1
+    assert len(fake_github.requests) == 4
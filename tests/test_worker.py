@@ -1,19 +1,56 @@
+from contextlib import contextmanager
+from functools import partial
+import threading
+import time
+
 from mock import patch
+from nameko.containers import MAX_WORKERS_CONFIG_KEY
 import pytest
 
-from cinch import app
-from cinch.models import Project, PullRequest
-from cinch.worker import RepoWorker, GithubStatus
+from cinch import app, db
+from cinch.git import GitError
+from cinch.models import MasterRecompute, Project, PullRequest
+from cinch.worker import (
+    PRIORITY_BULK, PRIORITY_INTERACTIVE, RepoWorker, EventCoalescer,
+    GithubStatus, LocalDispatcher, ProjectLocks, PullRequestMoved,
+    PullRequestStatusUpdated, RecomputeScheduled, dispatcher,
+    get_nameko_config, per_project, project_locks, pull_request_moved_key)
 
 
 @pytest.yield_fixture(autouse=True)
 def fake_repo():
+    def compare_prs(pull_request_numbers, refs=None):
+        return {number: (None, None) for number in pull_request_numbers}
+
     with patch('cinch.worker.Repo', autospec=True) as Repo:
-        Repo.from_local_repo('owner', 'name').compare_pr.return_value = (
-            None, None)
+        for repo in (Repo.from_local_repo.return_value,
+                     Repo.setup_repo.return_value):
+            repo.compare_pr.return_value = (None, None)
+            repo.compare_prs.side_effect = compare_prs
+            repo.ref_snapshot.return_value = {'origin/master': 'master'}
         yield Repo
 
 
+@pytest.yield_fixture(autouse=True)
+def dispatched():
+    """Events dispatched by handlers"""
+    events = []
+
+    @contextmanager
+    def dispatcher():
+        yield events.append
+
+    with patch('cinch.worker.dispatcher', dispatcher):
+        yield events
+
+
+def run_recomputes(events):
+    worker = RepoWorker()
+    for event in events:
+        if event.type == RecomputeScheduled.type:
+            worker.recompute_pull_requests(event.data)
+
+
 class TestPush(object):
     @pytest.fixture(autouse=True)
     def project(self, session):
@@ -22,7 +59,7 @@ class TestPush(object):
         session.commit()
         return project
 
-    def test_unseen_repo(self, fake_repo, session, project):
+    def test_unseen_repo(self, fake_repo, session, project, dispatched):
         pr1 = PullRequest(
             project=project, number=1, head='sha1', owner='me', title='foo',
             is_open=True,
@@ -51,7 +88,8 @@ class TestPush(object):
         assert args1 == ('mock_owner', 'mock_name')
         assert args2 == ('my_owner', 'my_name')
 
-    def test_master_with_open_prs(self, session, project, fake_repo):
+    def test_master_with_open_prs(
+            self, session, project, fake_repo, dispatched):
         pr1 = PullRequest(
             project=project, number=1, head='sha1', owner='me', title='foo',
             is_open=True
@@ -78,12 +116,62 @@ class TestPush(object):
             'name': 'my_name',
             'owner': 'my_owner',
         })
-        assert repo.compare_pr.call_count == 2
-        args1, _ = repo.compare_pr.call_args_list[0]
-        args2, _ = repo.compare_pr.call_args_list[1]
-        assert args1 == (1,)
-        assert args2 == (2,)
-        assert repo.fetch.call_count == 1  # not once per pr
+        # only master and the merge heads of the open prs, not once per pr
+        assert repo.fetch.call_count == 0
+        assert repo.fetch_master.call_count == 1
+        args, _ = repo.fetch_master.call_args
+        assert sorted(args[0]) == [1, 2]
+
+        assert len(dispatched) == 1
+        repo.reset_mock()
+        run_recomputes(dispatched)
+        # all prs are compared in one go
+        assert repo.compare_pr.call_count == 0
+        assert repo.compare_prs.call_count == 1
+        args, _ = repo.compare_prs.call_args
+        assert sorted(args[0]) == [1, 2]
+        # all shas are resolved from a single snapshot
+        assert repo.ref_snapshot.call_count == 1
+        refs = repo.ref_snapshot.return_value
+        assert repo.compare_prs.call_args[1] == {'refs': refs}
+        for _, kwargs in repo.is_mergeable.call_args_list:
+            assert kwargs == {'refs': refs}
+        # skipped by the repo if master (and the merge heads) were fetched
+        # above, i.e. on the same worker
+        repo.fetch_master.assert_called_once_with([1, 2], sha='master')
+        repo.fetch_pull_requests.assert_called_once_with(
+            {1: 'sha1', 2: 'sha2'})
+
+    def test_git_work_in_pool(self, session, project, fake_repo, dispatched):
+        for number in [1, 2]:
+            session.add(PullRequest(
+                project=project, number=number, head='sha1', owner='me',
+                title='foo', is_open=True,
+            ))
+        session.commit()
+
+        repo = fake_repo.from_local_repo('owner', 'name')
+        repo.is_mergeable.return_value = True
+        repo.merge_head.return_value = 'merge'
+
+        def run(key, func, *args):
+            return func(*args)
+
+        with patch('cinch.worker.git_pool') as git_pool:
+            git_pool.run.side_effect = run
+            RepoWorker().master_moved({
+                'name': 'my_name',
+                'owner': 'my_owner',
+            })
+            run_recomputes(dispatched)
+
+        # one task for all pull requests, keyed by repo
+        assert git_pool.run.call_count == 1
+        args, _ = git_pool.run.call_args
+        assert args[0] == repo.path
+        for pull_request in session.query(PullRequest):
+            assert pull_request.is_mergeable
+            assert pull_request.merge_head == 'merge'
 
 
 class TestPullRequest(object):
@@ -116,6 +204,31 @@ class TestPullRequest(object):
         assert repo.compare_pr.call_count == 1
         args, _ = repo.compare_pr.call_args_list[0]
         assert args == (2,)
+        assert repo.fetch.call_count == 0
+        repo.fetch_pull_request.assert_called_once_with(2, head='sha1')
+
+
+class TestFetchAll(object):
+    def test_fetches_existing_repos(self, session, fake_repo):
+        session.add(Project(owner='my_owner', name='my_name'))
+        session.commit()
+
+        repo = fake_repo.from_local_repo('owner', 'name')
+        repo.is_repo.return_value = True
+
+        RepoWorker().fetch_all()
+        repo.fetch.assert_called_once_with()
+
+    def test_skips_missing_repos(self, session, fake_repo):
+        session.add(Project(owner='my_owner', name='my_name'))
+        session.commit()
+
+        repo = fake_repo.from_local_repo('owner', 'name')
+        repo.is_repo.return_value = False
+
+        RepoWorker().fetch_all()
+        assert repo.fetch.call_count == 0
+        assert fake_repo.setup_repo.call_count == 0
 
 
 class TestPullRequestStatusUpdated(object):
@@ -139,8 +252,8 @@ class TestPullRequestStatusUpdated(object):
 
     @pytest.yield_fixture
     def github(self):
-        with patch('cinch.worker.github') as gh:
-            yield gh
+        with patch('cinch.worker.status_publisher') as publisher:
+            yield publisher
 
     def test_payload(self, session, pull_request, fake_repo, github):
         event_data = {
@@ -158,7 +271,7 @@ class TestPullRequestStatusUpdated(object):
         worker = RepoWorker()
 
         worker.pull_request_status_updated(event_data)
-        github.post.assert_called_with(
+        github.publish.assert_called_with(
             'repos/my_owner/my_name/statuses/sha1',
             {
                 'state': 'pending',
@@ -172,7 +285,7 @@ class TestPullRequestStatusUpdated(object):
             get_status.return_value = GithubStatus.FAILURE
 
             worker.pull_request_status_updated(event_data)
-            github.post.assert_called_with(
+            github.publish.assert_called_with(
                 'repos/my_owner/my_name/statuses/sha1',
                 {
                     'state': 'failure',
@@ -194,7 +307,7 @@ class TestPullRequestStatusUpdated(object):
         })
 
         worker.pull_request_status_updated(event_data)
-        github.post.assert_called_with(
+        github.publish.assert_called_with(
             'repos/my_owner/my_name/statuses/sha1',
             {
                 'state': 'success',
@@ -203,3 +316,477 @@ class TestPullRequestStatusUpdated(object):
                 'context': 'continuous-integration/cinch',
             }
         )
+
+
+class TestMaintenance(object):
+    @pytest.fixture(autouse=True)
+    def project(self, session):
+        project = Project(owner='my_owner', name='my_name')
+        session.add(project)
+        session.commit()
+        return project
+
+    def test_maintains_idle_repos(self, fake_repo, tmpdir):
+        repo = fake_repo.from_local_repo('owner', 'name')
+        repo.path = tmpdir.strpath
+        repo.is_idle.return_value = True
+
+        with patch('cinch.worker.threading.Thread') as thread:
+            RepoWorker().maintain()
+            # still running; shouldn't start another
+            RepoWorker().maintain()
+
+        assert thread.call_count == 1
+        _, kwargs = thread.call_args
+        target, args = kwargs['target'], kwargs['args']
+        assert args[0] == [('my_owner', 'my_name')]
+
+        with patch('cinch.worker.project_locks') as locks:
+            target(*args)
+        assert repo.maintain.call_count == 1
+        # event handlers for the project aren't held up
+        assert locks.hold.call_count == 0
+
+        # lock released once done
+        with patch('cinch.worker.threading.Thread') as thread:
+            RepoWorker().maintain()
+        assert thread.call_count == 1
+        _, kwargs = thread.call_args
+        kwargs['target'](*kwargs['args'])
+
+    def test_skips_busy_repos(self, fake_repo, tmpdir):
+        repo = fake_repo.from_local_repo('owner', 'name')
+        repo.path = tmpdir.strpath
+        repo.is_idle.return_value = False
+
+        with patch('cinch.worker.threading.Thread') as thread:
+            RepoWorker().maintain()
+        _, kwargs = thread.call_args
+        kwargs['target'](*kwargs['args'])
+
+        assert repo.maintain.call_count == 0
+
+
+class TestConcurrency(object):
+    def test_worker_concurrency(self):
+        with patch.dict(app.config, {'WORKER_CONCURRENCY': '4'}):
+            assert get_nameko_config()[MAX_WORKERS_CONFIG_KEY] == 4
+
+    def test_same_project_in_order(self):
+        locks = ProjectLocks()
+        order = []
+
+        def work(number):
+            with locks.hold(('owner', 'name')):
+                order.append(number)
+                time.sleep(0.01)
+                order.append(number)
+
+        with locks.hold(('owner', 'name')):
+            threads = []
+            for number in range(5):
+                thread = threading.Thread(target=work, args=(number,))
+                thread.start()
+                threads.append(thread)
+                # let it join the queue before starting the next one
+                time.sleep(0.01)
+        for thread in threads:
+            thread.join(5)
+
+        assert order == [number for number in range(5) for _ in range(2)]
+        assert len(locks) == 0
+
+    def test_other_projects_not_blocked(self):
+        locks = ProjectLocks()
+        done = threading.Event()
+
+        def work():
+            with locks.hold(('owner', 'other')):
+                done.set()
+
+        with locks.hold(('owner', 'name')):
+            thread = threading.Thread(target=work)
+            thread.start()
+            assert done.wait(5)
+        thread.join(5)
+
+    def test_handler_holds_project_lock(self, session, fake_repo):
+        project = Project(owner='my_owner', name='my_name')
+        session.add(project)
+        session.add(PullRequest(
+            project=project, number=1, head='sha1', owner='me',
+            title='foo', is_open=True,
+        ))
+        session.commit()
+
+        held = []
+
+        def fetch_pull_request(*args, **kwargs):
+            held.append(len(project_locks))
+
+        repo = fake_repo.from_local_repo('owner', 'name')
+        repo.fetch_pull_request.side_effect = fetch_pull_request
+        repo.is_mergeable.return_value = True
+        repo.merge_head.return_value = None
+
+        with patch('cinch.worker.db.session.remove') as remove:
+            RepoWorker().pull_request_moved({
+                'name': 'my_name',
+                'owner': 'my_owner',
+                'number': 1,
+            })
+        assert held == [1]
+        assert len(project_locks) == 0
+        assert remove.call_count == 1
+
+
+class TestCoalescing(object):
+    def test_superseded_events_dropped(self):
+        coalescer = EventCoalescer()
+        first = coalescer.arrived('key')
+        other = coalescer.arrived('other')
+        second = coalescer.arrived('key')
+
+        assert not coalescer.start('key', first)
+        assert coalescer.start('other', other)
+        assert coalescer.start('key', second)
+        assert coalescer.dropped == 1
+        assert coalescer.merged == 0
+
+        # handled; a new event runs again
+        assert coalescer.start('key', coalescer.arrived('key'))
+
+    def test_claimed_events_merged(self):
+        coalescer = EventCoalescer()
+        first = coalescer.arrived('key')
+        second = coalescer.arrived('key')
+        assert coalescer.claim(['key', 'other']) == ['key']
+
+        later = coalescer.arrived('key')
+        assert not coalescer.start('key', first)
+        assert not coalescer.start('key', second)
+        assert coalescer.start('key', later)
+        assert coalescer.merged == 2
+        assert coalescer.dropped == 0
+
+    def test_queued_events_coalesced(self):
+        handled = []
+
+        class Handler(object):
+            @per_project(lambda event_data: event_data['number'])
+            def handle(self, event_data):
+                handled.append(event_data['id'])
+
+        def event(number, id_):
+            return {
+                'owner': 'my_owner', 'name': 'my_name',
+                'number': number, 'id': id_,
+            }
+
+        with patch('cinch.worker.coalescer', EventCoalescer()) as coalescer:
+            threads = []
+            with project_locks.hold(('my_owner', 'my_name')):
+                for number, id_ in [(1, 'a'), (2, 'b'), (1, 'c'), (1, 'd')]:
+                    thread = threading.Thread(
+                        target=Handler().handle, args=(event(number, id_),))
+                    thread.start()
+                    threads.append(thread)
+                    time.sleep(0.01)
+            for thread in threads:
+                thread.join(5)
+
+        assert handled == ['b', 'd']
+        assert coalescer.dropped == 2
+
+    def test_master_moved_merges_pull_request_moved(
+            self, session, fake_repo, dispatched):
+        project = Project(owner='my_owner', name='my_name')
+        session.add(project)
+        for number in [1, 2]:
+            session.add(PullRequest(
+                project=project, number=number, head='sha{}'.format(number),
+                owner='me', title='foo', is_open=True,
+            ))
+        session.commit()
+
+        repo = fake_repo.from_local_repo('owner', 'name')
+        repo.is_mergeable.return_value = True
+        repo.merge_head.return_value = None
+
+        with patch('cinch.worker.coalescer', EventCoalescer()) as coalescer:
+            # waiting behind master_moved
+            key = pull_request_moved_key('my_owner', 'my_name', 2)
+            sequence = coalescer.arrived(key)
+
+            RepoWorker().master_moved({
+                'name': 'my_name',
+                'owner': 'my_owner',
+            })
+            repo.fetch_pull_request.assert_called_once_with(2, head='sha2')
+
+            assert not coalescer.start(key, sequence)
+            assert coalescer.merged == 1
+
+        # the moved pull request keeps its priority
+        assert [
+            (event.data['numbers'], event.data['priority'])
+            for event in dispatched
+        ] == [([2], PRIORITY_INTERACTIVE), ([1], PRIORITY_BULK)]
+
+
+class TestMemory(object):
+    def test_memory_gauge(self):
+        usage = RepoWorker().memory_gauge()
+        assert usage['rss'] > 0
+        assert usage['gc_objects'] > 0
+
+    def test_status_gauge(self):
+        with patch('cinch.worker.status_publisher') as publisher:
+            publisher.stats.return_value = {
+                'posted': 3, 'failed': 0, 'coalesced': 1, 'unchanged': 2,
+                'pending': 0,
+            }
+            assert RepoWorker().status_gauge()['unchanged'] == 2
+
+    def test_session_removed_after_event(
+            self, session, fake_repo, dispatched):
+        project = Project(owner='my_owner', name='my_name')
+        session.add(project)
+        session.add(PullRequest(
+            project=project, number=1, head='sha1', owner='me',
+            title='foo', is_open=True,
+        ))
+        session.commit()
+
+        repo = fake_repo.from_local_repo('owner', 'name')
+        repo.is_mergeable.return_value = True
+        repo.merge_head.return_value = None
+
+        loaded = db.session()
+        RepoWorker().master_moved({'name': 'my_name', 'owner': 'my_owner'})
+        assert db.session() is not loaded
+        assert len(db.session.identity_map) == 0
+
+
+class TestPriorities(object):
+    def start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.start()
+        # let it join the queue before starting the next one
+        time.sleep(0.02)
+        return thread
+
+    def test_interactive_first(self):
+        locks = ProjectLocks()
+        order = []
+
+        def work(name, priority):
+            with locks.hold('project', priority):
+                order.append(name)
+
+        with locks.hold('project', PRIORITY_BULK):
+            threads = [
+                self.start(work, 'bulk1', PRIORITY_BULK),
+                self.start(work, 'interactive1', PRIORITY_INTERACTIVE),
+                self.start(work, 'bulk2', PRIORITY_BULK),
+                self.start(work, 'interactive2', PRIORITY_INTERACTIVE),
+            ]
+        for thread in threads:
+            thread.join(5)
+
+        assert order == ['interactive1', 'interactive2', 'bulk1', 'bulk2']
+        count, _, longest = locks.wait_stats()[PRIORITY_BULK]
+        assert count == 3
+        assert longest > 0
+
+    def test_recompute_tasks_bulk(self, session, fake_repo, dispatched):
+        project = Project(owner='my_owner', name='my_name')
+        session.add(project)
+        session.add(PullRequest(
+            project=project, number=1, head='sha1', owner='me',
+            title='foo', is_open=True,
+        ))
+        session.commit()
+
+        held = []
+
+        def fetch_master(*args, **kwargs):
+            held.append(project_locks._queues[('my_owner', 'my_name')].holder)
+
+        repo = fake_repo.from_local_repo('owner', 'name')
+        repo.fetch_master.side_effect = fetch_master
+        repo.is_mergeable.return_value = True
+        repo.merge_head.return_value = None
+
+        RepoWorker().master_moved({'name': 'my_name', 'owner': 'my_owner'})
+        run_recomputes(dispatched)
+        assert [priority for priority, _ in held] == [PRIORITY_BULK] * 2
+
+
+class TestFanOut(object):
+    @pytest.fixture(autouse=True)
+    def project_id(self, session):
+        project = Project(owner='my_owner', name='my_name')
+        session.add(project)
+        for number in [1, 2, 3]:
+            session.add(PullRequest(
+                project=project, number=number, head='sha1', owner='me',
+                title='foo', is_open=True,
+            ))
+        session.commit()
+        return project.id
+
+    @pytest.fixture(autouse=True)
+    def repo(self, fake_repo):
+        repo = fake_repo.from_local_repo('owner', 'name')
+        repo.is_mergeable.return_value = True
+        repo.merge_head.return_value = None
+        return repo
+
+    def master_moved(self, dispatched):
+        config = {'RECOMPUTE_CHUNK_SIZE': '2'}
+        with patch.dict(app.config, config):
+            RepoWorker().master_moved({
+                'name': 'my_name',
+                'owner': 'my_owner',
+            })
+        events = list(dispatched)
+        del dispatched[:]
+        return events
+
+    def test_tasks(self, session, project_id, dispatched):
+        events = self.master_moved(dispatched)
+
+        assert [event.data['numbers'] for event in events] == [[1, 2], [3]]
+        recompute = session.query(MasterRecompute).get(project_id)
+        assert recompute.master_sha == 'master'
+        assert recompute.pending == 2
+        assert recompute.completed_at is None
+        assert not any(pr.is_mergeable for pr in session.query(PullRequest))
+
+    def test_completion(self, session, project_id, dispatched):
+        events = self.master_moved(dispatched)
+
+        run_recomputes(events[:1])
+        recompute = session.query(MasterRecompute).get(project_id)
+        assert recompute.pending == 1
+        assert recompute.completed_at is None
+
+        run_recomputes(events[1:])
+        session.expire_all()
+        recompute = session.query(MasterRecompute).get(project_id)
+        assert recompute.pending == 0
+        assert recompute.completed_at >= recompute.started_at
+        assert all(pr.is_mergeable for pr in session.query(PullRequest))
+
+    def test_superseded(self, session, project_id, dispatched, repo):
+        old_events = self.master_moved(dispatched)
+        new_events = self.master_moved(dispatched)
+
+        repo.compare_prs.reset_mock()
+        run_recomputes(old_events)
+        assert repo.compare_prs.call_count == 0
+
+        run_recomputes(new_events)
+        recompute = session.query(MasterRecompute).get(project_id)
+        assert recompute.generation == 1
+        assert recompute.completed_at is not None
+
+    def test_failing_pull_request(
+            self, session, project_id, dispatched, repo):
+        events = self.master_moved(dispatched)
+
+        def is_mergeable(number, refs=None):
+            if number == 2:
+                raise GitError('broken')
+            return True
+
+        repo.is_mergeable.side_effect = is_mergeable
+        run_recomputes(events)
+        session.expire_all()
+        assert [
+            pr.is_mergeable
+            for pr in session.query(PullRequest).order_by(PullRequest.number)
+        ] == [True, None, True]
+        recompute = session.query(MasterRecompute).get(project_id)
+        assert recompute.completed_at is not None
+
+    def test_failing_task(self, session, project_id, dispatched, repo):
+        events = self.master_moved(dispatched)
+
+        repo.fetch_master.side_effect = GitError('broken')
+        for event in events:
+            with pytest.raises(GitError):
+                run_recomputes([event])
+        session.expire_all()
+        recompute = session.query(MasterRecompute).get(project_id)
+        assert recompute.pending == 0
+        assert recompute.completed_at is not None
+
+    def test_no_open_pull_requests(self, session, project_id, dispatched):
+        session.query(PullRequest).update({'is_open': False})
+        session.commit()
+
+        assert self.master_moved(dispatched) == []
+        recompute = session.query(MasterRecompute).get(project_id)
+        assert recompute.pending == 0
+        assert recompute.completed_at is not None
+
+class TestLocalDispatcher(object):
+    def test_selected_by_config(self):
+        with patch.dict(app.config, {'DISPATCHER': 'local'}):
+            with patch('cinch.worker.get_local_dispatcher') as get:
+                with dispatcher() as dispatch:
+                    assert dispatch == get.return_value.dispatch
+
+    def test_unknown_backend(self):
+        with patch.dict(app.config, {'DISPATCHER': 'carrier-pigeon'}):
+            with pytest.raises(RuntimeError):
+                with dispatcher():
+                    pass
+
+    def test_calls_handlers(self):
+        with patch.object(
+                RepoWorker, 'pull_request_status_updated') as handler:
+            local = LocalDispatcher()
+            local.dispatch(PullRequestStatusUpdated(data={
+                'pull_request': (1, 1),
+            }))
+            assert local.join(5)
+        handler.assert_called_once_with({'pull_request': (1, 1)})
+
+    def test_same_project_in_order(self):
+        order = []
+
+        @per_project(lambda event_data: pull_request_moved_key(
+            event_data['owner'], event_data['name'], event_data['number']))
+        def handle(self, event_data):
+            order.append(event_data['number'])
+            time.sleep(0.005)
+            order.append(event_data['number'])
+
+        local = LocalDispatcher(concurrency=5)
+        local._handlers[PullRequestMoved.type] = partial(handle, None)
+        for number in range(10):
+            local.dispatch(PullRequestMoved(data={
+                'owner': 'owner',
+                'name': 'name',
+                'number': number,
+            }))
+        assert local.join(5)
+
+        assert order == [number for number in range(10) for _ in range(2)]
+        assert len(project_locks) == 0
+
+    def test_failing_handler(self):
+        with patch.object(RepoWorker, 'pull_request_moved') as handler:
+            handler.side_effect = ValueError
+            local = LocalDispatcher()
+            for number in range(2):
+                local.dispatch(PullRequestMoved(data={
+                    'owner': 'owner',
+                    'name': 'name',
+                    'number': number,
+                }))
+            assert local.join(5)
+        assert handler.call_count == 2